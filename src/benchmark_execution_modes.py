@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from lattice_surgery_complementary_gap import InitialValue, SteanePlusSurfaceCode, SteaneSyndromeExtractionPattern
+from lattice_surgery_complementary_gap import perform_parallel_simulation
+from util import QubitMapping
+from worker_pool import WorkerPool
+
+# Compares the throughput per GB of memory of the process-pool and thread-pool modes of `WorkerPool`, running
+# `perform_parallel_simulation` of lattice_surgery_complementary_gap.py.
+#
+# Each mode runs in a fresh interpreter. Memory is the peak total PSS (proportional set size) of the
+# interpreter and its worker processes, read from /proc, so pages shared by the forked workers are counted once.
+#
+# Usage:
+#   python benchmark_execution_modes.py --num-shots 100000 --parallelism 8 --surface-distance 9
+
+
+def _pss(pid: int) -> int:
+    '''Returns the PSS of the process in bytes, or 0 if it is gone.'''
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class _PeakMemoryMonitor:
+    '''Samples the total PSS of this process and its children every `interval` seconds.'''
+    def __init__(self, interval: float = 0.05) -> None:
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            pids = [os.getpid()] + [p.pid for p in multiprocessing.active_children() if p.pid is not None]
+            self.peak = max(self.peak, sum([_pss(pid) for pid in pids]))
+            self._stopped.wait(self.interval)
+
+    def __enter__(self) -> _PeakMemoryMonitor:
+        self._thread.start()
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+def run(use_threads: bool, num_shots: int, parallelism: int, max_shots_per_task: int, surface_distance: int,
+        error_probability: float, gap_threshold: float) -> dict[str, float]:
+    r = SteanePlusSurfaceCode(
+        QubitMapping(30, 40), surface_distance, surface_distance, InitialValue.SPlus,
+        SteaneSyndromeExtractionPattern.ZXZ, False, error_probability, False, False, 3, 10, False)
+    r.run()
+    detector_for_complementary_gap = r.detector_for_complementary_gap
+    assert detector_for_complementary_gap is not None
+
+    with _PeakMemoryMonitor() as monitor:
+        start = time.perf_counter()
+        with WorkerPool(parallelism, use_threads) as pool:
+            results = perform_parallel_simulation(
+                r.primal_circuit,
+                r.partially_noiseless_circuit,
+                detector_for_complementary_gap,
+                num_shots,
+                gap_threshold,
+                False,
+                None,
+                r.num_detectors_for_lookup_table,
+                np.random.SeedSequence(0),
+                parallelism,
+                max_shots_per_task,
+                False,
+                pool)
+        elapsed = time.perf_counter() - start
+    assert len(results) == num_shots
+    return {'elapsed': elapsed, 'shots_per_second': num_shots / elapsed, 'peak_memory': monitor.peak}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='description')
+    parser.add_argument('--num-shots', type=int, default=100000)
+    parser.add_argument('--parallelism', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-shots-per-task', type=int, default=10000)
+    parser.add_argument('--surface-distance', type=int, default=5)
+    parser.add_argument('--error-probability', type=float, default=0.001)
+    parser.add_argument('--gap-threshold', type=float, default=4)
+    parser.add_argument('--mode', choices=['processes', 'threads'], default=None,
+                        help='run only this mode in this interpreter and print the result as JSON')
+
+    args = parser.parse_args()
+
+    num_shots: int = args.num_shots
+    parallelism: int = args.parallelism
+    max_shots_per_task: int = args.max_shots_per_task
+    surface_distance: int = args.surface_distance
+    error_probability: float = args.error_probability
+    gap_threshold: float = args.gap_threshold
+
+    if args.mode is not None:
+        print(json.dumps(run(args.mode == 'threads', num_shots, parallelism, max_shots_per_task, surface_distance,
+                             error_probability, gap_threshold)))
+        return
+
+    print('  num-shots = {}'.format(num_shots))
+    print('  parallelism = {}'.format(parallelism))
+    print('  max-shots-per-task = {}'.format(max_shots_per_task))
+    print('  surface-distance = {}'.format(surface_distance))
+    print('  error-probability = {}'.format(error_probability))
+    print('  gap-threshold = {}'.format(gap_threshold))
+
+    for mode in ['processes', 'threads']:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--mode', mode],
+            check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output.decode().splitlines()[-1])
+        gb = result['peak_memory'] / 2 ** 30
+        print('{:>9}: {:8.1f} shots/s, peak memory = {:.3f} GB, {:8.1f} shots/s/GB'.format(
+            mode, result['shots_per_second'], gb, result['shots_per_second'] / gb))
+
+
+if __name__ == '__main__':
+    main()
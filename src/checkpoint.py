@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import os
+import pickle
+import time
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class PhaseState:
+    '''\
+    The state of a phase (e.g., the lookup table construction) of a simulation: the merged results of the
+    completed tasks, the submitted but not completed tasks given as (num_shots, seed), the number of shots not
+    yet assigned to any task, and the number of task seeds spawned so far.
+    '''
+    payload: Any
+    remaining_tasks: list[tuple[int, int]]
+    num_unscheduled_shots: int = 0
+    num_spawned_seeds: int = 0
+
+    def is_complete(self) -> bool:
+        return len(self.remaining_tasks) == 0 and self.num_unscheduled_shots == 0
+
+
+@dataclass
+class _Checkpoint:
+    config: dict[str, Any]
+    seed: int
+    phases: dict[str, PhaseState]
+
+
+class Checkpointer:
+    '''\
+    Periodically saves the states of the phases of a simulation to `path`, so that an interrupted run can
+    resume from there.
+
+    The task seeds are stored in the checkpoint, so a resumed run computes exactly what the interrupted one
+    would have computed. `config` identifies the simulation, and resuming with a different one is an error.
+    '''
+    def __init__(
+            self, path: str, config: dict[str, Any], seed: int, interval: float,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self._checkpoint = _Checkpoint(config, seed, {})
+        self._last_saved_at = clock()
+
+    @staticmethod
+    def resume(
+            path: str, config: dict[str, Any], interval: float,
+            clock: Callable[[], float] = time.monotonic) -> Checkpointer:
+        '''Loads the checkpoint at `path`. Raises ValueError if it has a different `config`.'''
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if not isinstance(checkpoint, _Checkpoint):
+            raise ValueError('{} is not a checkpoint.'.format(path))
+        if checkpoint.config != config:
+            raise ValueError('{} was saved with different options.'.format(path))
+        checkpointer = Checkpointer(path, config, checkpoint.seed, interval, clock)
+        checkpointer._checkpoint = checkpoint
+        return checkpointer
+
+    @property
+    def seed(self) -> int:
+        return self._checkpoint.seed
+
+    def phase(self, name: str) -> PhaseState | None:
+        return self._checkpoint.phases.get(name)
+
+    def update(self, name: str, state: PhaseState) -> None:
+        '''\
+        Records the state of the phase, and saves the checkpoint if `interval` seconds have passed since the
+        last save or if the phase is complete.
+        '''
+        self._checkpoint.phases[name] = state
+        if state.is_complete() or self.clock() - self._last_saved_at >= self.interval:
+            self.save()
+
+    def save(self) -> None:
+        # Write to a temporary file first, so that a crash while writing doesn't break the previous checkpoint.
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(self._checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        self._last_saved_at = self.clock()
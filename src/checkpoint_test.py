@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from checkpoint import *
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CheckpointerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'checkpoint')
+        self.clock = FakeClock()
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_resume(self) -> None:
+        checkpointer = Checkpointer(self.path, {'a': 1}, 5, 10, self.clock)
+        self.assertIsNone(checkpointer.phase('x'))
+        checkpointer.update('x', PhaseState([1], [(10, 100), (10, 101)]))
+        checkpointer.save()
+
+        resumed = Checkpointer.resume(self.path, {'a': 1}, 10, self.clock)
+        self.assertEqual(resumed.seed, 5)
+        state = resumed.phase('x')
+        assert state is not None
+        self.assertEqual(state.payload, [1])
+        self.assertEqual(state.remaining_tasks, [(10, 100), (10, 101)])
+        self.assertIsNone(resumed.phase('y'))
+
+        with self.assertRaises(ValueError):
+            Checkpointer.resume(self.path, {'a': 2}, 10, self.clock)
+
+    def test_interval(self) -> None:
+        checkpointer = Checkpointer(self.path, {}, 5, 10, self.clock)
+        checkpointer.update('x', PhaseState(0, [(10, 100)]))
+        self.assertFalse(os.path.exists(self.path))
+
+        self.clock.now += 10
+        checkpointer.update('x', PhaseState(1, [(10, 100)]))
+        self.assertEqual(Checkpointer.resume(self.path, {}, 10).phase('x'), PhaseState(1, [(10, 100)]))
+
+        self.clock.now += 1
+        checkpointer.update('x', PhaseState(2, [(10, 100)]))
+        self.assertEqual(Checkpointer.resume(self.path, {}, 10).phase('x'), PhaseState(1, [(10, 100)]))
+
+        # A phase with unscheduled shots is not complete.
+        checkpointer.update('x', PhaseState(3, [], 10, 2))
+        self.assertEqual(Checkpointer.resume(self.path, {}, 10).phase('x'), PhaseState(1, [(10, 100)]))
+
+        # Completing a phase saves the checkpoint immediately.
+        checkpointer.update('x', PhaseState(3, []))
+        self.assertEqual(Checkpointer.resume(self.path, {}, 10).phase('x'), PhaseState(3, []))
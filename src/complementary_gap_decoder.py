@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import math
+import numpy as np
+import pymatching
+import sinter
+import stim
+
+from lookup_table import NegativeLookupTable
+
+
+class ComplementaryGapDecoder(sinter.Decoder):
+    '''\
+    A sinter decoder performing complementary-gap decoding with post-selection, as `perform_simulation` in
+    lattice_surgery_complementary_gap.py does.
+
+    A shot is discarded if any of `post_selection_ids` fires, if the syndrome on the first
+    `num_detectors_for_lookup_table` detectors is in `lookup_table`, or if its complementary gap is below
+    `gap_threshold`. Sinter doesn't let decoders discard shots, so the decoder reports discarded shots by
+    predicting a flip of `discard_observable`, an observable with no targets, which the task post-selects on.
+    Use `complementary_gap_task()` to construct such a task.
+    '''
+    def __init__(
+            self,
+            detector_for_complementary_gap: int,
+            gap_threshold: float,
+            post_selection_ids: np.ndarray,
+            discard_observable: int,
+            lookup_table: NegativeLookupTable | None = None,
+            num_detectors_for_lookup_table: int = 0,
+            with_heuristic_gap_calculation: bool = False) -> None:
+        self.detector_for_complementary_gap = detector_for_complementary_gap
+        self.gap_threshold = gap_threshold
+        self.post_selection_ids = post_selection_ids
+        self.discard_observable = discard_observable
+        self.lookup_table = lookup_table
+        self.num_detectors_for_lookup_table = num_detectors_for_lookup_table
+        self.with_heuristic_gap_calculation = with_heuristic_gap_calculation
+
+    def compile_decoder_for_dem(self, *, dem: stim.DetectorErrorModel) -> CompiledComplementaryGapDecoder:
+        return CompiledComplementaryGapDecoder(self, dem)
+
+
+class CompiledComplementaryGapDecoder(sinter.CompiledDecoder):
+    def __init__(self, decoder: ComplementaryGapDecoder, dem: stim.DetectorErrorModel) -> None:
+        assert decoder.discard_observable < dem.num_observables
+        self.decoder = decoder
+        self.num_detectors = dem.num_detectors
+        self.num_observables = dem.num_observables
+        self.matcher = pymatching.Matching.from_detector_error_model(dem)
+
+    def decode_shots_bit_packed(self, *, bit_packed_detection_event_data: np.ndarray) -> np.ndarray:
+        decoder = self.decoder
+        syndromes = np.unpackbits(
+            bit_packed_detection_event_data, axis=1, count=self.num_detectors, bitorder='little').astype(np.bool_)
+        syndromes_for_table = syndromes[:, :decoder.num_detectors_for_lookup_table]
+
+        discarded = np.any(syndromes[:, decoder.post_selection_ids], axis=1)
+        if decoder.lookup_table is not None:
+            lookup_table = decoder.lookup_table
+            for shot in np.flatnonzero(~discarded):
+                discarded[shot] = syndromes_for_table[shot].tobytes() in lookup_table
+
+        predictions = np.zeros((len(syndromes), self.num_observables), dtype=np.bool_)
+        kept = np.flatnonzero(~discarded)
+        if len(kept) > 0:
+            (prediction, weight, c_prediction, c_weight) = self._decode_with_complement(syndromes[kept])
+            gap = np.abs(weight - c_weight)
+            if decoder.with_heuristic_gap_calculation:
+                gap[~np.any(syndromes_for_table[kept], axis=1)] += 0.01
+            gap *= 100
+            predictions[kept] = np.where((c_weight < weight)[:, np.newaxis], c_prediction, prediction)
+            discarded[kept[gap < decoder.gap_threshold]] = True
+
+        predictions[discarded] = False
+        predictions[discarded, decoder.discard_observable] = True
+        return np.packbits(predictions, axis=1, bitorder='little')
+
+    def _decode_with_complement(self, syndromes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        detector = self.decoder.detector_for_complementary_gap
+        (prediction, weight) = self.matcher.decode_batch(syndromes, return_weights=True)
+        syndromes[:, detector] = ~syndromes[:, detector]
+        try:
+            (c_prediction, c_weight) = self.matcher.decode_batch(syndromes, return_weights=True)
+        except ValueError:
+            # Some complementary syndromes have no matching. Decode them one by one and give them infinite weights.
+            c_prediction = np.zeros_like(prediction)
+            c_weight = np.full(len(syndromes), math.inf)
+            for (i, syndrome) in enumerate(syndromes):
+                try:
+                    (c_prediction[i], c_weight[i]) = self.matcher.decode(syndrome, return_weight=True)
+                except ValueError:
+                    pass
+        syndromes[:, detector] = ~syndromes[:, detector]
+        return (prediction, weight, c_prediction, c_weight)
+
+
+def complementary_gap_task(
+        primal_stim_circuit: stim.Circuit,
+        partially_noiseless_stim_circuit: stim.Circuit,
+        decoder_name: str,
+        detector_for_complementary_gap: int,
+        gap_threshold: float,
+        post_selection_ids: np.ndarray,
+        lookup_table: NegativeLookupTable | None = None,
+        num_detectors_for_lookup_table: int = 0,
+        with_heuristic_gap_calculation: bool = False,
+        json_metadata: object = None) -> tuple[sinter.Task, ComplementaryGapDecoder]:
+    '''\
+    Returns a sinter task sampling `primal_stim_circuit` and decoding it with a `ComplementaryGapDecoder`
+    named `decoder_name` for the decomposed DEM of `partially_noiseless_stim_circuit`, with the decoder.
+    Pass the decoder to `sinter.collect` via `custom_decoders={decoder_name: decoder}`.
+    '''
+    discard_observable = primal_stim_circuit.num_observables
+    assert partially_noiseless_stim_circuit.num_observables == discard_observable
+
+    circuit = primal_stim_circuit.copy()
+    circuit.append('OBSERVABLE_INCLUDE', [], discard_observable)
+    matching_circuit = partially_noiseless_stim_circuit.copy()
+    matching_circuit.append('OBSERVABLE_INCLUDE', [], discard_observable)
+
+    postselected_observables_mask = np.zeros(discard_observable // 8 + 1, dtype=np.uint8)
+    postselected_observables_mask[discard_observable // 8] |= 1 << (discard_observable % 8)
+
+    task = sinter.Task(
+        circuit=circuit,
+        decoder=decoder_name,
+        detector_error_model=matching_circuit.detector_error_model(decompose_errors=True),
+        postselected_observables_mask=postselected_observables_mask,
+        json_metadata=json_metadata)
+    decoder = ComplementaryGapDecoder(
+        detector_for_complementary_gap, gap_threshold, post_selection_ids, discard_observable, lookup_table,
+        num_detectors_for_lookup_table, with_heuristic_gap_calculation)
+    return (task, decoder)
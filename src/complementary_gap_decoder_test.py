@@ -0,0 +1,76 @@
+import unittest
+
+from complementary_gap_decoder import *
+from lattice_surgery_complementary_gap import SteanePlusSurfaceCode, InitialValue, SteaneSyndromeExtractionPattern
+from lattice_surgery_complementary_gap import SimulationResultsForGapThreshold, perform_simulation
+from lookup_table import LookupTableWithNegativeSamplesOnly
+from util import QubitMapping
+
+
+class ComplementaryGapDecoderTest(unittest.TestCase):
+    def _new_instance(self) -> SteanePlusSurfaceCode:
+        mapping = QubitMapping(30, 40)
+        r = SteanePlusSurfaceCode(
+            mapping, 3, 3, InitialValue.SPlus, SteaneSyndromeExtractionPattern.ZXZ, False, 2e-3, False, False, 3,
+            3, False)
+        r.run()
+        return r
+
+    def _collect(self, r: SteanePlusSurfaceCode, num_shots: int, seed: int, gap_threshold: float,
+                 lookup_table: LookupTableWithNegativeSamplesOnly | None) -> tuple[int, int, int]:
+        assert r.detector_for_complementary_gap is not None
+        (task, decoder) = complementary_gap_task(
+            r.primal_circuit.circuit,
+            r.partially_noiseless_circuit.circuit,
+            'complementary-gap',
+            r.detector_for_complementary_gap.id,
+            gap_threshold,
+            r.primal_circuit.post_selection_ids,
+            lookup_table,
+            r.num_detectors_for_lookup_table)
+        assert task.circuit is not None
+        assert task.detector_error_model is not None
+        discard_observable = task.circuit.num_observables - 1
+        self.assertEqual(decoder.discard_observable, discard_observable)
+
+        # Sample the original circuit with the seed used by `perform_simulation`.
+        sampler = r.primal_circuit.circuit.compile_detector_sampler(seed=seed)
+        detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
+        compiled = decoder.compile_decoder_for_dem(dem=task.detector_error_model)
+        predictions = compiled.decode_shots_bit_packed(
+            bit_packed_detection_event_data=np.packbits(detection_events, axis=1, bitorder='little'))
+        predictions = np.unpackbits(predictions, axis=1, count=discard_observable + 1, bitorder='little')
+
+        discarded = predictions[:, discard_observable] == 1
+        wrong = np.any(predictions[:, :discard_observable] != observable_flips, axis=1) & ~discarded
+        num_discarded = int(np.count_nonzero(discarded))
+        num_wrong = int(np.count_nonzero(wrong))
+        return (num_shots - num_discarded - num_wrong, num_wrong, num_discarded)
+
+    def test_same_as_perform_simulation(self) -> None:
+        r = self._new_instance()
+        assert r.detector_for_complementary_gap is not None
+        num_shots = 2000
+        seed = 42
+        gap_threshold = 2
+
+        # Reject every shot whose syndrome for the lookup table is seen in the first 200 shots and nontrivial.
+        sampler = r.primal_circuit.circuit.compile_detector_sampler(seed=seed)
+        detection_events = sampler.sample(200)
+        lookup_table = LookupTableWithNegativeSamplesOnly()
+        for syndrome in detection_events[:, :r.num_detectors_for_lookup_table]:
+            if np.any(syndrome):
+                lookup_table.table[syndrome.tobytes()] = 1
+
+        results = perform_simulation(
+            r.primal_circuit, r.partially_noiseless_circuit, num_shots, gap_threshold, False, lookup_table,
+            r.num_detectors_for_lookup_table, r.detector_for_complementary_gap, seed)
+        assert isinstance(results, SimulationResultsForGapThreshold)
+
+        for (table, entry) in [(None, results.entry_without_lookup_table()),
+                               (lookup_table, results.entry_with_lookup_table())]:
+            self.assertEqual(
+                self._collect(r, num_shots, seed, gap_threshold, table),
+                (entry.num_valid_samples(), entry.num_wrong_samples(), entry.num_discarded_samples()))
+        self.assertGreater(results.entry_with_lookup_table().num_discarded_samples(),
+                           results.entry_without_lookup_table().num_discarded_samples())
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import math
+import numpy as np
+
+
+class GapHistogram:
+    '''\
+    A histogram of the complementary gaps of the samples that are not discarded by post-selection, counting
+    valid and wrong samples separately, from which the results for any discard rate can be read out at the end.
+    The i-th bin counts gaps in [i * bin_width, (i + 1) * bin_width), and the last bin also counts the gaps
+    beyond, including infinite gaps. The histogram has a fixed number of bins, so its size doesn't depend on
+    the number or the values of the samples, and histograms with the same bins can be merged.
+    '''
+    DEFAULT_MAX_GAP = 2 ** 14
+
+    def __init__(self, bin_width: float = 1, max_gap: float = DEFAULT_MAX_GAP) -> None:
+        assert bin_width > 0
+        assert max_gap > 0
+        self.bin_width = bin_width
+        self.max_gap = max_gap
+        num_bins = math.ceil(max_gap / bin_width)
+        self.num_valid_samples: np.ndarray = np.zeros(num_bins, dtype=np.int64)
+        self.num_wrong_samples: np.ndarray = np.zeros(num_bins, dtype=np.int64)
+        self.num_discarded_samples: int = 0
+
+    def bin_indices(self, gaps: np.ndarray) -> np.ndarray:
+        num_bins = len(self.num_valid_samples)
+        return np.clip(np.floor(np.asarray(gaps, dtype=np.float64) / self.bin_width), 0, num_bins - 1).astype(np.intp)
+
+    def add(self, gap: float, expected: bool) -> None:
+        [index] = self.bin_indices(np.array([gap]))
+        if expected:
+            self.num_valid_samples[index] += 1
+        else:
+            self.num_wrong_samples[index] += 1
+
+    def add_many(self, gaps: np.ndarray, expected: np.ndarray) -> None:
+        '''Adds the samples with `gaps`, which are valid where `expected` is true and wrong elsewhere.'''
+        expected = np.asarray(expected, dtype=np.bool_)
+        indices = self.bin_indices(gaps)
+        num_bins = len(self.num_valid_samples)
+        self.num_valid_samples += np.bincount(indices[expected], minlength=num_bins)
+        self.num_wrong_samples += np.bincount(indices[~expected], minlength=num_bins)
+
+    def add_discarded(self, num_samples: int = 1) -> None:
+        self.num_discarded_samples += num_samples
+
+    def extend(self, other: GapHistogram) -> None:
+        assert self.bin_width == other.bin_width
+        assert self.max_gap == other.max_gap
+        self.num_valid_samples += other.num_valid_samples
+        self.num_wrong_samples += other.num_wrong_samples
+        self.num_discarded_samples += other.num_discarded_samples
+
+    def discard(self, rates: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''\
+        Returns (num_valid, num_wrong, num_discarded, bin_index) when discarding the samples with the smallest
+        gaps in addition to those discarded by post-selection, so that `rates` of all samples are discarded.
+        Samples are discarded bin by bin, and the valid and wrong samples in the bin at the boundary, at
+        `bin_index`, are discarded in proportion to their counts.
+        '''
+        rates = np.asarray(rates, dtype=np.float64)
+        num_samples = len(self)
+        counts = self.num_valid_samples + self.num_wrong_samples
+        # The number of samples discarded when discarding up to the i-th bin.
+        cumulative_discarded = self.num_discarded_samples + np.cumsum(counts)
+        cumulative_valid = np.cumsum(self.num_valid_samples)
+        cumulative_wrong = np.cumsum(self.num_wrong_samples)
+
+        num_to_be_discarded = num_samples * rates
+        bin_index = np.minimum(
+            np.searchsorted(cumulative_discarded, num_to_be_discarded, side='left'), len(counts) - 1)
+        bin_count = counts[bin_index]
+        d = cumulative_discarded[bin_index] - bin_count
+        v = cumulative_valid[-1] - cumulative_valid[bin_index] + self.num_valid_samples[bin_index]
+        w = cumulative_wrong[-1] - cumulative_wrong[bin_index] + self.num_wrong_samples[bin_index]
+
+        num_to_be_discarded_additionally = num_to_be_discarded - d
+        partial = num_to_be_discarded_additionally > 0
+        valid_rate = np.divide(
+            self.num_valid_samples[bin_index], bin_count, out=np.zeros(len(rates)), where=bin_count > 0)
+        v = np.where(partial, v - np.round(num_to_be_discarded_additionally * valid_rate), v).astype(np.int64)
+        w = np.where(partial, w - np.round(num_to_be_discarded_additionally * (1 - valid_rate)), w).astype(np.int64)
+        d = np.where(partial, num_samples - v - w, d).astype(np.int64)
+        return (v, w, d, bin_index)
+
+    def __len__(self) -> int:
+        return int(np.sum(self.num_valid_samples) + np.sum(self.num_wrong_samples)) + self.num_discarded_samples
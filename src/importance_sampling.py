@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import math
+import numpy as np
+import stim
+
+from collections.abc import Generator
+
+# The maximum number of bytes of the bit-packed errors sampled at once by `ImportanceSampler.sample`.
+_MAX_ERROR_BYTES_PER_CHUNK = 2 ** 26
+
+
+def _error_mechanisms(dem: stim.DetectorErrorModel) -> tuple[np.ndarray, list[list[stim.DemTarget]]]:
+    '''Returns the probabilities and the targets of the error mechanisms of `dem`, in the order stim samples them.'''
+    probabilities: list[float] = []
+    targets: list[list[stim.DemTarget]] = []
+    for instruction in dem.flattened():
+        if isinstance(instruction, stim.DemInstruction) and instruction.type == 'error':
+            probabilities.append(instruction.args_copy()[0])
+            targets.append(instruction.targets_copy())
+    return (np.array(probabilities, dtype=np.float64), targets)
+
+
+class ImportanceSampler:
+    '''\
+    Samples shots from `sampling_dem`, a detector error model with inflated error probabilities, and weights
+    each shot by its likelihood ratio under `target_dem`, the real model. Rare failures then need far fewer
+    shots to observe, and the sums of the weights (see `WeightSums`) are unbiased estimates for the real model.
+
+    The two models must have the same error mechanisms in the same order, with different probabilities, as
+    the DEMs of one circuit built with two error probabilities do. When the mechanisms in F fire, the weight
+    of the shot is prod_{i in F} p_i / q_i * prod_{i not in F} (1 - p_i) / (1 - q_i), where p_i and q_i are
+    the probabilities of the i-th mechanism in `target_dem` and `sampling_dem` respectively.
+    '''
+    def __init__(self, target_dem: stim.DetectorErrorModel, sampling_dem: stim.DetectorErrorModel) -> None:
+        (p, target_targets) = _error_mechanisms(target_dem)
+        (q, sampling_targets) = _error_mechanisms(sampling_dem)
+        if target_targets != sampling_targets:
+            raise ValueError('The detector error models have different error mechanisms.')
+        if np.any((q == 0) & (p > 0)):
+            raise ValueError('The sampling model never samples some errors of the target model.')
+        self.sampling_dem = sampling_dem
+        with np.errstate(divide='ignore'):
+            log_ratio_without_fault = np.log1p(-p) - np.log1p(-q)
+            # A mechanism which the target model never samples makes the weight zero. The ones which neither
+            # model samples never fire.
+            log_ratio_with_fault = np.where(q > 0, np.log(p) - np.log(np.where(q > 0, q, 1)), 0)
+        self._log_weight_without_faults = float(np.sum(log_ratio_without_fault))
+        self._log_weight_per_fault = log_ratio_with_fault - log_ratio_without_fault
+
+    def weights(self, packed_errors: np.ndarray) -> np.ndarray:
+        '''Returns the weights of shots with `packed_errors`, the bit-packed errors stim's DEM sampler returns.'''
+        # Errors are sparse, so look only at the bytes recording some errors.
+        (shots, byte_indices) = np.nonzero(packed_errors)
+        bits = np.unpackbits(packed_errors[shots, byte_indices][:, np.newaxis], axis=1, bitorder='little')
+        (fault_indices, bit_indices) = np.nonzero(bits)
+        errors = byte_indices[fault_indices] * 8 + bit_indices
+        log_weights = self._log_weight_without_faults + np.bincount(
+            shots[fault_indices], weights=self._log_weight_per_fault[errors], minlength=len(packed_errors))
+        return np.exp(log_weights)
+
+    def sample(
+            self, num_shots: int, seed: int | None) -> Generator[tuple[np.ndarray, np.ndarray, np.ndarray], None, None]:
+        '''\
+        Samples `num_shots` shots in chunks, and yields (detection_events, observable_flips, weights) for each
+        chunk, with the detection events and observable flips as boolean arrays.
+        '''
+        for (detection_events, observable_flips, packed_errors) in sample_errors(self.sampling_dem, num_shots, seed):
+            yield (detection_events, observable_flips, self.weights(packed_errors))
+
+
+def sample_errors(
+        dem: stim.DetectorErrorModel,
+        num_shots: int,
+        seed: int | None) -> Generator[tuple[np.ndarray, np.ndarray, np.ndarray], None, None]:
+    '''\
+    Samples `num_shots` shots of `dem` in chunks, and yields (detection_events, observable_flips, packed_errors)
+    for each chunk, with the detection events and observable flips as boolean arrays and the errors which fired
+    bit-packed, as `ImportanceSampler.weights` takes them.
+    '''
+    sampler = dem.compile_sampler(seed=seed)
+    num_error_bytes = max(1, (dem.num_errors + 7) // 8)
+    chunk_size = max(1, _MAX_ERROR_BYTES_PER_CHUNK // num_error_bytes)
+    for start in range(0, num_shots, chunk_size):
+        n = min(chunk_size, num_shots - start)
+        (packed_detection_events, packed_observable_flips, packed_errors) = sampler.sample(
+            n, bit_packed=True, return_errors=True)
+        detection_events = np.unpackbits(
+            packed_detection_events, axis=1, count=dem.num_detectors, bitorder='little').astype(np.bool_)
+        observable_flips = np.unpackbits(
+            packed_observable_flips, axis=1, count=dem.num_observables, bitorder='little').astype(np.bool_)
+        yield (detection_events, observable_flips, packed_errors)
+
+
+class WeightSums:
+    '''The sum of the weights of the samples of some outcome, and the sum of their squares.'''
+    def __init__(self) -> None:
+        self.total: float = 0.0
+        self.total_of_squares: float = 0.0
+
+    def add(self, weight: float) -> None:
+        self.total += weight
+        self.total_of_squares += weight * weight
+
+    def extend(self, other: WeightSums) -> None:
+        self.total += other.total
+        self.total_of_squares += other.total_of_squares
+
+
+def effective_sample_size(sums: WeightSums) -> float:
+    '''\
+    Returns Kish's effective sample size of the samples whose weights `sums` holds, (sum w)^2 / sum w^2.
+    It is the number of samples when all the weights are equal, and drops when a few samples dominate, which
+    happens when the sampling model is far from the target model.
+    '''
+    if sums.total_of_squares == 0:
+        return 0.0
+    return sums.total * sums.total / sums.total_of_squares
+
+
+def estimate(sums: WeightSums, num_shots: int) -> tuple[float, float]:
+    '''\
+    Returns the unbiased estimate of the probability of the outcome whose weights `sums` holds, out of
+    `num_shots` shots, and the variance of the estimate.
+    '''
+    assert num_shots > 0
+    mean = sums.total / num_shots
+    if num_shots == 1:
+        return (mean, math.inf)
+    variance = max(0.0, sums.total_of_squares - num_shots * mean * mean) / (num_shots - 1) / num_shots
+    return (mean, variance)
+
+
+def estimate_ratio(wrong: WeightSums, valid: WeightSums, num_shots: int) -> tuple[float, float]:
+    '''\
+    Returns the estimate of P(wrong) / (P(valid) + P(wrong)) for two disjoint outcomes out of `num_shots`
+    shots, and its variance to first order (the delta method). Returns nan for the estimate if no shot has
+    either outcome.
+    '''
+    (a, variance_a) = estimate(wrong, num_shots)
+    (b, variance_b) = estimate(valid, num_shots)
+    if a + b == 0:
+        return (math.nan, math.nan)
+    # No shot has both outcomes, so the covariance of the two estimates is -E[a]E[b] / num_shots.
+    covariance = -a * b / num_shots
+    variance = (b * b * variance_a + a * a * variance_b - 2 * a * b * covariance) / (a + b) ** 4
+    return (a / (a + b), variance)
@@ -0,0 +1,88 @@
+import math
+import numpy as np
+import stim
+import unittest
+
+from importance_sampling import ImportanceSampler, WeightSums, effective_sample_size, estimate, estimate_ratio
+
+
+def _dem(p: float) -> stim.DetectorErrorModel:
+    return stim.DetectorErrorModel('''
+        error({}) D0
+        error({}) D0 D1
+        error({}) D1 L0
+        error(0.25) D2
+    '''.format(p, 2 * p, 3 * p))
+
+
+class ImportanceSamplerTest(unittest.TestCase):
+    def test_weights(self) -> None:
+        (p, q) = (np.array([0.01, 0.02, 0.03, 0.25]), np.array([0.1, 0.2, 0.3, 0.25]))
+        sampler = ImportanceSampler(_dem(0.01), _dem(0.1))
+        errors = np.array([[False] * 4, [True, False, False, True], [True, True, True, False]])
+
+        weights = sampler.weights(np.packbits(errors, axis=1, bitorder='little'))
+
+        expected = np.prod(np.where(errors, p / q, (1 - p) / (1 - q)), axis=1)
+        np.testing.assert_allclose(weights, expected)
+
+    def test_same_models(self) -> None:
+        sampler = ImportanceSampler(_dem(0.1), _dem(0.1))
+        for (detection_events, observable_flips, weights) in sampler.sample(100, seed=1):
+            self.assertEqual(detection_events.shape, (100, 3))
+            self.assertEqual(observable_flips.shape, (100, 1))
+            np.testing.assert_allclose(weights, np.ones(100))
+
+    def test_unbiased(self) -> None:
+        sampler = ImportanceSampler(_dem(0.01), _dem(0.1))
+        sums = WeightSums()
+        num_shots = 0
+        for (_, observable_flips, weights) in sampler.sample(100_000, seed=1):
+            for w in weights[observable_flips[:, 0]]:
+                sums.add(float(w))
+            num_shots += len(weights)
+
+        (mean, variance) = estimate(sums, num_shots)
+        self.assertLess(abs(mean - 0.03), 4 * math.sqrt(variance))
+
+    def test_different_models(self) -> None:
+        with self.assertRaises(ValueError):
+            ImportanceSampler(_dem(0.01), stim.DetectorErrorModel('error(0.1) D0'))
+        with self.assertRaises(ValueError):
+            ImportanceSampler(_dem(0.01), _dem(0))
+
+
+class EstimateTest(unittest.TestCase):
+    def test_estimate(self) -> None:
+        sums = WeightSums()
+        sums.add(1)
+        sums.add(3)
+        (mean, variance) = estimate(sums, 4)
+        self.assertEqual(mean, 1)
+        # The sample variance of [1, 3, 0, 0] is 2, so the variance of the mean is 2 / 4.
+        self.assertAlmostEqual(variance, 0.5)
+
+    def test_effective_sample_size(self) -> None:
+        sums = WeightSums()
+        self.assertEqual(effective_sample_size(sums), 0)
+        for _ in range(4):
+            sums.add(0.5)
+        self.assertAlmostEqual(effective_sample_size(sums), 4)
+        sums.add(8)
+        self.assertAlmostEqual(effective_sample_size(sums), 100 / 65)
+
+    def test_estimate_ratio(self) -> None:
+        wrong = WeightSums()
+        valid = WeightSums()
+        self.assertTrue(math.isnan(estimate_ratio(wrong, valid, 10)[0]))
+        wrong.add(1)
+        valid.add(1)
+        valid.add(1)
+        valid.add(1)
+        (rate, variance) = estimate_ratio(wrong, valid, 4)
+        self.assertEqual(rate, 0.25)
+        self.assertGreater(variance, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
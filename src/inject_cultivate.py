@@ -8,6 +8,7 @@ import math
 import numpy as np
 import pymatching
 import stim
+import sys
 
 import steane_code
 
@@ -19,6 +20,7 @@ from steane_code import SteaneZ0145SyndromeMeasurement, SteaneZ0235SyndromeMeasu
 from steane_code import STEANE_0, STEANE_1, STEANE_2, STEANE_3, STEANE_4, STEANE_5, STEANE_6
 from surface_code import SurfaceStabilizerPattern, SurfaceSyndromeMeasurement
 from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement
+from task_sizing import TaskSizer, max_shots_for_memory, runs_serially, timed
 
 
 class CircuitsWithAdditionalProperties:
@@ -64,7 +66,7 @@ def perform_simulation(
     detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
 
     results = SimulationResults()
-    postselection_ids = np.array([id.id for id in circuits.circuit.detectors_for_post_selection], dtype='uint')
+    postselection_ids = circuits.circuit.post_selection_ids
 
     for shot in range(num_shots):
         syndrome = detection_events[shot]
@@ -83,48 +85,40 @@ def perform_parallel_simulation(
         num_shots: int,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> SimulationResults:
-    if num_shots / parallelism < 1000 or parallelism == 1:
-        return perform_simulation(
-                circuits,
-                num_shots,
-                None)
+        show_progress: bool,
+        target_task_duration: float | None = None) -> SimulationResults:
+    results = SimulationResults()
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
+    if runs_serially(num_shots, parallelism, target_task_duration):
+        while (size := sizer.next_task_size()) > 0:
+            results.extend(perform_simulation(circuits, size, None))
+        return results
 
     progress = 0
-    results = SimulationResults()
     with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        while remaining_shots > 0:
-            seed = None
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(perform_simulation,
-                                     circuits,
-                                     num_shots_for_this_task,
-                                     seed)
-            futures.append(future)
+        shots_for_future: dict[concurrent.futures.Future, int] = {}
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                while len(shots_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    seed = None
+                    future = executor.submit(timed, perform_simulation, circuits, size, seed)
+                    shots_for_future[future] = size
+                if len(shots_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        results.extend(future.result())
-                        progress = len(results)
-                    else:
-                        new_futures.append(future)
-                futures = new_futures
+                (done, _) = concurrent.futures.wait(
+                    shots_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, future_results) = future.result()
+                    results.extend(future_results)
+                    progress = len(results)
+                    sizer.record(shots_for_future.pop(future), duration)
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in shots_for_future:
                 future.cancel()
     return results
 
@@ -135,6 +129,10 @@ def main() -> None:
     parser.add_argument('--error-probability', type=float, default=0)
     parser.add_argument('--parallelism', type=int, default=1)
     parser.add_argument('--max-shots-per-task', type=int, default=2 ** 20)
+    parser.add_argument('--max-memory-per-task', type=int, default=1024,
+                        help='in MiB, for the sampled detection events of a task')
+    parser.add_argument('--target-task-duration', type=float, default=None,
+                        help='in seconds; size tasks from the measured cost per shot instead of --max-shots-per-task')
     parser.add_argument('--intermediate-surface-distance', type=int, default=3)
     parser.add_argument('--final-surface-distance', type=int, default=None)
     parser.add_argument('--full-post-selection', action='store_true')
@@ -143,10 +141,18 @@ def main() -> None:
 
     args = parser.parse_args()
 
+    if args.max_shots_per_task <= 0 or args.max_memory_per_task <= 0:
+        print('Error: --max-shots-per-task and --max-memory-per-task must be positive.', file=sys.stderr)
+        return
+    if args.target_task_duration is not None and args.target_task_duration <= 0:
+        print('Error: --target-task-duration must be positive.', file=sys.stderr)
+        return
     print('  num-shots = {}'.format(args.num_shots))
     print('  error-probability = {}'.format(args.error_probability))
     print('  parallelism = {}'.format(args.parallelism))
     print('  max-shots-per-task = {}'.format(args.max_shots_per_task))
+    print('  max-memory-per-task = {}'.format(args.max_memory_per_task))
+    print('  target-task-duration = {}'.format(args.target_task_duration))
     print('  print-circuit = {}'.format(args.print_circuit))
     print('  show-progress = {}'.format(args.show_progress))
 
@@ -154,6 +160,8 @@ def main() -> None:
     error_probability: float = args.error_probability
     parallelism: int = args.parallelism
     max_shots_per_task: int = args.max_shots_per_task
+    max_memory_per_task: int = args.max_memory_per_task
+    target_task_duration: float | None = args.target_task_duration
     print_circuit: bool = args.print_circuit
     show_progress: bool = args.show_progress
 
@@ -179,12 +187,14 @@ def main() -> None:
     if num_shots == 0:
         return
 
+    max_shots_per_task = min(max_shots_per_task, max_shots_for_memory(max_memory_per_task * 2 ** 20, stim_circuit))
     results = perform_parallel_simulation(
         CircuitsWithAdditionalProperties(circuit),
         num_shots,
         parallelism,
         max_shots_per_task,
-        show_progress)
+        show_progress,
+        target_task_duration)
 
     num_valid = results.num_valid_samples
     num_wrong = results.num_wrong_samples
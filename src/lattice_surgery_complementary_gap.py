@@ -5,25 +5,42 @@ import concurrent.futures
 import argparse
 import enum
 import math
+import os
 import numpy as np
 import pymatching
 import random
 import re
+import sinter
 import sqlite3
 import stim
 import sys
+import tempfile
 
 import steane_code
 
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from collections.abc import Callable, Iterator
+from complementary_gap_decoder import ComplementaryGapDecoder, complementary_gap_task
+from dataclasses import asdict, dataclass, replace
 from enum import auto
+from gap_histogram import GapHistogram
+from importance_sampling import ImportanceSampler, WeightSums, effective_sample_size, estimate, estimate_ratio
+from importance_sampling import sample_errors
 from util import QubitMapping, Circuit, MultiplexingCircuit
 from util import MeasurementIdentifier, DetectorIdentifier, ObservableIdentifier, SuppressNoise
 from surface_code import SurfaceStabilizerPattern, SurfaceSyndromeMeasurement
-from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement
-from lookup_table import LookupTable, LookupTableKey, LookupTableWithNegativeSamplesOnly
+from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement, SurfaceSyndromeMeasurementScheduler
+from checkpoint import Checkpointer, PhaseState
+from lookup_table import LookupTable, LookupTableKey, LookupTableWithNegativeSamplesOnly, NegativeLookupTable
+from lookup_table import SortedArrayLookupTable
 from lookup_table import ensure_lookup_tables_table, query_lookup_table, store_lookup_table
+from results_db import StoredResults, ensure_results_table, num_accumulated_shots, query_results, store_results
+from sampling import sample_in_chunks
+from shard import OPTIONS_NOT_AFFECTING_SHARD_RESULTS, Shard, ShardFile, add_shard_arguments
+from shard import load_shard_files_to_merge, make_shard_config, parse_shard_arguments, save_shard_file, spawn_seeds
+from staged_sampling import sample_in_stages
+from task_sizing import TaskSizer, max_shots_for_memory, runs_serially, timed
+from typing import Any
+from worker_pool import WorkerPool, borrow_executor, cached_matcher
 
 
 class InitialValue(enum.Enum):
@@ -46,7 +63,13 @@ class SteanePlusSurfaceCode:
                  error_probability: float, with_heuristic_post_selection: bool,
                  full_post_selection: bool, num_stabilization_rounds_after_surgery: int,
                  num_epilogue_syndrome_extraction_rounds: int,
-                 skip_detector_for_complementary_gap: bool) -> None:
+                 skip_detector_for_complementary_gap: bool,
+                 use_repeat_blocks: bool = False) -> None:
+        '''\
+        When `use_repeat_blocks` is true, the steady-state stabilization and epilogue rounds are emitted as
+        stim REPEAT blocks instead of being unrolled. In that case all the stabilization rounds share the
+        layering tag "Stabilize'".
+        '''
         self.mapping = mapping
         self.surface_intermediate_distance = surface_intermediate_distance
         self.surface_distance = surface_intermediate_distance
@@ -80,6 +103,7 @@ class SteanePlusSurfaceCode:
         self.detector_for_complementary_gap: DetectorIdentifier | None = None
         self.num_detectors_for_lookup_table: int = -1
         self.skip_detector_for_complementary_gap = skip_detector_for_complementary_gap
+        self.use_repeat_blocks = use_repeat_blocks
 
         self._setup_syndrome_measurements()
 
@@ -130,6 +154,24 @@ class SteanePlusSurfaceCode:
             for m in self.surface_syndrome_measurements.values():
                 m.set_post_selection(True)
 
+    def add_circuit_variant(
+            self, noiseless_qubits: list[tuple[int, int]], error_probability: float | None = None) -> Circuit:
+        '''\
+        Adds a circuit variant that is built together with the primal circuit by `run()`.
+
+        The variant shares all measurement, detector and observable IDs with the primal circuit, but has its own
+        error probability and its own set of noiseless qubits. Unlike `self.partially_noiseless_circuit`, the
+        noiseless qubits of a variant stay noiseless until the end of the protocol.
+        This must be called before `run()`.
+        '''
+        assert self.primal_circuit.circuit.num_measurements == 0
+        if error_probability is None:
+            error_probability = self.error_probability
+        variant = Circuit(self.mapping, error_probability)
+        variant.mark_qubits_as_noiseless(noiseless_qubits)
+        self.circuit.circuits.append(variant)
+        return variant
+
     def _prepare_qubits_for_code_expansion_upward(self) -> None:
         if self.surface_intermediate_distance == self.surface_final_distance:
             return
@@ -347,7 +389,6 @@ class SteanePlusSurfaceCode:
         assert len(syndrome_measurements) == (surface_distance * surface_distance) - 1
 
     def run(self) -> None:
-        SURFACE_SYNDROME_MEASUREMENT_DEPTH = 6
         surface_distance = self.surface_distance
         circuit = self.circuit
         mapping = self.mapping
@@ -356,7 +397,7 @@ class SteanePlusSurfaceCode:
         surface_offset_y = self.surface_offset_y
 
         if self.perfect_initialization:
-            for stim_circuit in [self.primal_circuit.circuit, self.partially_noiseless_circuit.circuit]:
+            for stim_circuit in [c.circuit for c in self.circuit.circuits]:
                 match self.initial_value:
                     case InitialValue.Plus:
                         steane_code.perform_perfect_steane_plus_initialization(stim_circuit, mapping)
@@ -462,33 +503,34 @@ class SteanePlusSurfaceCode:
         for m in self.surface_syndrome_measurements.values():
             m.set_post_selection(False)
 
-        for _ in range(SURFACE_SYNDROME_MEASUREMENT_DEPTH):
-            for m in self.surface_syndrome_measurements.values():
-                m.run()
-            circuit.place_tick()
+        # The set of syndrome measurements doesn't change from now on.
+        self.surface_syndrome_scheduler = SurfaceSyndromeMeasurementScheduler(
+            circuit, self.surface_syndrome_measurements.values())
+        self.surface_syndrome_scheduler.run_round()
         circuit.place_layering_tick('Escape!')
 
-        for i in range(self.num_stabilization_rounds_after_surgery):
-            for _ in range(SURFACE_SYNDROME_MEASUREMENT_DEPTH):
-                for m in self.surface_syndrome_measurements.values():
-                    m.run()
-                circuit.place_tick()
-            circuit.place_layering_tick('Stabilize\'_{}'.format(i))
+        if self.use_repeat_blocks:
+            circuit.place_repeated(
+                self.num_stabilization_rounds_after_surgery,
+                lambda: self._perform_surface_syndrome_extraction_round('Stabilize\''))
+            if self.num_epilogue_syndrome_extraction_rounds > 0:
+                circuit.place_repeated(
+                    self.num_epilogue_syndrome_extraction_rounds - 1,
+                    lambda: self._perform_surface_syndrome_extraction_round('[wait for gap]'))
+                self._perform_surface_syndrome_extraction_round(None)
+        else:
+            for i in range(self.num_stabilization_rounds_after_surgery):
+                self._perform_surface_syndrome_extraction_round('Stabilize\'_{}'.format(i))
 
-        for i in range(self.num_epilogue_syndrome_extraction_rounds):
-            for _ in range(SURFACE_SYNDROME_MEASUREMENT_DEPTH):
-                for m in self.surface_syndrome_measurements.values():
-                    m.run()
-                circuit.place_tick()
-            if i < self.num_epilogue_syndrome_extraction_rounds - 1:
-                circuit.place_layering_tick('[wait for gap]')
+            for i in range(self.num_epilogue_syndrome_extraction_rounds):
+                if i < self.num_epilogue_syndrome_extraction_rounds - 1:
+                    self._perform_surface_syndrome_extraction_round('[wait for gap]')
+                else:
+                    self._perform_surface_syndrome_extraction_round(None)
 
         # Perfect verification of the resultant state.
         with SuppressNoise(circuit):
-            for _ in range(SURFACE_SYNDROME_MEASUREMENT_DEPTH):
-                for m in self.surface_syndrome_measurements.values():
-                    m.run()
-                circuit.place_tick()
+            self.surface_syndrome_scheduler.run_round()
 
             ms: list[MeasurementIdentifier] = []
             match self.initial_value:
@@ -513,6 +555,11 @@ class SteanePlusSurfaceCode:
                     circuit.place_observable_include(ms)
             circuit.place_layering_tick('ready')
 
+    def _perform_surface_syndrome_extraction_round(self, layering_tag: str | None) -> None:
+        self.surface_syndrome_scheduler.run_round()
+        if layering_tag is not None:
+            self.circuit.place_layering_tick(layering_tag)
+
     def _logical_x_pauli_string(self) -> stim.PauliString:
         surface_distance = self.surface_distance
         mapping = self.mapping
@@ -543,6 +590,11 @@ class SteanePlusSurfaceCode:
         return self._logical_x_pauli_string() * self._logical_z_pauli_string()
 
 
+# The names of the phases in checkpoints.
+LOOKUP_TABLE_CONSTRUCTION_PHASE = 'lookup-table-construction'
+EVALUATION_PHASE = 'evaluation'
+
+
 def construct_lookup_table(
         primal_stim_circuit: stim.Circuit,
         partially_noiseless_stim_circuit: stim.Circuit,
@@ -550,62 +602,59 @@ def construct_lookup_table(
         detector_for_complementary_gap: DetectorIdentifier,
         num_detectors_for_lookup_table: int,
         seed: int | None,
-        detectors_for_post_selection: list[DetectorIdentifier],
+        postselection_ids: np.ndarray,
         gap_threshold: float,
         with_heuristic_gap_calculation) -> tuple[LookupTable, bool]:
     # We construct a decoder for `partially_noiseless_stim_circuit`, not to confuse the matching decoder with
     # non-matchable detectors. We perform post-selection for all detectors in the Steane code, so the difference
     # between the two DEMs should be small...
-    dem = partially_noiseless_stim_circuit.detector_error_model(decompose_errors=True)
-    matcher = pymatching.Matching.from_detector_error_model(dem)
-
-    # However, we construct a sampler from `primal_stim_circuit` because it is *the real* circuit.
-    sampler = primal_stim_circuit.compile_detector_sampler(seed=seed)
-    detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
+    matcher = cached_matcher(partially_noiseless_stim_circuit)
 
     results = SimulationResultsForDiscardRates()
-    postselection_ids = np.array([id.id for id in detectors_for_post_selection], dtype='uint')
 
     table = LookupTable(gap_threshold=gap_threshold)
 
     all_nontrivial_syndromes_have_gap_below_threshold = True
-    for shot in range(num_shots):
-        syndrome = detection_events[shot]
-        if np.any(syndrome[postselection_ids] != 0):
-            results.add_discarded()
-            continue
+    # However, we sample `primal_stim_circuit` because it is *the real* circuit. It is sampled chunk by chunk, so
+    # that only one chunk of the samples is in memory.
+    for (detection_events, observable_flips) in sample_in_chunks(primal_stim_circuit, num_shots, seed):
+        for shot in range(len(detection_events)):
+            syndrome = detection_events[shot]
+            if np.any(syndrome[postselection_ids] != 0):
+                results.add_discarded()
+                continue
 
-        prediction, weight = matcher.decode(syndrome, return_weight=True)
-        min_weight = weight
-        max_weight = weight
+            prediction, weight = matcher.decode(syndrome, return_weight=True)
+            min_weight = weight
+            max_weight = weight
 
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
-        try:
-            c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
-        except ValueError:
-            c_prediction = None
-            c_weight = math.inf
-        if c_weight < min_weight:
-            prediction = c_prediction
-        min_weight = min(min_weight, c_weight)
-        max_weight = max(max_weight, c_weight)
+            syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+            try:
+                c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
+            except ValueError:
+                c_prediction = None
+                c_weight = math.inf
+            if c_weight < min_weight:
+                prediction = c_prediction
+            min_weight = min(min_weight, c_weight)
+            max_weight = max(max_weight, c_weight)
 
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+            syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
 
-        actual = observable_flips[shot]
-        assert isinstance(prediction, np.ndarray)
-        expected = np.array_equal(actual, prediction)
-        gap = max_weight - min_weight
+            actual = observable_flips[shot]
+            assert isinstance(prediction, np.ndarray)
+            expected = np.array_equal(actual, prediction)
+            gap = max_weight - min_weight
 
-        syndrome_for_table_is_trivial: bool = all(syndrome[:num_detectors_for_lookup_table] == 0)
-        if with_heuristic_gap_calculation and syndrome_for_table_is_trivial:
-            gap += 0.01
+            syndrome_for_table_is_trivial: bool = all(syndrome[:num_detectors_for_lookup_table] == 0)
+            if with_heuristic_gap_calculation and syndrome_for_table_is_trivial:
+                gap += 0.01
 
-        gap *= 100
+            gap *= 100
 
-        table.add(syndrome[:num_detectors_for_lookup_table], gap, expected)
-        if not syndrome_for_table_is_trivial and gap >= gap_threshold:
-            all_nontrivial_syndromes_have_gap_below_threshold = False
+            table.add(syndrome[:num_detectors_for_lookup_table], gap, expected)
+            if not syndrome_for_table_is_trivial and gap >= gap_threshold:
+                all_nontrivial_syndromes_have_gap_below_threshold = False
 
     return (table, all_nontrivial_syndromes_have_gap_below_threshold)
 
@@ -616,75 +665,96 @@ def parallel_construct_lookup_table(
         num_shots: int,
         detector_for_complementary_gap: DetectorIdentifier,
         num_detectors_for_lookup_table: int,
-        seed: int,
+        seed: np.random.SeedSequence,
         gap_threshold: float,
         with_heuristic_gap_calculation: bool,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> tuple[LookupTable, bool]:
-    if num_shots / parallelism < 1000 or parallelism == 1:
+        show_progress: bool,
+        pool: WorkerPool | None = None,
+        checkpointer: Checkpointer | None = None,
+        target_task_duration: float | None = None) -> tuple[LookupTable, bool]:
+    # A run with `checkpointer` goes through the tasks below even if it is small, so that it is checkpointed.
+    if checkpointer is None and runs_serially(num_shots, parallelism, target_task_duration):
         return construct_lookup_table(
             primal_circuit.circuit,
             partially_noiseless_circuit.circuit,
             num_shots,
             detector_for_complementary_gap,
             num_detectors_for_lookup_table,
-            seed,
-            primal_circuit.detectors_for_post_selection,
+            spawn_seeds(seed, 1)[0],
+            primal_circuit.post_selection_ids,
             gap_threshold,
             with_heuristic_gap_calculation)
 
-    table = LookupTable(gap_threshold=gap_threshold)
-    progress = 0
+    # Task seeds are spawned from a child of `seed` as tasks are created, so that the phase consumes exactly one
+    # child of `seed` however its shots are split.
+    phase_seed = seed.spawn(1)[0]
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
+    tasks: list[tuple[int, int]] = []
 
+    table = LookupTable(gap_threshold=gap_threshold)
     all_nontrivial_syndromes_have_gap_below_threshold = True
 
-    with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        num_shots_for_future: dict[concurrent.futures.Future, int] = {}
-        while remaining_shots > 0:
-            seed_to_pass = (seed + remaining_shots) % (2 ** 64)
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(construct_lookup_table,
+    state = None if checkpointer is None else checkpointer.phase(LOOKUP_TABLE_CONSTRUCTION_PHASE)
+    if state is not None:
+        (table, all_nontrivial_syndromes_have_gap_below_threshold) = state.payload
+        tasks = state.remaining_tasks
+        sizer.remaining_shots = state.num_unscheduled_shots
+        phase_seed = np.random.SeedSequence(
+            phase_seed.entropy, spawn_key=phase_seed.spawn_key, n_children_spawned=state.num_spawned_seeds)
+    progress = num_shots - sizer.remaining_shots - sum([n for (n, _) in tasks])
+
+    with borrow_executor(pool, parallelism) as executor:
+        task_for_future: dict[concurrent.futures.Future, tuple[int, int]] = {}
+
+        def submit(task: tuple[int, int]) -> None:
+            (num_shots_for_this_task, seed_to_pass) = task
+            future = executor.submit(timed,
+                                     construct_lookup_table,
                                      primal_circuit.circuit,
                                      partially_noiseless_circuit.circuit,
                                      num_shots_for_this_task,
                                      detector_for_complementary_gap,
                                      num_detectors_for_lookup_table,
                                      seed_to_pass,
-                                     primal_circuit.detectors_for_post_selection,
+                                     primal_circuit.post_selection_ids,
                                      gap_threshold,
                                      with_heuristic_gap_calculation)
-            futures.append(future)
-            num_shots_for_future[future] = num_shots_for_this_task
+            task_for_future[future] = task
+
+        for task in tasks:
+            submit(task)
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                # Keep every worker busy, while leaving the remaining shots to tasks sized with newer measurements.
+                while len(task_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    submit((size, spawn_seeds(phase_seed, 1)[0]))
+                if len(task_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        table_per_task, all_nontrivial_syndromes_have_gap_below_threshold_per_task = future.result()
-                        table.extend(table_per_task)
-                        all_nontrivial_syndromes_have_gap_below_threshold = \
-                            all_nontrivial_syndromes_have_gap_below_threshold and \
-                            all_nontrivial_syndromes_have_gap_below_threshold_per_task
-                        progress += num_shots_for_future[future]
-                        del num_shots_for_future[future]
-                    else:
-                        new_futures.append(future)
-                futures = new_futures
+                (done, _) = concurrent.futures.wait(
+                    task_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, (table_per_task, all_nontrivial_syndromes_have_gap_below_threshold_per_task)) = \
+                        future.result()
+                    table.extend(table_per_task)
+                    all_nontrivial_syndromes_have_gap_below_threshold = \
+                        all_nontrivial_syndromes_have_gap_below_threshold and \
+                        all_nontrivial_syndromes_have_gap_below_threshold_per_task
+                    (num_shots_for_this_task, _) = task_for_future.pop(future)
+                    sizer.record(num_shots_for_this_task, duration)
+                    progress += num_shots_for_this_task
+                if checkpointer is not None:
+                    checkpointer.update(LOOKUP_TABLE_CONSTRUCTION_PHASE, PhaseState(
+                        (table, all_nontrivial_syndromes_have_gap_below_threshold), list(task_for_future.values()),
+                        sizer.remaining_shots, phase_seed.n_children_spawned))
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in task_for_future:
                 future.cancel()
     return (table, all_nontrivial_syndromes_have_gap_below_threshold)
 
@@ -697,136 +767,89 @@ class SyndromeExtractionRound:
 
 class SyndromeExtractionRounds:
     def __init__(self, circuit: Circuit, qubits_refreshing_label: str) -> None:
-        self._rounds: list[SyndromeExtractionRound] = []
+        metadata = circuit.detector_metadata()
+        self._rounds: list[SyndromeExtractionRound] = [
+            SyndromeExtractionRound(label, i) for (i, label) in enumerate(metadata.round_labels)]
         self._num_qubits_used_for: dict[SyndromeExtractionRound, int] = {}
-        self._aborting_rounds_for: list[SyndromeExtractionRound] = []
-        qubits_in_use: set[int] = set()
-        num_detectors_in_this_round = 0
-
-        annotation_gates = {
-            'DETECTOR',
-            'MPAD',
-            'OBSERVABLE_INCLUDE',
-            'QUBIT_COORDS',
-            'SHIFT_COORDS',
-            'TICK'
-        }
-        error_gates = {
-            'CORRELATED_ERROR',
-            'DEPOLARIZE1',
-            'DEPOLARIZE2',
-            'E',
-            'ELSE_CORRELATED_ERROR',
-            'HERALDED_ERASE',
-            'HERALDED_PAULI_CHANNEL_1',
-            'II_ERROR',
-            'I_ERROR',
-            'PAULI_CHANNEL_1',
-            'PAULI_CHANNEL_2',
-            'X_ERROR',
-            'Y_ERROR',
-            'Z_ERROR'
-        }
+        qubits_in_use = np.zeros(metadata.round_qubit_usage.shape[1], dtype=bool)
+        for (r, usage) in zip(self._rounds, metadata.round_qubit_usage):
+            qubits_in_use |= usage
+            self._num_qubits_used_for[r] = int(np.count_nonzero(qubits_in_use))
+            if r.label == qubits_refreshing_label:
+                qubits_in_use[:] = False
 
-        for inst in circuit.circuit:
-            # We don't support CircuitRepeatBlock.
-            assert isinstance(inst, stim.CircuitInstruction)
-            if inst.name == 'TICK' and inst.tag != '':
-                r = SyndromeExtractionRound(inst.tag, len(self._rounds))
-                self._rounds.append(r)
-                self._num_qubits_used_for[r] = len(qubits_in_use)
-                if inst.tag == qubits_refreshing_label:
-                    qubits_in_use = set()
-                for _ in range(num_detectors_in_this_round):
-                    self._aborting_rounds_for.append(r)
-                num_detectors_in_this_round = 0
-            if inst.name == 'DETECTOR':
-                num_detectors_in_this_round += 1
-            if inst.name not in annotation_gates and inst.name not in error_gates:
-                for target in inst.targets_copy():
-                    if target.is_combiner:
-                        continue
-                    if target.is_qubit_target:
-                        qubits_in_use.add(target.value)
-                    elif target.is_x_target or target.is_y_target or target.is_z_target:
-                        qubits_in_use.add(target.value)
-                    else:
-                        raise ValueError('Unsupported gate target')
-
-        assert num_detectors_in_this_round == 0
+        assert np.all(metadata.detector_rounds >= 0)
+        self._aborting_round_indices: np.ndarray = metadata.detector_rounds
 
     def num_qubits_used(self, round: SyndromeExtractionRound) -> int:
         return self._num_qubits_used_for[round]
 
     def aborting_round_for_syndrome(self, syndrome: np.ndarray) -> SyndromeExtractionRound:
         assert any(syndrome)
-        return self._aborting_rounds_for[np.argmax(syndrome)]
+        return self._rounds[self._aborting_round_indices[np.argmax(syndrome)]]
 
     def aborting_round_for_detector_index(self, detector_index: int) -> SyndromeExtractionRound:
-        return self._aborting_rounds_for[detector_index]
+        return self._rounds[self._aborting_round_indices[detector_index]]
+
+    def count_aborting_rounds(self, syndromes: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        '''\
+        Returns the number of `syndromes` aborting at each round, indexed by the round index, or the sums of
+        their `weights` if given. Each row of `syndromes` must have a non-zero element.
+        '''
+        assert np.all(np.any(syndromes, axis=1))
+        round_indices = self._aborting_round_indices[np.argmax(syndromes, axis=1)]
+        return np.bincount(round_indices, weights=weights, minlength=len(self._rounds))
+
+    @property
+    def aborting_round_indices(self) -> np.ndarray:
+        '''Returns the index of the round that each detector belongs to.'''
+        return self._aborting_round_indices
 
     def rounds(self) -> list[SyndromeExtractionRound]:
         return self._rounds
 
 
-class SimulationResultsForDiscardRates:
-    class Bucket:
-        def __init__(self) -> None:
-            self.num_valid_samples: int = 0
-            self.num_wrong_samples: int = 0
-
-    def __init__(self) -> None:
-        self.buckets: list[SimulationResultsForDiscardRates.Bucket] = []
-        self.num_discarded_samples: int = 0
-
-    def ensure_bucket(self, gap: float) -> SimulationResultsForDiscardRates.Bucket:
-        int_gap = int(gap)
-        if len(self.buckets) > int_gap:
-            return self.buckets[int_gap]
-        Bucket = SimulationResultsForDiscardRates.Bucket
-        self.buckets.extend([Bucket() for _ in range(int_gap - len(self.buckets) + 1)])
-        assert len(self.buckets) == int_gap + 1
-        return self.buckets[int_gap]
-
-    def add(self, gap: float, expected: bool) -> None:
-        bucket = self.ensure_bucket(gap)
-
-        if expected:
-            bucket.num_valid_samples += 1
-        else:
-            bucket.num_wrong_samples += 1
-
-    def add_discarded(self) -> None:
-        self.num_discarded_samples += 1
-
-    def extend(self, other: SimulationResultsForDiscardRates) -> None:
-        Bucket = SimulationResultsForDiscardRates.Bucket
-        self.buckets.extend([Bucket() for _ in range(len(other.buckets) - len(self.buckets))])
-        assert len(self.buckets) >= len(other.buckets)
-
-        self.num_discarded_samples += other.num_discarded_samples
-        for (i, bucket) in enumerate(other.buckets):
-            self.buckets[i].num_valid_samples += bucket.num_valid_samples
-            self.buckets[i].num_wrong_samples += bucket.num_wrong_samples
-
-    def __len__(self) -> int:
-        return sum([b.num_valid_samples + b.num_wrong_samples for b in self.buckets]) + self.num_discarded_samples
+class SimulationResultsForDiscardRates(GapHistogram):
+    '''The results of a simulation for discard rates, as a histogram of the gaps scaled by 100.'''
 
 
 class SimulationResultsForGapThreshold:
+    '''\
+    The results of a simulation with a gap threshold, with and without the lookup table. With importance
+    sampling, each sample has a weight, its likelihood ratio (see `ImportanceSampler`), and the entries keep
+    the sums of the weights next to the counts.
+
+    The entry without the lookup table holds one in `without_lookup_table_interval` shots, or none if it is
+    zero (see `perform_simulation`).
+    '''
     class Entry:
         def __init__(self) -> None:
             self._num_valid_samples: int = 0
             self._num_wrong_samples: int = 0
-            self._num_discarded_samples: dict[SyndromeExtractionRound, int] = {}
+            # The numbers of the discarded samples and the sums of their weights and squared weights, indexed
+            # by the round index. They grow as rounds with higher indices are seen.
+            self._num_discarded_samples = np.zeros(0, dtype=np.int64)
+            self._discarded_weight_totals = np.zeros(0, dtype=np.float64)
+            self._discarded_weight_totals_of_squares = np.zeros(0, dtype=np.float64)
+            self._valid_weights = WeightSums()
+            self._wrong_weights = WeightSums()
+
+        def _ensure_num_rounds(self, num_rounds: int) -> None:
+            size = len(self._num_discarded_samples)
+            if num_rounds > size:
+                self._num_discarded_samples = np.pad(self._num_discarded_samples, (0, num_rounds - size))
+                self._discarded_weight_totals = np.pad(self._discarded_weight_totals, (0, num_rounds - size))
+                self._discarded_weight_totals_of_squares = \
+                    np.pad(self._discarded_weight_totals_of_squares, (0, num_rounds - size))
 
         def extend(self, other: SimulationResultsForGapThreshold.Entry):
             self._num_valid_samples += other._num_valid_samples
             self._num_wrong_samples += other._num_wrong_samples
-            for round, count in other._num_discarded_samples.items():
-                if round not in self._num_discarded_samples:
-                    self._num_discarded_samples[round] = 0
-                self._num_discarded_samples[round] += count
+            self._valid_weights.extend(other._valid_weights)
+            self._wrong_weights.extend(other._wrong_weights)
+            self.add_discarded_counts(
+                other._num_discarded_samples, other._discarded_weight_totals,
+                other._discarded_weight_totals_of_squares)
 
         def num_valid_samples(self) -> int:
             return self._num_valid_samples
@@ -835,51 +858,128 @@ class SimulationResultsForGapThreshold:
             return self._num_wrong_samples
 
         def num_discarded_samples(self) -> int:
-            return sum(self._num_discarded_samples.values())
+            return int(np.sum(self._num_discarded_samples))
 
         def num_discarded_samples_for(self, round: SyndromeExtractionRound) -> int:
-            return self._num_discarded_samples.get(round, 0)
-
-        def add_valid(self) -> None:
+            if round.index >= len(self._num_discarded_samples):
+                return 0
+            return int(self._num_discarded_samples[round.index])
+
+        def valid_weights(self) -> WeightSums:
+            return self._valid_weights
+
+        def wrong_weights(self) -> WeightSums:
+            return self._wrong_weights
+
+        def discarded_weights(self) -> WeightSums:
+            weights = WeightSums()
+            weights.total = float(np.sum(self._discarded_weight_totals))
+            weights.total_of_squares = float(np.sum(self._discarded_weight_totals_of_squares))
+            return weights
+
+        def discarded_weights_for(self, round: SyndromeExtractionRound) -> WeightSums:
+            weights = WeightSums()
+            if round.index < len(self._num_discarded_samples):
+                weights.total = float(self._discarded_weight_totals[round.index])
+                weights.total_of_squares = float(self._discarded_weight_totals_of_squares[round.index])
+            return weights
+
+        def add_valid(self, weight: float = 1.0) -> None:
             self._num_valid_samples += 1
+            self._valid_weights.add(weight)
 
-        def add_wrong(self) -> None:
+        def add_wrong(self, weight: float = 1.0) -> None:
             self._num_wrong_samples += 1
-
-        def add_discarded(self, round: SyndromeExtractionRound) -> None:
-            if round not in self._num_discarded_samples:
-                self._num_discarded_samples[round] = 0
-            self._num_discarded_samples[round] += 1
+            self._wrong_weights.add(weight)
+
+        def add_discarded(self, round: SyndromeExtractionRound, weight: float = 1.0) -> None:
+            self._ensure_num_rounds(round.index + 1)
+            self._num_discarded_samples[round.index] += 1
+            self._discarded_weight_totals[round.index] += weight
+            self._discarded_weight_totals_of_squares[round.index] += weight * weight
+
+        def add_discarded_samples(self, round: SyndromeExtractionRound, weights: np.ndarray) -> None:
+            '''Adds `len(weights)` samples discarded at `round`, with `weights`.'''
+            self._ensure_num_rounds(round.index + 1)
+            self._num_discarded_samples[round.index] += len(weights)
+            self._discarded_weight_totals[round.index] += float(np.sum(weights))
+            self._discarded_weight_totals_of_squares[round.index] += float(np.sum(weights * weights))
+
+        def add_discarded_counts(
+                self,
+                counts: np.ndarray,
+                weight_totals: np.ndarray | None = None,
+                weight_totals_of_squares: np.ndarray | None = None) -> None:
+            '''\
+            Adds `counts[i]` discarded samples for the round with index i, with the sums of their weights and
+            squared weights. The weights are one unless given. See `SyndromeExtractionRounds.count_aborting_rounds`.
+            '''
+            n = len(counts)
+            self._ensure_num_rounds(n)
+            self._num_discarded_samples[:n] += counts.astype(np.int64)
+            self._discarded_weight_totals[:n] += counts if weight_totals is None else weight_totals
+            self._discarded_weight_totals_of_squares[:n] += \
+                counts if weight_totals_of_squares is None else weight_totals_of_squares
 
         def __len__(self):
             return self._num_valid_samples + self._num_wrong_samples + self.num_discarded_samples()
 
-    def __init__(self, gap_threshold: float) -> None:
+    def __init__(
+            self,
+            gap_threshold: float,
+            importance_sampled: bool = False,
+            without_lookup_table_interval: int = 1) -> None:
+        assert without_lookup_table_interval >= 0
         self._entry_with_lookup_table = SimulationResultsForGapThreshold.Entry()
         self._entry_without_lookup_table = SimulationResultsForGapThreshold.Entry()
 
         self.gap_threshold = gap_threshold
-
-    def add_discarded(self, round: SyndromeExtractionRound) -> None:
-        self._entry_with_lookup_table.add_discarded(round)
-        self._entry_without_lookup_table.add_discarded(round)
+        self.importance_sampled = importance_sampled
+        self.without_lookup_table_interval = without_lookup_table_interval
+
+    def add_discarded(self, round: SyndromeExtractionRound, weight: float = 1.0) -> None:
+        self._entry_with_lookup_table.add_discarded(round, weight)
+        self._entry_without_lookup_table.add_discarded(round, weight)
+
+    def add_discarded_syndromes(
+            self,
+            rounds: SyndromeExtractionRounds,
+            syndromes: np.ndarray,
+            weights: np.ndarray | None = None,
+            entries: list[SimulationResultsForGapThreshold.Entry] | None = None) -> None:
+        '''\
+        Adds the samples with `syndromes` discarded by the post-selection, with `weights` if given, to `entries`,
+        or to both entries if not given.
+        '''
+        counts = rounds.count_aborting_rounds(syndromes)
+        weight_totals = None
+        weight_totals_of_squares = None
+        if weights is not None:
+            weight_totals = rounds.count_aborting_rounds(syndromes, weights)
+            weight_totals_of_squares = rounds.count_aborting_rounds(syndromes, weights * weights)
+        if entries is None:
+            entries = [self._entry_with_lookup_table, self._entry_without_lookup_table]
+        for entry in entries:
+            entry.add_discarded_counts(counts, weight_totals, weight_totals_of_squares)
 
     def add(self, gap: float, expected: bool, discarded_due_to_lookup_table: bool,
-            lookup_table_round: SyndromeExtractionRound, gap_round: SyndromeExtractionRound) -> None:
+            lookup_table_round: SyndromeExtractionRound, gap_round: SyndromeExtractionRound,
+            weight: float = 1.0) -> None:
         if discarded_due_to_lookup_table:
-            self._entry_with_lookup_table.add_discarded(lookup_table_round)
+            self._entry_with_lookup_table.add_discarded(lookup_table_round, weight)
+        else:
+            self.add_to_entry(self._entry_with_lookup_table, gap, expected, gap_round, weight)
+        self.add_to_entry(self._entry_without_lookup_table, gap, expected, gap_round, weight)
+
+    def add_to_entry(self, entry: SimulationResultsForGapThreshold.Entry, gap: float, expected: bool,
+                     gap_round: SyndromeExtractionRound, weight: float = 1.0) -> None:
+        '''Adds a decoded sample to `entry`, which is discarded at `gap_round` if `gap` is below the threshold.'''
         if gap < self.gap_threshold:
-            if not discarded_due_to_lookup_table:
-                self._entry_with_lookup_table.add_discarded(gap_round)
-            self._entry_without_lookup_table.add_discarded(gap_round)
+            entry.add_discarded(gap_round, weight)
         elif expected:
-            if not discarded_due_to_lookup_table:
-                self._entry_with_lookup_table.add_valid()
-            self._entry_without_lookup_table.add_valid()
+            entry.add_valid(weight)
         else:
-            if not discarded_due_to_lookup_table:
-                self._entry_with_lookup_table.add_wrong()
-            self._entry_without_lookup_table.add_wrong()
+            entry.add_wrong(weight)
 
     def entry_with_lookup_table(self) -> SimulationResultsForGapThreshold.Entry:
         return self._entry_with_lookup_table
@@ -889,17 +989,114 @@ class SimulationResultsForGapThreshold:
 
     def extend(self, other: SimulationResultsForGapThreshold) -> None:
         assert self.gap_threshold == other.gap_threshold
+        assert self.importance_sampled == other.importance_sampled
+        assert self.without_lookup_table_interval == other.without_lookup_table_interval
         self._entry_with_lookup_table.extend(other._entry_with_lookup_table)
         self._entry_without_lookup_table.extend(other._entry_without_lookup_table)
 
     def __len__(self) -> int:
         a = len(self._entry_with_lookup_table)
         b = len(self._entry_without_lookup_table)
-        assert a == b
+        assert a == b or self.without_lookup_table_interval != 1
         return a
 
 
-SimulationResults = SimulationResultsForDiscardRates | SimulationResultsForGapThreshold
+class ReweightedSimulationResults:
+    '''\
+    The results of a simulation whose shots are sampled once and reweighted to each of `error_probabilities`
+    (see `perform_reweighted_simulation`). `results[i]` holds the importance-sampled results for
+    `error_probabilities[i]`.
+    '''
+    def __init__(self, gap_threshold: float, error_probabilities: list[float]) -> None:
+        self.gap_threshold = gap_threshold
+        self.error_probabilities = error_probabilities
+        self.results = [SimulationResultsForGapThreshold(gap_threshold, True) for _ in error_probabilities]
+
+    def extend(self, other: ReweightedSimulationResults) -> None:
+        assert self.error_probabilities == other.error_probabilities
+        for (results, other_results) in zip(self.results, other.results):
+            results.extend(other_results)
+
+    def __len__(self) -> int:
+        return len(self.results[0]) if len(self.results) > 0 else 0
+
+
+class SimulationResultsForGapThresholds:
+    '''\
+    The results of a simulation evaluated with several gap thresholds at once (see `GapThresholdTarget`).
+    `results[i]` holds the results for `gap_thresholds[i]`.
+    '''
+    def __init__(self, gap_thresholds: list[float], importance_sampled: bool = False) -> None:
+        self.gap_thresholds = gap_thresholds
+        self.importance_sampled = importance_sampled
+        self.results = [SimulationResultsForGapThreshold(t, importance_sampled) for t in gap_thresholds]
+
+    def extend(self, other: SimulationResultsForGapThresholds) -> None:
+        assert self.gap_thresholds == other.gap_thresholds
+        for (results, other_results) in zip(self.results, other.results):
+            results.extend(other_results)
+
+    def __len__(self) -> int:
+        return len(self.results[0]) if len(self.results) > 0 else 0
+
+
+SimulationResults = SimulationResultsForDiscardRates | SimulationResultsForGapThreshold | \
+    ReweightedSimulationResults | SimulationResultsForGapThresholds
+
+
+@dataclass
+class GapThresholdTarget:
+    '''A gap threshold to evaluate the decoded shots with, with the lookup table for it.'''
+    gap_threshold: float
+    lookup_table: NegativeLookupTable | None
+
+
+@dataclass
+class ReweightingTarget:
+    '''\
+    An error probability to reweight the shots to, with the circuit to decode them with, the lookup table for it,
+    and the importance sampler computing the weights.
+    '''
+    error_probability: float
+    partially_noiseless_circuit: Circuit
+    lookup_table: NegativeLookupTable | None
+    importance_sampler: ImportanceSampler
+
+
+def decode_with_complementary_gap(
+        matcher: pymatching.Matching,
+        syndrome: np.ndarray,
+        detector_for_complementary_gap: DetectorIdentifier,
+        with_heuristic_gap_calculation: bool,
+        num_detectors_for_lookup_table: int) -> tuple[np.ndarray, float]:
+    '''\
+    Decodes `syndrome` with and without flipping `detector_for_complementary_gap`, and returns the lighter
+    prediction and the gap scaled by 100. `syndrome` is restored before returning.
+    '''
+    prediction, weight = matcher.decode(syndrome, return_weight=True)
+    min_weight = weight
+    max_weight = weight
+
+    syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+    try:
+        c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
+    except ValueError:
+        c_prediction = None
+        c_weight = math.inf
+    if c_weight < min_weight:
+        prediction = c_prediction
+    min_weight = min(min_weight, c_weight)
+    max_weight = max(max_weight, c_weight)
+
+    syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+
+    assert isinstance(prediction, np.ndarray)
+    gap = max_weight - min_weight
+
+    if with_heuristic_gap_calculation and all(syndrome[:num_detectors_for_lookup_table] == 0):
+        gap += 0.01
+
+    return (prediction, gap * 100)
 
 
 def perform_simulation(
@@ -908,83 +1105,236 @@ def perform_simulation(
         num_shots: int,
         gap_threshold: float | None,
         with_heuristic_gap_calculation: bool,
-        lookup_table: LookupTableWithNegativeSamplesOnly | None,
+        lookup_table: NegativeLookupTable | None,
         num_detectors_for_lookup_table: int,
         detector_for_complementary_gap: DetectorIdentifier,
-        seed: int | None) -> SimulationResults:
+        seed: int | None,
+        gap_bin_width: float = 1,
+        max_gap: float = SimulationResultsForDiscardRates.DEFAULT_MAX_GAP,
+        importance_sampler: ImportanceSampler | None = None,
+        reweighting_targets: list[ReweightingTarget] | None = None,
+        gap_threshold_targets: list[GapThresholdTarget] | None = None,
+        staged_sampling: bool = False,
+        without_lookup_table_interval: int = 1) -> SimulationResults:
+    '''\
+    Simulates `num_shots` shots. With `importance_sampler`, which requires `gap_threshold`, the shots are
+    sampled from its model instead of `primal_circuit`, and weighted by their likelihood ratios. With
+    `reweighting_targets`, see `perform_reweighted_simulation`.
+
+    With `gap_threshold_targets`, which replace `gap_threshold` and `lookup_table`, each shot is decoded once
+    and evaluated with every gap threshold.
+
+    With `staged_sampling`, the shots are sampled with `sample_in_stages`, which stops simulating the shots
+    failing the post-selection early.
+
+    With `without_lookup_table_interval` other than one, which requires `gap_threshold` and `lookup_table`, the
+    lookup table is checked before decoding, and the shots it discards are not decoded. The results without the
+    lookup table are then those of every `without_lookup_table_interval`-th shot, all of which are decoded, or
+    are not computed if it is zero. In the latter case with `staged_sampling`, the shots the lookup table
+    discards are not simulated beyond its detectors, either.
+    '''
+    if reweighting_targets is not None:
+        assert gap_threshold is not None
+        return perform_reweighted_simulation(
+            primal_circuit, reweighting_targets, num_shots, gap_threshold, with_heuristic_gap_calculation,
+            num_detectors_for_lookup_table, detector_for_complementary_gap, seed)
+
     primal_stim_circuit: stim.Circuit = primal_circuit.circuit
     partially_noiseless_stim_circuit: stim.Circuit = partially_noiseless_circuit.circuit
-    detectors_for_post_selection: list[DetectorIdentifier] = primal_circuit.detectors_for_post_selection
+    postselection_ids = primal_circuit.post_selection_ids
+    lookup_table_first = without_lookup_table_interval != 1
+    if lookup_table_first:
+        assert gap_threshold is not None and gap_threshold_targets is None and lookup_table is not None
 
     # We construct a decoder for `partially_noiseless_stim_circuit`, not to confuse the matching decoder with
     # non-matchable detectors. We perform post-selection for all detectors in the Steane code, so the difference
     # between the two DEMs should be small...
-    dem = partially_noiseless_stim_circuit.detector_error_model(decompose_errors=True)
-    matcher = pymatching.Matching.from_detector_error_model(dem)
-
-    # However, we construct a sampler from `primal_stim_circuit` because it is *the real* circuit.
-    sampler = primal_stim_circuit.compile_detector_sampler(seed=seed)
-    detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
+    matcher = cached_matcher(partially_noiseless_stim_circuit)
     rounds = SyndromeExtractionRounds(primal_circuit, '')
     lookup_table_round: SyndromeExtractionRound = \
         rounds.aborting_round_for_detector_index(num_detectors_for_lookup_table - 1)
     last_round = rounds.rounds()[-1]
 
     results: SimulationResults
+    # The results for each gap threshold, with the lookup table to evaluate them with.
+    evaluations: list[tuple[SimulationResultsForGapThreshold, NegativeLookupTable | None]] = []
     if gap_threshold is None:
-        results = SimulationResultsForDiscardRates()
+        results = SimulationResultsForDiscardRates(gap_bin_width, max_gap)
+    elif gap_threshold_targets is not None:
+        results = SimulationResultsForGapThresholds(
+            [target.gap_threshold for target in gap_threshold_targets], importance_sampler is not None)
+        evaluations = [(r, target.lookup_table) for (r, target) in zip(results.results, gap_threshold_targets)]
     else:
-        results = SimulationResultsForGapThreshold(gap_threshold)
-    postselection_ids = np.array([id.id for id in detectors_for_post_selection], dtype='uint')
-
-    for shot in range(num_shots):
-        syndrome = detection_events[shot]
-        if np.any(syndrome[postselection_ids] != 0):
-            if isinstance(results, SimulationResultsForGapThreshold):
-                results.add_discarded(rounds.aborting_round_for_syndrome(syndrome))
-            else:
-                assert isinstance(results, SimulationResultsForDiscardRates)
-                results.add_discarded()
+        results = SimulationResultsForGapThreshold(
+            gap_threshold, importance_sampler is not None, without_lookup_table_interval)
+        evaluations = [(results, lookup_table)]
+
+    # However, we sample `primal_stim_circuit` because it is *the real* circuit. It is sampled chunk by chunk, so
+    # that only one chunk of the samples is in memory. `rejected` marks the shots `sample_in_stages` dropped as the
+    # lookup table discards them.
+    chunks: Iterator[tuple[np.ndarray, np.ndarray, np.ndarray | None, np.ndarray | None]]
+    if importance_sampler is None and staged_sampling:
+        reject = None
+        if lookup_table_first and without_lookup_table_interval == 0:
+            assert lookup_table is not None
+            reject = lookup_table.contains
+        chunks = ((d, o, None, rejected) for (d, o, rejected) in sample_in_stages(
+            primal_stim_circuit, postselection_ids, num_shots, seed, reject=reject,
+            num_detectors_for_reject=num_detectors_for_lookup_table))
+    elif importance_sampler is None:
+        chunks = ((d, o, None, None) for (d, o) in sample_in_chunks(primal_stim_circuit, num_shots, seed))
+    else:
+        assert gap_threshold is not None
+        chunks = ((d, o, w, None) for (d, o, w) in importance_sampler.sample(num_shots, seed))
+    num_sampled_shots = 0
+    for (detection_events, observable_flips, likelihood_ratios, rejected) in chunks:
+        # The shots discarded by the post-selection are counted at once, and the rest are decoded one by one.
+        discarded = np.any(detection_events[:, postselection_ids], axis=1)
+        if lookup_table_first:
+            assert isinstance(results, SimulationResultsForGapThreshold) and lookup_table is not None
+            evaluate_lookup_table_first(
+                results, matcher, rounds, detection_events, observable_flips, likelihood_ratios, discarded, rejected,
+                lookup_table, num_sampled_shots, with_heuristic_gap_calculation, num_detectors_for_lookup_table,
+                detector_for_complementary_gap)
+            num_sampled_shots += len(detection_events)
             continue
+        if isinstance(results, SimulationResultsForDiscardRates):
+            results.add_discarded(int(np.count_nonzero(discarded)))
+        for (results_for_threshold, _) in evaluations:
+            results_for_threshold.add_discarded_syndromes(
+                rounds, detection_events[discarded],
+                None if likelihood_ratios is None else likelihood_ratios[discarded])
+
+        # The gaps and the expectations of the chunk, added to the histogram at once without a gap threshold.
+        gaps: list[float] = []
+        expectations: list[bool] = []
+        for shot in np.flatnonzero(~discarded):
+            syndrome = detection_events[shot]
+            likelihood_ratio = 1.0 if likelihood_ratios is None else float(likelihood_ratios[shot])
+            (prediction, gap) = decode_with_complementary_gap(
+                matcher, syndrome, detector_for_complementary_gap, with_heuristic_gap_calculation,
+                num_detectors_for_lookup_table)
+            expected = np.array_equal(observable_flips[shot], prediction)
+
+            if gap_threshold is None:
+                gaps.append(gap)
+                expectations.append(expected)
+                continue
+            for (results_for_threshold, table) in evaluations:
+                discarded_due_to_lookup_table = \
+                    table is not None and syndrome[:num_detectors_for_lookup_table].tobytes() in table
+                results_for_threshold.add(
+                    gap, expected, discarded_due_to_lookup_table, lookup_table_round, last_round, likelihood_ratio)
+        if isinstance(results, SimulationResultsForDiscardRates):
+            results.add_many(np.array(gaps), np.array(expectations, dtype=np.bool_))
 
-        prediction, weight = matcher.decode(syndrome, return_weight=True)
-        min_weight = weight
-        max_weight = weight
-
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
-        try:
-            c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
-        except ValueError:
-            c_prediction = None
-            c_weight = math.inf
-        if c_weight < min_weight:
-            prediction = c_prediction
-        min_weight = min(min_weight, c_weight)
-        max_weight = max(max_weight, c_weight)
-
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
-
-        actual = observable_flips[shot]
-        assert isinstance(prediction, np.ndarray)
-        expected = np.array_equal(actual, prediction)
-        gap = max_weight - min_weight
-
-        if with_heuristic_gap_calculation and all(syndrome[:num_detectors_for_lookup_table] == 0):
-            gap += 0.01
+    return results
 
-        gap *= 100
 
-        if gap_threshold is None:
-            assert isinstance(results, SimulationResultsForDiscardRates)
-            results.add(gap, expected)
-        else:
-            assert isinstance(results, SimulationResultsForGapThreshold)
-            discarded_due_to_lookup_table = False
-            if lookup_table is not None:
-                bytes = syndrome[:num_detectors_for_lookup_table].tobytes()
-                discarded_due_to_lookup_table = bytes in lookup_table
-            results.add(gap, expected, discarded_due_to_lookup_table, lookup_table_round, last_round)
+def evaluate_lookup_table_first(
+        results: SimulationResultsForGapThreshold,
+        matcher: pymatching.Matching,
+        rounds: SyndromeExtractionRounds,
+        detection_events: np.ndarray,
+        observable_flips: np.ndarray,
+        likelihood_ratios: np.ndarray | None,
+        discarded: np.ndarray,
+        rejected: np.ndarray | None,
+        lookup_table: NegativeLookupTable,
+        first_shot_index: int,
+        with_heuristic_gap_calculation: bool,
+        num_detectors_for_lookup_table: int,
+        detector_for_complementary_gap: DetectorIdentifier) -> None:
+    '''\
+    Adds a chunk of shots to `results`, checking the lookup table before decoding (see `perform_simulation`).
+    `discarded` marks the shots discarded by the post-selection, and `rejected`, if given, those already known
+    to be discarded by the lookup table. `first_shot_index` is the index of the first shot of the chunk, which
+    decides the shots sampled for the entry without the lookup table.
+    '''
+    num_shots = len(detection_events)
+    interval = results.without_lookup_table_interval
+    weights = np.ones(num_shots) if likelihood_ratios is None else likelihood_ratios
+    lookup_table_round = rounds.aborting_round_for_detector_index(num_detectors_for_lookup_table - 1)
+    last_round = rounds.rounds()[-1]
+    with_lookup_table = results.entry_with_lookup_table()
+    without_lookup_table = results.entry_without_lookup_table()
+
+    sampled_without_lookup_table = np.zeros(num_shots, dtype=np.bool_)
+    if interval > 0:
+        sampled_without_lookup_table[(-first_shot_index) % interval::interval] = True
+    in_table = np.zeros(num_shots, dtype=np.bool_) if rejected is None else rejected.copy()
+    to_check = ~discarded & ~in_table
+    in_table[to_check] = lookup_table.contains(detection_events[to_check, :num_detectors_for_lookup_table])
+
+    results.add_discarded_syndromes(
+        rounds, detection_events[discarded], None if likelihood_ratios is None else likelihood_ratios[discarded],
+        [with_lookup_table])
+    with_lookup_table.add_discarded_samples(lookup_table_round, weights[~discarded & in_table])
+    discarded_and_sampled = discarded & sampled_without_lookup_table
+    results.add_discarded_syndromes(
+        rounds, detection_events[discarded_and_sampled],
+        None if likelihood_ratios is None else likelihood_ratios[discarded_and_sampled], [without_lookup_table])
+
+    for shot in np.flatnonzero(~discarded & (~in_table | sampled_without_lookup_table)):
+        (prediction, gap) = decode_with_complementary_gap(
+            matcher, detection_events[shot], detector_for_complementary_gap, with_heuristic_gap_calculation,
+            num_detectors_for_lookup_table)
+        expected = np.array_equal(observable_flips[shot], prediction)
+        weight = float(weights[shot])
+        if not in_table[shot]:
+            results.add_to_entry(with_lookup_table, gap, expected, last_round, weight)
+        if sampled_without_lookup_table[shot]:
+            results.add_to_entry(without_lookup_table, gap, expected, last_round, weight)
+
+
+def perform_reweighted_simulation(
+        primal_circuit: Circuit,
+        targets: list[ReweightingTarget],
+        num_shots: int,
+        gap_threshold: float,
+        with_heuristic_gap_calculation: bool,
+        num_detectors_for_lookup_table: int,
+        detector_for_complementary_gap: DetectorIdentifier,
+        seed: int | None) -> ReweightedSimulationResults:
+    '''\
+    Samples `num_shots` shots once from the model the importance samplers of `targets` share, and evaluates
+    each shot for every target, weighted by its likelihood ratio under the target's error probability. This
+    replaces a run per error probability of a sweep around the sampled one.
+
+    The post-selection doesn't depend on the error probability, so it is done once per shot. The shots passing
+    it are decoded with the decoder of each target, so the gaps are exactly those of a run at that error
+    probability.
+    '''
+    assert len(targets) > 0
+    sampling_dem = targets[0].importance_sampler.sampling_dem
+    postselection_ids = primal_circuit.post_selection_ids
+    matchers = [cached_matcher(target.partially_noiseless_circuit.circuit) for target in targets]
+    rounds = SyndromeExtractionRounds(primal_circuit, '')
+    lookup_table_round: SyndromeExtractionRound = \
+        rounds.aborting_round_for_detector_index(num_detectors_for_lookup_table - 1)
+    last_round = rounds.rounds()[-1]
 
+    results = ReweightedSimulationResults(gap_threshold, [target.error_probability for target in targets])
+    for (detection_events, observable_flips, packed_errors) in sample_errors(sampling_dem, num_shots, seed):
+        # likelihood_ratios[i][shot] is the weight of `shot` for `targets[i]`.
+        likelihood_ratios = [target.importance_sampler.weights(packed_errors) for target in targets]
+        discarded = np.any(detection_events[:, postselection_ids], axis=1)
+        for (target_results, ratios) in zip(results.results, likelihood_ratios):
+            target_results.add_discarded_syndromes(rounds, detection_events[discarded], ratios[discarded])
+        for shot in np.flatnonzero(~discarded):
+            syndrome = detection_events[shot]
+            for (target, matcher, target_results, ratios) in zip(
+                    targets, matchers, results.results, likelihood_ratios):
+                (prediction, gap) = decode_with_complementary_gap(
+                    matcher, syndrome, detector_for_complementary_gap, with_heuristic_gap_calculation,
+                    num_detectors_for_lookup_table)
+                expected = np.array_equal(observable_flips[shot], prediction)
+                discarded_due_to_lookup_table = False
+                if target.lookup_table is not None:
+                    bytes = syndrome[:num_detectors_for_lookup_table].tobytes()
+                    discarded_due_to_lookup_table = bytes in target.lookup_table
+                target_results.add(
+                    gap, expected, discarded_due_to_lookup_table, lookup_table_round, last_round, float(ratios[shot]))
     return results
 
 
@@ -995,13 +1345,24 @@ def perform_parallel_simulation(
         num_shots: int,
         gap_threshold: float | None,
         with_heuristic_gap_calculation: bool,
-        lookup_table: LookupTableWithNegativeSamplesOnly | None,
+        lookup_table: NegativeLookupTable | None,
         num_detectors_for_lookup_table: int,
-        seed: int,
+        seed: np.random.SeedSequence,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> SimulationResults:
-    if num_shots / parallelism < 1000 or parallelism == 1:
+        show_progress: bool,
+        pool: WorkerPool | None = None,
+        checkpointer: Checkpointer | None = None,
+        target_task_duration: float | None = None,
+        gap_bin_width: float = 1,
+        max_gap: float = SimulationResultsForDiscardRates.DEFAULT_MAX_GAP,
+        importance_sampler: ImportanceSampler | None = None,
+        reweighting_targets: list[ReweightingTarget] | None = None,
+        gap_threshold_targets: list[GapThresholdTarget] | None = None,
+        staged_sampling: bool = False,
+        without_lookup_table_interval: int = 1) -> SimulationResults:
+    # See parallel_construct_lookup_table.
+    if checkpointer is None and runs_serially(num_shots, parallelism, target_task_duration):
         return perform_simulation(
                 primal_circuit,
                 partially_noiseless_circuit,
@@ -1011,24 +1372,49 @@ def perform_parallel_simulation(
                 lookup_table,
                 num_detectors_for_lookup_table,
                 detector_for_complementary_gap,
-                seed)
+                spawn_seeds(seed, 1)[0],
+                gap_bin_width,
+                max_gap,
+                importance_sampler,
+                reweighting_targets,
+                gap_threshold_targets,
+                staged_sampling,
+                without_lookup_table_interval)
+
+    # See parallel_construct_lookup_table.
+    phase_seed = seed.spawn(1)[0]
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
+    tasks: list[tuple[int, int]] = []
 
     results: SimulationResults
     if gap_threshold is None:
-        results = SimulationResultsForDiscardRates()
+        results = SimulationResultsForDiscardRates(gap_bin_width, max_gap)
+    elif reweighting_targets is not None:
+        results = ReweightedSimulationResults(
+            gap_threshold, [target.error_probability for target in reweighting_targets])
+    elif gap_threshold_targets is not None:
+        results = SimulationResultsForGapThresholds(
+            [target.gap_threshold for target in gap_threshold_targets], importance_sampler is not None)
     else:
-        results = SimulationResultsForGapThreshold(gap_threshold)
-    progress = 0
-    with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        while remaining_shots > 0:
-            seed_to_pass = (seed + remaining_shots) % (2 ** 64)
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(perform_simulation,
+        results = SimulationResultsForGapThreshold(
+            gap_threshold, importance_sampler is not None, without_lookup_table_interval)
+
+    state = None if checkpointer is None else checkpointer.phase(EVALUATION_PHASE)
+    if state is not None:
+        results = state.payload
+        tasks = state.remaining_tasks
+        sizer.remaining_shots = state.num_unscheduled_shots
+        phase_seed = np.random.SeedSequence(
+            phase_seed.entropy, spawn_key=phase_seed.spawn_key, n_children_spawned=state.num_spawned_seeds)
+    progress = len(results)
+
+    with borrow_executor(pool, parallelism) as executor:
+        task_for_future: dict[concurrent.futures.Future, tuple[int, int]] = {}
+
+        def submit(task: tuple[int, int]) -> None:
+            (num_shots_for_this_task, seed_to_pass) = task
+            future = executor.submit(timed,
+                                     perform_simulation,
                                      primal_circuit,
                                      partially_noiseless_circuit,
                                      num_shots_for_this_task,
@@ -1037,39 +1423,112 @@ def perform_parallel_simulation(
                                      lookup_table,
                                      num_detectors_for_lookup_table,
                                      detector_for_complementary_gap,
-                                     seed_to_pass)
-            futures.append(future)
+                                     seed_to_pass,
+                                     gap_bin_width,
+                                     max_gap,
+                                     importance_sampler,
+                                     reweighting_targets,
+                                     gap_threshold_targets,
+                                     staged_sampling,
+                                     without_lookup_table_interval)
+            task_for_future[future] = task
+
+        for task in tasks:
+            submit(task)
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                while len(task_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    submit((size, spawn_seeds(phase_seed, 1)[0]))
+                if len(task_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        future_results = future.result()
-                        if gap_threshold is None:
-                            assert isinstance(results, SimulationResultsForDiscardRates)
-                            assert isinstance(future_results, SimulationResultsForDiscardRates)
-                            results.extend(future_results)
-                        else:
-                            assert isinstance(results, SimulationResultsForGapThreshold)
-                            assert isinstance(future_results, SimulationResultsForGapThreshold)
-                            results.extend(future_results)
-                        progress += len(future.result())
+                (done, _) = concurrent.futures.wait(
+                    task_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, future_results) = future.result()
+                    if gap_threshold is None:
+                        assert isinstance(results, SimulationResultsForDiscardRates)
+                        assert isinstance(future_results, SimulationResultsForDiscardRates)
+                        results.extend(future_results)
+                    elif reweighting_targets is not None:
+                        assert isinstance(results, ReweightedSimulationResults)
+                        assert isinstance(future_results, ReweightedSimulationResults)
+                        results.extend(future_results)
+                    elif gap_threshold_targets is not None:
+                        assert isinstance(results, SimulationResultsForGapThresholds)
+                        assert isinstance(future_results, SimulationResultsForGapThresholds)
+                        results.extend(future_results)
                     else:
-                        new_futures.append(future)
-                futures = new_futures
+                        assert isinstance(results, SimulationResultsForGapThreshold)
+                        assert isinstance(future_results, SimulationResultsForGapThreshold)
+                        results.extend(future_results)
+                    progress += len(future_results)
+                    (num_shots_for_this_task, _) = task_for_future.pop(future)
+                    sizer.record(num_shots_for_this_task, duration)
+                if checkpointer is not None:
+                    checkpointer.update(EVALUATION_PHASE, PhaseState(
+                        results, list(task_for_future.values()), sizer.remaining_shots, phase_seed.n_children_spawned))
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in task_for_future:
                 future.cancel()
     return results
 
 
+def perform_simulation_with_sinter(
+        primal_circuit: Circuit,
+        partially_noiseless_circuit: Circuit,
+        detector_for_complementary_gap: DetectorIdentifier,
+        max_shots: int,
+        max_errors: int | None,
+        gap_threshold: float,
+        with_heuristic_gap_calculation: bool,
+        lookup_table: NegativeLookupTable | None,
+        num_detectors_for_lookup_table: int,
+        json_metadata: dict,
+        parallelism: int,
+        max_batch_size: int,
+        save_resume_filepath: str | None,
+        show_progress: bool) -> list[sinter.TaskStats]:
+    '''\
+    Runs the simulation with sinter, with and without `lookup_table` (the latter only if `lookup_table` is given).
+    `json_metadata` identifies the configuration in `save_resume_filepath`.
+    '''
+    tasks: list[sinter.Task] = []
+    decoders: dict[str, sinter.Decoder] = {}
+    for table in ([None] if lookup_table is None else [None, lookup_table]):
+        decoder_name = 'complementary-gap' if table is None else 'complementary-gap-with-lookup-table'
+        (task, decoder) = complementary_gap_task(
+            primal_circuit.circuit,
+            partially_noiseless_circuit.circuit,
+            decoder_name,
+            detector_for_complementary_gap.id,
+            gap_threshold,
+            primal_circuit.post_selection_ids,
+            table,
+            num_detectors_for_lookup_table,
+            with_heuristic_gap_calculation,
+            dict(json_metadata, with_lookup_table=table is not None,
+                 lookup_table_size=0 if table is None else len(table)))
+        tasks.append(task)
+        decoders[decoder_name] = decoder
+
+    stats = sinter.collect(
+        num_workers=parallelism,
+        tasks=tasks,
+        custom_decoders=decoders,
+        max_shots=max_shots,
+        max_errors=max_errors,
+        max_batch_size=max_batch_size,
+        save_resume_filepath=save_resume_filepath,
+        print_progress=show_progress)
+    stats.sort(key=lambda s: s.decoder)
+    return stats
+
+
 def print_results_for_gap_threshold_entry(
         result_entry: SimulationResultsForGapThreshold.Entry, label: str, rounds: SyndromeExtractionRounds) -> None:
     num_valid = result_entry.num_valid_samples()
@@ -1089,20 +1548,233 @@ def print_results_for_gap_threshold_entry(
         print('  QUBITROUNDS = inf')
         return
 
+    num_samples_at_the_end = print_costs(num_samples, result_entry.num_discarded_samples_for, rounds)
+    assert num_samples_at_the_end == num_valid + num_wrong
+
+
+def print_costs(
+        num_samples: float,
+        num_discarded_samples_for: Callable[[SyndromeExtractionRound], float],
+        rounds: SyndromeExtractionRounds) -> float:
+    '''\
+    Prints the success rate and the cost of each round and the total cost, and returns the number of samples
+    surviving all the rounds. The numbers may be estimates rather than counts.
+    '''
     num_samples_at_this_round = num_samples
     qubitround_so_far: float = 0
     for round in rounds.rounds():
         num_qubits = rounds.num_qubits_used(round)
 
-        num_discarded_at_this_round = result_entry.num_discarded_samples_for(round)
+        num_discarded_at_this_round = num_discarded_samples_for(round)
         round_success_rate = 1 - num_discarded_at_this_round / num_samples_at_this_round
         qubitround_so_far = (qubitround_so_far + num_qubits) / round_success_rate
 
         num_samples_at_this_round -= num_discarded_at_this_round
         print('  {}: num_qubits = {}, round success rate = {:.3f}, cost = {:.3f} '.format(
             round.label, num_qubits, round_success_rate, qubitround_so_far))
-    assert num_samples_at_this_round == num_valid + num_wrong
     print('  QUBITROUNDS = {:.3f}'.format(qubitround_so_far))
+    return num_samples_at_this_round
+
+
+def print_importance_sampling_results_for_gap_threshold_entry(
+        result_entry: SimulationResultsForGapThreshold.Entry, label: str, rounds: SyndromeExtractionRounds) -> None:
+    '''\
+    Prints the estimates for the real error probability from an importance-sampled entry, with their standard
+    errors. The counts are those of the shots sampled with the inflated error probability.
+    '''
+    num_shots = len(result_entry)
+    (valid, valid_variance) = estimate(result_entry.valid_weights(), num_shots)
+    (wrong, wrong_variance) = estimate(result_entry.wrong_weights(), num_shots)
+    (discarded, discarded_variance) = estimate(result_entry.discarded_weights(), num_shots)
+    (rate, rate_variance) = estimate_ratio(result_entry.wrong_weights(), result_entry.valid_weights(), num_shots)
+
+    print(label)
+    print('  Sampled: VALID = {}, WRONG = {}, DISCARDED = {}'.format(
+        result_entry.num_valid_samples(), result_entry.num_wrong_samples(), result_entry.num_discarded_samples()))
+    print('  P(VALID) = {:.3e} +- {:.1e}, P(WRONG) = {:.3e} +- {:.1e}, P(DISCARDED) = {:.3e} +- {:.1e}'.format(
+        valid, math.sqrt(valid_variance), wrong, math.sqrt(wrong_variance),
+        discarded, math.sqrt(discarded_variance)))
+    print('  WRONG / (VALID + WRONG) = {:.3e} +- {:.1e}'.format(rate, math.sqrt(rate_variance)))
+    all_weights = WeightSums()
+    for weights in [result_entry.valid_weights(), result_entry.wrong_weights(), result_entry.discarded_weights()]:
+        all_weights.extend(weights)
+    # A small effective sample size means a few shots dominate the estimates, which are then unreliable.
+    print('  EFFECTIVE SAMPLE SIZE = {:.1f} (ALL), {:.1f} (WRONG)'.format(
+        effective_sample_size(all_weights), effective_sample_size(result_entry.wrong_weights())))
+    if valid + wrong == 0:
+        print('  QUBITROUNDS = inf')
+        return
+    print('  (VALID + WRONG) / SHOTS = {:.3f}'.format(valid + wrong))
+    print_costs(1.0, lambda round: estimate(result_entry.discarded_weights_for(round), num_shots)[0], rounds)
+
+
+# Options that don't change what a shard computes. `--discard-rates` is applied when printing the merged results,
+# and `--lookup-table-min-samples` when storing the merged lookup table.
+_OPTIONS_NOT_AFFECTING_SHARD_RESULTS = OPTIONS_NOT_AFFECTING_SHARD_RESULTS | {
+    'use_threads', 'discard_rates', 'lookup_table_min_samples', 'evaluate_after_construction', 'checkpoint',
+    'checkpoint_interval', 'resume',
+}
+
+
+# Options that don't change the task schedule or the results.
+_OPTIONS_NOT_AFFECTING_CHECKPOINTS = {
+    'use_threads', 'print_circuit', 'seed', 'checkpoint', 'checkpoint_interval', 'resume', 'show_progress',
+    'results_db', 'no_results_db',
+}
+
+
+def print_results(
+        results: SimulationResults, discard_rates: list[float], rounds: SyndromeExtractionRounds) -> None:
+    if isinstance(results, SimulationResultsForDiscardRates):
+        num_samples = len(results)
+        for (rate, v, w, d, bin_index) in zip(discard_rates, *results.discard(np.array(discard_rates))):
+            print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}, bin_index = {}'.format(
+                rate * 100, v, w, d, bin_index))
+            if v + w == 0:
+                print('WRONG / (VALID + WRONG) = nan')
+            else:
+                print('WRONG / (VALID + WRONG) = {:.3e}'.format(w / (v + w)))
+            print('(VALID + WRONG) / SHOTS = {:.3f}'.format((v + w) / num_samples))
+    elif isinstance(results, ReweightedSimulationResults):
+        for (error_probability, results_for_error_probability) in zip(results.error_probabilities, results.results):
+            print('Error probability = {}'.format(error_probability))
+            print_results(results_for_error_probability, discard_rates, rounds)
+        return
+    elif isinstance(results, SimulationResultsForGapThresholds):
+        for (gap_threshold, results_for_gap_threshold) in zip(results.gap_thresholds, results.results):
+            print('Gap threshold = {}'.format(gap_threshold))
+            print_results(results_for_gap_threshold, discard_rates, rounds)
+        return
+    else:
+        assert isinstance(results, SimulationResultsForGapThreshold)
+        print_entry = print_results_for_gap_threshold_entry
+        if results.importance_sampled:
+            print_entry = print_importance_sampling_results_for_gap_threshold_entry
+        if results.without_lookup_table_interval == 1:
+            print_entry(results.entry_without_lookup_table(), 'Without lookup table:', rounds)
+        elif results.without_lookup_table_interval > 1:
+            print_entry(results.entry_without_lookup_table(), 'Without lookup table (one in {} shots):'.format(
+                results.without_lookup_table_interval), rounds)
+        print_entry(results.entry_with_lookup_table(), 'With lookup table:', rounds)
+    print()
+
+
+def summarize_results(results: SimulationResults) -> dict[str, Any]:
+    '''Returns the counts in `results`, and the sums of the weights if importance-sampled, as a JSON object.'''
+    if isinstance(results, SimulationResultsForDiscardRates):
+        return {
+            'num_shots': len(results),
+            'num_valid_samples': int(np.sum(results.num_valid_samples)),
+            'num_wrong_samples': int(np.sum(results.num_wrong_samples)),
+            'num_discarded_samples': results.num_discarded_samples,
+        }
+    if isinstance(results, ReweightedSimulationResults):
+        return {
+            'num_shots': len(results),
+            'error_probabilities': [
+                dict(summarize_results(r), error_probability=p)
+                for (p, r) in zip(results.error_probabilities, results.results)],
+        }
+    if isinstance(results, SimulationResultsForGapThresholds):
+        return {
+            'num_shots': len(results),
+            'gap_thresholds': [summarize_results(r) for r in results.results],
+        }
+    assert isinstance(results, SimulationResultsForGapThreshold)
+
+    def summarize_entry(entry: SimulationResultsForGapThreshold.Entry) -> dict[str, Any]:
+        summary: dict[str, Any] = {
+            'num_valid_samples': entry.num_valid_samples(),
+            'num_wrong_samples': entry.num_wrong_samples(),
+            'num_discarded_samples': entry.num_discarded_samples(),
+        }
+        if results.importance_sampled:
+            summary['valid_weight'] = entry.valid_weights().total
+            summary['wrong_weight'] = entry.wrong_weights().total
+            summary['discarded_weight'] = entry.discarded_weights().total
+        return summary
+
+    return {
+        'num_shots': len(results),
+        'gap_threshold': results.gap_threshold,
+        'importance_sampled': results.importance_sampled,
+        'without_lookup_table_interval': results.without_lookup_table_interval,
+        'without_lookup_table': summarize_entry(results.entry_without_lookup_table()),
+        'with_lookup_table': summarize_entry(results.entry_with_lookup_table()),
+    }
+
+
+def merge_results(results_list: list[SimulationResults]) -> SimulationResults:
+    '''Merges results of the same kind, e.g., those of the shards of a simulation.'''
+    assert len(results_list) > 0
+    first = results_list[0]
+    results: SimulationResults
+    if isinstance(first, SimulationResultsForDiscardRates):
+        results = SimulationResultsForDiscardRates(first.bin_width, first.max_gap)
+        for r in results_list:
+            assert isinstance(r, SimulationResultsForDiscardRates)
+            results.extend(r)
+    elif isinstance(first, ReweightedSimulationResults):
+        results = ReweightedSimulationResults(first.gap_threshold, first.error_probabilities)
+        for r in results_list:
+            assert isinstance(r, ReweightedSimulationResults)
+            results.extend(r)
+    elif isinstance(first, SimulationResultsForGapThresholds):
+        results = SimulationResultsForGapThresholds(first.gap_thresholds, first.importance_sampled)
+        for r in results_list:
+            assert isinstance(r, SimulationResultsForGapThresholds)
+            results.extend(r)
+    else:
+        assert isinstance(first, SimulationResultsForGapThreshold)
+        results = SimulationResultsForGapThreshold(
+            first.gap_threshold, first.importance_sampled, first.without_lookup_table_interval)
+        for r in results_list:
+            assert isinstance(r, SimulationResultsForGapThreshold)
+            results.extend(r)
+    return results
+
+
+def store_constructed_lookup_table(
+        con: sqlite3.Connection,
+        key: LookupTableKey,
+        table: LookupTable,
+        all_nontrivial_syndromes_have_gap_below_threshold: bool,
+        min_samples: int) -> LookupTableWithNegativeSamplesOnly:
+    if all_nontrivial_syndromes_have_gap_below_threshold:
+        print('All non-trivial syndromes have gap below threshold.')
+        table.set_reject_nontrivial()
+    print('len(table) = {}, num_samples = {}'.format(len(table), table.num_samples()))
+    lookup_table_to_store = table.negative_samples_only(min_samples)
+    print('Storing the lookup table of size {}...'.format(len(lookup_table_to_store)))
+    store_lookup_table(con, key, lookup_table_to_store)
+    return lookup_table_to_store
+
+
+def merge_shards(
+        shard_files: list[ShardFile],
+        lookup_table_key: LookupTableKey,
+        construct_lookup_table: bool,
+        lookup_table_min_samples: int,
+        discard_rates: list[float],
+        rounds: SyndromeExtractionRounds) -> None:
+    if construct_lookup_table:
+        table = LookupTable(gap_threshold=lookup_table_key.gap_threshold)
+        all_nontrivial_syndromes_have_gap_below_threshold = True
+        for shard_file in shard_files:
+            (table_per_shard, all_nontrivial_syndromes_have_gap_below_threshold_per_shard) = shard_file.payload
+            assert isinstance(table_per_shard, LookupTable)
+            table.extend(table_per_shard)
+            all_nontrivial_syndromes_have_gap_below_threshold = \
+                all_nontrivial_syndromes_have_gap_below_threshold and \
+                all_nontrivial_syndromes_have_gap_below_threshold_per_shard
+        with sqlite3.connect('lookup_table.db') as lookup_table_con:
+            ensure_lookup_tables_table(lookup_table_con)
+            store_constructed_lookup_table(
+                lookup_table_con, lookup_table_key, table, all_nontrivial_syndromes_have_gap_below_threshold,
+                lookup_table_min_samples)
+        return
+
+    print_results(merge_results([shard_file.payload for shard_file in shard_files]), discard_rates, rounds)
 
 
 def main() -> None:
@@ -1110,7 +1782,13 @@ def main() -> None:
     parser.add_argument('--num-shots', type=int, default=1000)
     parser.add_argument('--error-probability', type=float, default=0)
     parser.add_argument('--parallelism', type=int, default=1)
+    parser.add_argument('--use-threads', action='store_true',
+                        help='run the workers as threads sharing the decoders, to save memory')
     parser.add_argument('--max-shots-per-task', type=int, default=2 ** 20)
+    parser.add_argument('--max-memory-per-task', type=int, default=1024,
+                        help='in MiB, for the sampled detection events of a task')
+    parser.add_argument('--target-task-duration', type=float, default=None,
+                        help='in seconds; size tasks from the measured cost per shot instead of --max-shots-per-task')
     parser.add_argument('--surface-intermediate-distance', type=int, default=None)
     parser.add_argument('--surface-final-distance', type=int, default=3)
     parser.add_argument('--initial-value', choices=['+', '0', 'S+'], default='+')
@@ -1123,13 +1801,46 @@ def main() -> None:
     parser.add_argument('--num-stabilization-rounds-after-surgery', type=int, default=3)
     parser.add_argument('--num-epilogue-syndrome-extraction-rounds', type=int, default=10)
     parser.add_argument('--discard-rates', type=str)
-    parser.add_argument('--gap-threshold', type=float)
+    parser.add_argument('--gap-threshold', type=str,
+                        help='a comma-separated list evaluates each gap threshold with the same decoded shots')
+    parser.add_argument('--gap-bin-width', type=float, default=1,
+                        help='the resolution of the gap histogram for --discard-rates, in the unit of --gap-threshold')
+    parser.add_argument('--max-gap', type=float, default=SimulationResultsForDiscardRates.DEFAULT_MAX_GAP,
+                        help='gaps beyond this fall in the last bin of the gap histogram')
+    parser.add_argument('--importance-sampling-error-probability', type=float, default=None,
+                        help='sample with this error probability and reweight the shots to --error-probability; '
+                             'used with --gap-threshold')
+    parser.add_argument('--reweight-error-probabilities', type=str, default=None,
+                        help='a comma-separated list of error probabilities to reweight the shots sampled with '
+                             '--importance-sampling-error-probability, or --error-probability, to; '
+                             'used with --gap-threshold')
+    parser.add_argument('--staged-sampling', action='store_true',
+                        help='stop simulating the shots failing the post-selection early')
+    parser.add_argument('--lookup-table-first', action='store_true',
+                        help='check the lookup table before decoding, and decode only the shots it keeps; '
+                             'used with --gap-threshold')
+    parser.add_argument('--without-lookup-table-interval', type=int, default=0,
+                        help='with --lookup-table-first, evaluate every n-th shot without the lookup table as well '
+                             '(n >= 2, or 0 to evaluate no shots without it)')
     parser.add_argument('--print-circuit', action='store_true')
     parser.add_argument('--construct-lookup-table', action='store_true')
     parser.add_argument('--lookup-table-min-samples', type=int, default=100)
+    parser.add_argument('--evaluate-after-construction', action='store_true')
     parser.add_argument('--skip-detector-for-complementary-gap', action='store_true')
+    parser.add_argument('--use-repeat-blocks', action='store_true')
     parser.add_argument('--seed', type=int, default=None)
+    add_shard_arguments(parser)
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--checkpoint-interval', type=float, default=600, help='in seconds')
+    parser.add_argument('--resume', action='store_true', help='resume from --checkpoint if it exists')
+    parser.add_argument('--use-sinter', action='store_true')
+    parser.add_argument('--max-errors', type=int, default=None, help='used with --use-sinter')
+    parser.add_argument('--sinter-save-resume-filepath', type=str, default=None, help='used with --use-sinter')
     parser.add_argument('--show-progress', action='store_true')
+    parser.add_argument('--results-db', type=str, default='results.db',
+                        help='accumulate the results of the runs with the same options here, and run only the '
+                             'shots missing from --num-shots')
+    parser.add_argument('--no-results-db', action='store_true')
 
     args = parser.parse_args()
 
@@ -1150,16 +1861,52 @@ def main() -> None:
         print('Error: Cannot specify both --discard-rates and --gap-threshold.', file=sys.stderr)
         return
 
+    shard: Shard | None
+    try:
+        shard = parse_shard_arguments(args)
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return
+    if shard is not None and args.evaluate_after_construction:
+        print('Error: Cannot specify both --shard and --evaluate-after-construction.', file=sys.stderr)
+        return
+
+    if args.resume and args.checkpoint is None:
+        print('Error: --resume must be used with --checkpoint.', file=sys.stderr)
+        return
+
+    checkpoint_config = {
+        name: value for (name, value) in vars(args).items() if name not in _OPTIONS_NOT_AFFECTING_CHECKPOINTS}
+    checkpointer: Checkpointer | None = None
+    if args.resume and os.path.exists(args.checkpoint):
+        try:
+            checkpointer = Checkpointer.resume(args.checkpoint, checkpoint_config, args.checkpoint_interval)
+        except ValueError as e:
+            print('Error: {}'.format(e), file=sys.stderr)
+            return
+        if args.seed is not None and args.seed != checkpointer.seed:
+            print('Error: {} was saved with seed = {}.'.format(args.checkpoint, checkpointer.seed), file=sys.stderr)
+            return
+
     seed: int
-    if args.seed is None:
+    if checkpointer is not None:
+        seed = checkpointer.seed
+    elif args.seed is None:
         seed = random.randrange(0, 2 ** 32)
     else:
         seed = args.seed
+    if args.checkpoint is not None and checkpointer is None:
+        checkpointer = Checkpointer(args.checkpoint, checkpoint_config, seed, args.checkpoint_interval)
+    # Shards of one simulation share `seed` and the other options.
+    shard_config = make_shard_config(args, _OPTIONS_NOT_AFFECTING_SHARD_RESULTS)
 
     print('  num-shots = {}'.format(args.num_shots))
     print('  error-probability = {}'.format(args.error_probability))
     print('  parallelism = {}'.format(args.parallelism))
+    print('  use-threads = {}'.format(args.use_threads))
     print('  max-shots-per-task = {}'.format(args.max_shots_per_task))
+    print('  max-memory-per-task = {}'.format(args.max_memory_per_task))
+    print('  target-task-duration = {}'.format(args.target_task_duration))
     print('  surface-intermediate-distance = {}'.format(args.surface_intermediate_distance))
     print('  surface-final-distance = {}'.format(args.surface_final_distance))
     print('  initial-value = {}'.format(args.initial_value))
@@ -1172,20 +1919,42 @@ def main() -> None:
     print('  num-epilogue-syndrome-extraction-rounds = {}'.format(args.num_epilogue_syndrome_extraction_rounds))
     print('  discard-rates = {}'.format(args.discard_rates))
     print('  gap-threshold = {}'.format(args.gap_threshold))
+    print('  gap-bin-width = {}'.format(args.gap_bin_width))
+    print('  max-gap = {}'.format(args.max_gap))
+    print('  importance-sampling-error-probability = {}'.format(args.importance_sampling_error_probability))
+    print('  reweight-error-probabilities = {}'.format(args.reweight_error_probabilities))
+    print('  staged-sampling = {}'.format(args.staged_sampling))
+    print('  lookup-table-first = {}'.format(args.lookup_table_first))
+    print('  without-lookup-table-interval = {}'.format(args.without_lookup_table_interval))
     print('  print-circuit = {}'.format(args.print_circuit))
     print('  construct-lookup-table = {}'.format(args.construct_lookup_table))
     print('  lookup-table-min-samples = {}'.format(args.lookup_table_min_samples))
+    print('  evaluate-after-construction = {}'.format(args.evaluate_after_construction))
     print('  skip-detector-for-complementary-gap = {}'.format(args.skip_detector_for_complementary_gap))
+    print('  use-repeat-blocks = {}'.format(args.use_repeat_blocks))
     if args.seed is None:
         print('  seed = None ({})'.format(seed))
     else:
         print('  seed = {}'.format(seed))
+    print('  shard = {}'.format(shard))
+    print('  shard-output = {}'.format(args.shard_output))
+    print('  merge-shards = {}'.format(args.merge_shards))
+    print('  checkpoint = {}'.format(args.checkpoint))
+    print('  checkpoint-interval = {}'.format(args.checkpoint_interval))
+    print('  resume = {}'.format(args.resume))
+    print('  use-sinter = {}'.format(args.use_sinter))
+    print('  max-errors = {}'.format(args.max_errors))
+    print('  sinter-save-resume-filepath = {}'.format(args.sinter_save_resume_filepath))
     print('  show-progress = {}'.format(args.show_progress))
+    print('  results-db = {}'.format(None if args.no_results_db else args.results_db))
 
     num_shots: int = args.num_shots
     error_probability: float = args.error_probability
     parallelism: int = args.parallelism
+    use_threads: bool = args.use_threads
     max_shots_per_task: int = args.max_shots_per_task
+    max_memory_per_task: int = args.max_memory_per_task
+    target_task_duration: float | None = args.target_task_duration
     surface_final_distance: int = args.surface_final_distance
     surface_intermediate_distance: int = args.surface_intermediate_distance or surface_final_distance
     match args.initial_value:
@@ -1207,6 +1976,8 @@ def main() -> None:
         case _:
             assert False
     gap_threshold: float | None
+    # The gap thresholds evaluated together, if more than one is given.
+    gap_thresholds: list[float] | None = None
     discard_rates: list[float]
     if args.gap_threshold is None:
         gap_threshold = None
@@ -1217,21 +1988,51 @@ def main() -> None:
         discard_rates = [float(x) for x in args.discard_rates.split(',')]
         discard_rates.sort()
     else:
-        assert isinstance(args.gap_threshold, float)
+        assert isinstance(args.gap_threshold, str)
         assert args.discard_rates is None
-        gap_threshold = args.gap_threshold
+        if not re.compile(r'^\d+(\.\d+)?(,\d+(\.\d+)?)*$').match(args.gap_threshold):
+            print('Error: --gap-threshold must be a number or a comma-separated list of numbers.', file=sys.stderr)
+            return
+        thresholds = [float(x) for x in args.gap_threshold.split(',')]
+        gap_threshold = thresholds[0]
+        if len(thresholds) > 1:
+            gap_thresholds = thresholds
         discard_rates = []
 
+    gap_bin_width: float = args.gap_bin_width
+    max_gap: float = args.max_gap
+    importance_sampling_error_probability: float | None = args.importance_sampling_error_probability
+    reweight_error_probabilities: list[float] | None = None
+    if args.reweight_error_probabilities is not None:
+        if not re.compile(r'^\d+(\.\d+)?(e-?\d+)?(,\d+(\.\d+)?(e-?\d+)?)*$').match(args.reweight_error_probabilities):
+            print('Error: --reweight-error-probabilities must be a comma-separated list of numbers.', file=sys.stderr)
+            return
+        reweight_error_probabilities = [float(x) for x in args.reweight_error_probabilities.split(',')]
     with_heuristic_post_selection: bool = args.with_heuristic_post_selection
     with_heuristic_gap_calculation: bool = args.with_heuristic_gap_calculation
     full_post_selection: bool = args.full_post_selection
     num_stabilization_rounds_after_surgery: int = args.num_stabilization_rounds_after_surgery
     num_epilogue_syndrome_extraction_rounds: int = args.num_epilogue_syndrome_extraction_rounds
+    staged_sampling: bool = args.staged_sampling
+    lookup_table_first: bool = args.lookup_table_first
+    without_lookup_table_interval: int = args.without_lookup_table_interval
     print_circuit: bool = args.print_circuit
     construct_lookup_table: bool = args.construct_lookup_table
     lookup_table_min_samples: int = args.lookup_table_min_samples
+    evaluate_after_construction: bool = args.evaluate_after_construction
     skip_detector_for_complementary_gap: bool = args.skip_detector_for_complementary_gap
+    use_repeat_blocks: bool = args.use_repeat_blocks
+    shard_output: str | None = args.shard_output
+    merge_shard_paths: list[str] | None = args.merge_shards
+    use_sinter: bool = args.use_sinter
+    max_errors: int | None = args.max_errors
+    sinter_save_resume_filepath: str | None = args.sinter_save_resume_filepath
     show_progress: bool = args.show_progress
+    # The results of the shards, the lookup table construction and sinter are not stored.
+    results_db_path: str | None = args.results_db
+    if args.no_results_db or shard is not None or construct_lookup_table or use_sinter:
+        results_db_path = None
+    seed_sequence = (shard or Shard(0, 1)).seed_sequence(seed)
 
     if not perfect_initialization and initial_value != InitialValue.SPlus:
         print('perfect-initialization=False is supported only for S+ initial value.', file=sys.stderr)
@@ -1240,14 +2041,83 @@ def main() -> None:
     if construct_lookup_table and gap_threshold is None:
         print('Error: --construct-lookup-table must be used with --gap-threshold.', file=sys.stderr)
         return
+    if evaluate_after_construction and not construct_lookup_table:
+        print('Error: --evaluate-after-construction must be used with --construct-lookup-table.', file=sys.stderr)
+        return
+    if use_sinter:
+        if gap_threshold is None:
+            print('Error: --use-sinter must be used with --gap-threshold.', file=sys.stderr)
+            return
+        if construct_lookup_table or shard is not None or merge_shard_paths is not None or checkpointer is not None \
+                or use_threads:
+            print('Error: --use-sinter cannot be used with --construct-lookup-table, --shard, --merge-shards, '
+                  '--checkpoint or --use-threads.', file=sys.stderr)
+            return
+    elif max_errors is not None or sinter_save_resume_filepath is not None:
+        print('Error: --max-errors and --sinter-save-resume-filepath must be used with --use-sinter.', file=sys.stderr)
+        return
+    if max_shots_per_task <= 0 or max_memory_per_task <= 0:
+        print('Error: --max-shots-per-task and --max-memory-per-task must be positive.', file=sys.stderr)
+        return
+    if target_task_duration is not None and target_task_duration <= 0:
+        print('Error: --target-task-duration must be positive.', file=sys.stderr)
+        return
+    if gap_bin_width <= 0 or max_gap <= 0:
+        print('Error: --gap-bin-width and --max-gap must be positive.', file=sys.stderr)
+        return
+    if importance_sampling_error_probability is not None:
+        if gap_threshold is None or construct_lookup_table or use_sinter:
+            print('Error: --importance-sampling-error-probability must be used with --gap-threshold, and cannot be '
+                  'used with --construct-lookup-table or --use-sinter.', file=sys.stderr)
+            return
+        if not 0 < importance_sampling_error_probability < 1:
+            print('Error: --importance-sampling-error-probability must be in (0, 1).', file=sys.stderr)
+            return
+    if staged_sampling and (importance_sampling_error_probability is not None or
+                            reweight_error_probabilities is not None or construct_lookup_table or use_sinter):
+        print('Error: --staged-sampling cannot be used with --importance-sampling-error-probability, '
+              '--reweight-error-probabilities, --construct-lookup-table or --use-sinter.', file=sys.stderr)
+        return
+    if lookup_table_first:
+        if gap_threshold is None or gap_thresholds is not None or reweight_error_probabilities is not None or \
+                use_sinter:
+            print('Error: --lookup-table-first must be used with a single --gap-threshold, and cannot be used with '
+                  '--reweight-error-probabilities or --use-sinter.', file=sys.stderr)
+            return
+        # Evaluating every shot without the lookup table is what runs without --lookup-table-first do.
+        if without_lookup_table_interval < 0 or without_lookup_table_interval == 1:
+            print('Error: --without-lookup-table-interval must be 0 or at least 2. Omit --lookup-table-first to '
+                  'evaluate every shot without the lookup table.', file=sys.stderr)
+            return
+    elif without_lookup_table_interval != 0:
+        print('Error: --without-lookup-table-interval must be used with --lookup-table-first.', file=sys.stderr)
+        return
+    if gap_thresholds is not None and (
+            construct_lookup_table or use_sinter or reweight_error_probabilities is not None):
+        print('Error: Multiple gap thresholds cannot be used with --construct-lookup-table, --use-sinter or '
+              '--reweight-error-probabilities.', file=sys.stderr)
+        return
+    if reweight_error_probabilities is not None:
+        if gap_threshold is None or construct_lookup_table or use_sinter:
+            print('Error: --reweight-error-probabilities must be used with --gap-threshold, and cannot be used with '
+                  '--construct-lookup-table or --use-sinter.', file=sys.stderr)
+            return
+        if (importance_sampling_error_probability or error_probability) == 0:
+            print('Error: --reweight-error-probabilities needs a positive error probability to sample with.',
+                  file=sys.stderr)
+            return
 
     mapping = QubitMapping(30, 40)
-    r = SteanePlusSurfaceCode(
-        mapping, surface_intermediate_distance, surface_final_distance, initial_value,
-        steane_syndrome_extraction_pattern,
-        perfect_initialization, error_probability, with_heuristic_post_selection, full_post_selection,
-        num_stabilization_rounds_after_surgery,
-        num_epilogue_syndrome_extraction_rounds, skip_detector_for_complementary_gap)
+
+    def build(error_probability: float) -> SteanePlusSurfaceCode:
+        return SteanePlusSurfaceCode(
+            mapping, surface_intermediate_distance, surface_final_distance, initial_value,
+            steane_syndrome_extraction_pattern,
+            perfect_initialization, error_probability, with_heuristic_post_selection, full_post_selection,
+            num_stabilization_rounds_after_surgery,
+            num_epilogue_syndrome_extraction_rounds, skip_detector_for_complementary_gap, use_repeat_blocks)
+
+    r = build(error_probability)
     primal_circuit = r.primal_circuit
     partially_noiseless_circuit = r.partially_noiseless_circuit
     stim_circuit = primal_circuit.circuit
@@ -1261,11 +2131,39 @@ def main() -> None:
     # The partially noiseless circuit has a graph-like DEM.
     _ = partially_noiseless_circuit.circuit.detector_error_model(decompose_errors=True)
 
-    if num_shots == 0:
+    if num_shots == 0 and merge_shard_paths is None:
         return
 
     detector_for_complementary_gap = r.detector_for_complementary_gap
     assert detector_for_complementary_gap is not None
+    max_shots_per_task = min(max_shots_per_task, max_shots_for_memory(max_memory_per_task * 2 ** 20, stim_circuit))
+
+    importance_sampler: ImportanceSampler | None = None
+    reweighting_targets: list[ReweightingTarget] | None = None
+    if (importance_sampling_error_probability is not None or reweight_error_probabilities is not None) and \
+            merge_shard_paths is None:
+        # The same circuit with another error probability has the same error mechanisms.
+        sampling_code = r
+        if importance_sampling_error_probability is not None:
+            sampling_code = build(importance_sampling_error_probability)
+            sampling_code.run()
+        sampling_dem = sampling_code.primal_circuit.circuit.detector_error_model()
+        try:
+            if reweight_error_probabilities is None:
+                importance_sampler = ImportanceSampler(stim_circuit.detector_error_model(), sampling_dem)
+            else:
+                reweighting_targets = []
+                for target_error_probability in reweight_error_probabilities:
+                    target_code = build(target_error_probability)
+                    target_code.run()
+                    reweighting_targets.append(ReweightingTarget(
+                        target_error_probability,
+                        target_code.partially_noiseless_circuit,
+                        None,
+                        ImportanceSampler(target_code.primal_circuit.circuit.detector_error_model(), sampling_dem)))
+        except ValueError as e:
+            print('Error: {}'.format(e), file=sys.stderr)
+            return
 
     lookup_table_key = LookupTableKey(
         error_probability=error_probability,
@@ -1281,101 +2179,184 @@ def main() -> None:
         num_epilogue_syndrome_extraction_rounds=num_epilogue_syndrome_extraction_rounds,
         gap_threshold=gap_threshold or 0)
 
-    lookup_table: LookupTableWithNegativeSamplesOnly | None = None
-    with sqlite3.connect('lookup_table.db') as lookup_table_con:
-        ensure_lookup_tables_table(lookup_table_con)
+    if merge_shard_paths is not None:
+        try:
+            shard_files = load_shard_files_to_merge(merge_shard_paths, shard_config)
+        except ValueError as e:
+            print('Error: {}'.format(e), file=sys.stderr)
+            return
+        merge_shards(shard_files, lookup_table_key, construct_lookup_table, lookup_table_min_samples,
+                     discard_rates, SyndromeExtractionRounds(partially_noiseless_circuit, 'Stabilize_2'))
+        return
 
-        if construct_lookup_table:
+    lookup_table: NegativeLookupTable | None = None
+    gap_threshold_targets: list[GapThresholdTarget] | None = None
+    # The pool is shared by the lookup table construction and the evaluation, so that the worker processes
+    # keep their decoders.
+    with WorkerPool(parallelism, use_threads) as pool, tempfile.TemporaryDirectory() as lookup_table_dir:
+        with sqlite3.connect('lookup_table.db') as lookup_table_con:
+            ensure_lookup_tables_table(lookup_table_con)
+
+            if construct_lookup_table:
+                assert gap_threshold is not None
+                print('Constructing the lookup table...')
+                (table, all_nontrivial_syndromes_have_gap_below_threshold) = parallel_construct_lookup_table(
+                    primal_circuit,
+                    partially_noiseless_circuit,
+                    num_shots,
+                    detector_for_complementary_gap,
+                    r.num_detectors_for_lookup_table,
+                    seed_sequence,
+                    gap_threshold,
+                    with_heuristic_gap_calculation,
+                    parallelism,
+                    max_shots_per_task,
+                    show_progress,
+                    pool,
+                    checkpointer,
+                    target_task_duration
+                )
+                if shard is not None:
+                    assert shard_output is not None
+                    save_shard_file(shard_output, ShardFile(
+                        shard_config, seed, shard, num_shots,
+                        (table, all_nontrivial_syndromes_have_gap_below_threshold)))
+                    print('len(table) = {}, num_samples = {}'.format(len(table), table.num_samples()))
+                    print('Saved the partial lookup table to {}.'.format(shard_output))
+                    return
+                lookup_table_to_store = store_constructed_lookup_table(
+                    lookup_table_con, lookup_table_key, table, all_nontrivial_syndromes_have_gap_below_threshold,
+                    lookup_table_min_samples)
+                if not evaluate_after_construction:
+                    return
+                # `seed_sequence` spawns new seeds for the evaluation, so the table is evaluated with fresh samples.
+                lookup_table = lookup_table_to_store
+            elif gap_thresholds is not None:
+                gap_threshold_targets = []
+                for t in gap_thresholds:
+                    table_for_threshold = query_lookup_table(
+                        lookup_table_con, replace(lookup_table_key, gap_threshold=t))
+                    if table_for_threshold is None:
+                        print('No lookup table is found for gap threshold = {}.'.format(t))
+                    else:
+                        print('A lookup table of size {} is found for gap threshold = {}.'.format(
+                            len(table_for_threshold), t))
+                    gap_threshold_targets.append(GapThresholdTarget(t, table_for_threshold))
+            elif gap_threshold is not None:
+                lookup_table = query_lookup_table(lookup_table_con, lookup_table_key)
+                if lookup_table is None:
+                    print('No lookup table is found.')
+                else:
+                    print('A lookup table of size {} is found.'.format(len(lookup_table)))
+            for target in reweighting_targets or []:
+                target.lookup_table = query_lookup_table(
+                    lookup_table_con, replace(lookup_table_key, error_probability=target.error_probability))
+                if target.lookup_table is not None:
+                    print('A lookup table of size {} is found for error probability = {}.'.format(
+                        len(target.lookup_table), target.error_probability))
+
+        if isinstance(lookup_table, LookupTableWithNegativeSamplesOnly):
+            # Let the workers memory-map one copy of the table instead of unpickling their own copies.
+            lookup_table = SortedArrayLookupTable.create(
+                os.path.join(lookup_table_dir, 'lookup_table.npy'), lookup_table, r.num_detectors_for_lookup_table)
+        for (i, target) in enumerate(reweighting_targets or []):
+            if isinstance(target.lookup_table, LookupTableWithNegativeSamplesOnly):
+                target.lookup_table = SortedArrayLookupTable.create(
+                    os.path.join(lookup_table_dir, 'lookup_table_{}.npy'.format(i)), target.lookup_table,
+                    r.num_detectors_for_lookup_table)
+        for (i, gap_threshold_target) in enumerate(gap_threshold_targets or []):
+            if isinstance(gap_threshold_target.lookup_table, LookupTableWithNegativeSamplesOnly):
+                gap_threshold_target.lookup_table = SortedArrayLookupTable.create(
+                    os.path.join(lookup_table_dir, 'lookup_table_for_threshold_{}.npy'.format(i)),
+                    gap_threshold_target.lookup_table, r.num_detectors_for_lookup_table)
+        if lookup_table_first and lookup_table is None:
+            print('Error: --lookup-table-first needs a lookup table.', file=sys.stderr)
+            return
+
+        if use_sinter:
             assert gap_threshold is not None
-            print('Constructing the lookup table...')
-            (table, all_nontrivial_syndromes_have_gap_below_threshold) = parallel_construct_lookup_table(
+            stats = perform_simulation_with_sinter(
                 primal_circuit,
                 partially_noiseless_circuit,
-                num_shots,
                 detector_for_complementary_gap,
-                r.num_detectors_for_lookup_table,
-                seed,
+                num_shots,
+                max_errors,
                 gap_threshold,
                 with_heuristic_gap_calculation,
+                lookup_table,
+                r.num_detectors_for_lookup_table,
+                asdict(lookup_table_key),
                 parallelism,
                 max_shots_per_task,
-                show_progress
-            )
-            if all_nontrivial_syndromes_have_gap_below_threshold:
-                print('All non-trivial syndromes have gap below threshold.')
-                table.set_reject_nontrivial()
-            print('len(table) = {}, num_samples = {}'.format(len(table), table.num_samples()))
-            lookup_table_to_store = table.negative_samples_only(lookup_table_min_samples)
-            print('Storing the lookup table of size {}...'.format(len(lookup_table_to_store)))
-            store_lookup_table(lookup_table_con, lookup_table_key, lookup_table_to_store)
+                sinter_save_resume_filepath,
+                show_progress)
+            for s in stats:
+                assert isinstance(s.json_metadata, dict)
+                title = 'With lookup table:' if s.json_metadata['with_lookup_table'] else 'Without lookup table:'
+                print(title)
+                print('  VALID = {}, WRONG = {}, DISCARDED = {}'.format(
+                    s.shots - s.errors - s.discards, s.errors, s.discards))
+                if s.shots > s.discards:
+                    print('  WRONG / (VALID + WRONG) = {:.3e}'.format(s.errors / (s.shots - s.discards)))
+            print()
             return
 
-        if gap_threshold is not None:
-            lookup_table = query_lookup_table(lookup_table_con, lookup_table_key)
-            if lookup_table is None:
-                print('No lookup table is found.')
-            else:
-                print('A lookup table of size {} is found.'.format(len(lookup_table)))
-
-    results = perform_parallel_simulation(
-        primal_circuit,
-        partially_noiseless_circuit,
-        detector_for_complementary_gap,
-        num_shots,
-        gap_threshold,
-        with_heuristic_gap_calculation,
-        lookup_table,
-        r.num_detectors_for_lookup_table,
-        seed,
-        parallelism,
-        max_shots_per_task,
-        show_progress)
-
-    if gap_threshold is None:
-        assert isinstance(results, SimulationResultsForDiscardRates)
-        num_discarded = results.num_discarded_samples
-        num_samples = len(results)
-        num_valid = sum([b.num_valid_samples for b in results.buckets])
-        num_wrong = sum([b.num_wrong_samples for b in results.buckets])
-        bucket_index = 0
-        for rate in discard_rates:
-            while True:
-                bucket = results.buckets[bucket_index]
-                if num_discarded + bucket.num_valid_samples + bucket.num_wrong_samples >= num_samples * rate:
-                    break
-
-                num_valid -= bucket.num_valid_samples
-                num_wrong -= bucket.num_wrong_samples
-                num_discarded += bucket.num_valid_samples + bucket.num_wrong_samples
-                bucket_index += 1
-
-            v = num_valid
-            w = num_wrong
-            d = num_discarded
-            num_to_be_discarded_additionally = num_samples * rate - num_discarded
-            if num_to_be_discarded_additionally > 0:
-                assert num_to_be_discarded_additionally <= bucket.num_valid_samples + bucket.num_wrong_samples
-                bucket_valid_rate = bucket.num_valid_samples / (bucket.num_valid_samples + bucket.num_wrong_samples)
-                bucket_wrong_rate = 1 - bucket_valid_rate
-                v -= round(num_to_be_discarded_additionally * bucket_valid_rate)
-                w -= round(num_to_be_discarded_additionally * bucket_wrong_rate)
-                assert abs(v + w + d + num_to_be_discarded_additionally - num_samples) < 3
-                d = num_samples - v - w
-
-            print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}, bucket_index = {}'.format(
-                rate * 100, v, w, d, bucket_index))
-            if num_valid + num_wrong == 0:
-                print('WRONG / (VALID + WRONG) = nan')
-            else:
-                print('WRONG / (VALID + WRONG) = {:.3e}'.format(w / (v + w)))
-            print('(VALID + WRONG) / SHOTS = {:.3f}'.format((v + w) / num_samples))
-    else:
-        assert isinstance(results, SimulationResultsForGapThreshold)
-        rounds = SyndromeExtractionRounds(partially_noiseless_circuit, 'Stabilize_2')
+        # The results depend on the lookup tables as well as on the options.
+        results_config = dict(shard_config, lookup_table_sizes=[
+            None if table is None else len(table)
+            for table in [lookup_table] + [target.lookup_table for target in reweighting_targets or []] +
+            [target.lookup_table for target in gap_threshold_targets or []]])
+        stored_results: list[StoredResults] = []
+        if results_db_path is not None:
+            with sqlite3.connect(results_db_path) as results_con:
+                ensure_results_table(results_con)
+                stored_results = query_results(results_con, results_config)
+            num_stored_shots = num_accumulated_shots(stored_results, seed, Shard(0, 1))
+            # This run replaces the results stored with the same seed.
+            stored_results = [r for r in stored_results if r.seed != seed]
+            print('{} shots are accumulated in {}.'.format(num_stored_shots, results_db_path))
+            num_shots = max(0, num_shots - num_stored_shots)
+        if num_shots == 0:
+            assert len(stored_results) > 0
+            print_results(merge_results([r.payload for r in stored_results]), discard_rates,
+                          SyndromeExtractionRounds(partially_noiseless_circuit, 'Stabilize_2'))
+            return
 
-        print_results_for_gap_threshold_entry(results.entry_without_lookup_table(), 'Without lookup table:', rounds)
-        print_results_for_gap_threshold_entry(results.entry_with_lookup_table(), 'With lookup table:', rounds)
-    print()
+        results = perform_parallel_simulation(
+            primal_circuit,
+            partially_noiseless_circuit,
+            detector_for_complementary_gap,
+            num_shots,
+            gap_threshold,
+            with_heuristic_gap_calculation,
+            lookup_table,
+            r.num_detectors_for_lookup_table,
+            seed_sequence,
+            parallelism,
+            max_shots_per_task,
+            show_progress,
+            pool,
+            checkpointer,
+            target_task_duration,
+            gap_bin_width,
+            max_gap,
+            importance_sampler,
+            reweighting_targets,
+            gap_threshold_targets,
+            staged_sampling,
+            without_lookup_table_interval if lookup_table_first else 1)
+
+    if shard is not None:
+        assert shard_output is not None
+        save_shard_file(shard_output, ShardFile(shard_config, seed, shard, num_shots, results))
+        print('Saved the results to {}.'.format(shard_output))
+    if results_db_path is not None:
+        with sqlite3.connect(results_db_path) as results_con:
+            store_results(results_con, results_config, StoredResults(
+                seed, Shard(0, 1), num_shots, summarize_results(results), results))
+        print('Stored the results of {} shots in {}.'.format(num_shots, results_db_path))
+        results = merge_results([r.payload for r in stored_results] + [results])
+    print_results(results, discard_rates, SyndromeExtractionRounds(partially_noiseless_circuit, 'Stabilize_2'))
 
 
 if __name__ == '__main__':
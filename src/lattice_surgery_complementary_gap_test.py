@@ -316,6 +316,48 @@ class SteanePlusSurfaceCodeTest(unittest.TestCase):
         # Assert that the circuit has a graph-like dem.
         _ = stim_circuit.detector_error_model(decompose_errors=True)
 
+    def test_repeat_blocks(self) -> None:
+        mapping = QubitMapping(20, 30)
+        unrolled = SteanePlusSurfaceCode(mapping, 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                         True, 0.001, False, False, 3, 4, False)
+        repeated = SteanePlusSurfaceCode(mapping, 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                         True, 0.001, False, False, 3, 4, False, use_repeat_blocks=True)
+        unrolled.run()
+        repeated.run()
+
+        self.assertIn('REPEAT', str(repeated.primal_circuit.circuit))
+        self.assertEqual(repeated.detector_for_complementary_gap, unrolled.detector_for_complementary_gap)
+        for (c1, c2) in [(unrolled.primal_circuit, repeated.primal_circuit),
+                         (unrolled.partially_noiseless_circuit, repeated.partially_noiseless_circuit)]:
+            self.assertEqual(c1.detectors_for_post_selection, c2.detectors_for_post_selection)
+            self.assertEqual(c1.circuit.num_detectors, c2.circuit.num_detectors)
+            self.assertEqual(c1.circuit.detector_error_model().flattened(),
+                             c2.circuit.detector_error_model().flattened())
+
+        rounds1 = SyndromeExtractionRounds(unrolled.primal_circuit, '')
+        rounds2 = SyndromeExtractionRounds(repeated.primal_circuit, '')
+        self.assertEqual(len(rounds1.rounds()), len(rounds2.rounds()))
+        for (r1, r2) in zip(rounds1.rounds(), rounds2.rounds()):
+            self.assertEqual(rounds1.num_qubits_used(r1), rounds2.num_qubits_used(r2))
+        syndrome = np.zeros(unrolled.primal_circuit.circuit.num_detectors, dtype=bool)
+        syndrome[-2] = True
+        self.assertEqual(rounds1.aborting_round_for_syndrome(syndrome).index,
+                         rounds2.aborting_round_for_syndrome(syndrome).index)
+
+    def test_circuit_variant(self) -> None:
+        c = self._new_instance(3, 3, InitialValue.Plus)
+        noiseless_qubits = [(x, y) for y in range(0, 16) for x in range(0, 20) if (x + y) % 2 == 0]
+        variant = c.add_circuit_variant(noiseless_qubits, 0.002)
+        self.assertEqual(len(c.circuit.circuits), 3)
+
+        c.run()
+        self.assertEqual(variant.error_probability, 0.002)
+        self.assertEqual(variant.circuit.num_detectors, c.primal_circuit.circuit.num_detectors)
+        self.assertEqual(variant.circuit.num_measurements, c.primal_circuit.circuit.num_measurements)
+        self.assertNotEqual(variant.circuit, c.primal_circuit.circuit)
+        # Assert that the circuit has deterministic observables.
+        _ = variant.circuit.detector_error_model()
+
 
 class SyndromeExtractionRoundsTest(unittest.TestCase):
     def _new_circuit(self) -> util.Circuit:
@@ -397,3 +439,226 @@ class SyndromeExtractionRoundsTest(unittest.TestCase):
         self.assertEqual(rounds.aborting_round_for_syndrome(np.array([0, 1, 1, 1])), r2)
         self.assertEqual(rounds.aborting_round_for_syndrome(np.array([0, 0, 1, 1])), r2)
         self.assertEqual(rounds.aborting_round_for_syndrome(np.array([0, 0, 0, 1])), r3)
+
+    def test_count_aborting_rounds(self) -> None:
+        circuit = self._new_circuit()
+
+        rounds = SyndromeExtractionRounds(circuit, 'Round2')
+        syndromes = np.array([[1, 1, 1, 1], [0, 1, 1, 1], [0, 0, 1, 1], [0, 0, 0, 1]], dtype=np.bool_)
+
+        self.assertEqual(rounds.count_aborting_rounds(syndromes).tolist(), [0, 1, 2, 1])
+        self.assertEqual(rounds.count_aborting_rounds(syndromes, np.array([1, 2, 4, 8])).tolist(), [0, 1, 6, 8])
+        self.assertEqual(rounds.count_aborting_rounds(syndromes[:0]).tolist(), [0, 0, 0, 0])
+
+
+class SimulationResultsForDiscardRatesTest(unittest.TestCase):
+    def test_add(self) -> None:
+        results = SimulationResultsForDiscardRates(0.5, 4)
+        self.assertEqual(len(results.num_valid_samples), 8)
+        results.add(0.7, True)
+        results.add_many(np.array([0.2, 0.9, 3.9, 4.0, math.inf]), np.array([True, False, True, False, True]))
+        results.add_discarded()
+        self.assertEqual(list(results.num_valid_samples), [1, 1, 0, 0, 0, 0, 0, 2])
+        self.assertEqual(list(results.num_wrong_samples), [0, 1, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(len(results), 7)
+
+    def test_extend(self) -> None:
+        results1 = SimulationResultsForDiscardRates(1, 4)
+        results1.add_many(np.array([0, 1, 1]), np.array([True, True, False]))
+        results2 = SimulationResultsForDiscardRates(1, 4)
+        results2.add_many(np.array([1, 3]), np.array([True, False]))
+        results2.add_discarded()
+        results1.extend(results2)
+        self.assertEqual(list(results1.num_valid_samples), [1, 2, 0, 0])
+        self.assertEqual(list(results1.num_wrong_samples), [0, 1, 0, 1])
+        self.assertEqual(results1.num_discarded_samples, 1)
+
+    def test_discard(self) -> None:
+        results = SimulationResultsForDiscardRates(1, 4)
+        # 2 discarded samples, then bins with (valid, wrong) = (2, 2), (0, 0), (3, 1), (0, 0).
+        results.num_discarded_samples = 2
+        results.add_many(np.array([0, 0, 0, 0, 2, 2, 2, 2]),
+                         np.array([True, True, False, False, True, True, True, False]))
+        (v, w, d, bin_index) = results.discard(np.array([0, 0.2, 0.4, 0.6, 0.8, 1]))
+        # Valid and wrong samples in the boundary bin are discarded in proportion to their counts.
+        self.assertEqual(v.tolist(), [5, 5, 4, 3, 1, 0])
+        self.assertEqual(w.tolist(), [3, 3, 2, 1, 1, 0])
+        self.assertEqual(d.tolist(), [2, 2, 4, 6, 8, 10])
+        self.assertEqual(bin_index.tolist(), [0, 0, 0, 0, 2, 2])
+
+
+class SimulationResultsForGapThresholdTest(unittest.TestCase):
+    def test_weights(self) -> None:
+        r1 = SyndromeExtractionRound('Round0', 0)
+        r2 = SyndromeExtractionRound('Round1', 1)
+        results = SimulationResultsForGapThreshold(10, importance_sampled=True)
+        results.add_discarded(r1, 0.5)
+        results.add(20, True, True, r1, r2, 2.0)
+        other = SimulationResultsForGapThreshold(10, importance_sampled=True)
+        other.add(20, False, False, r1, r2, 0.25)
+        other.add(5, True, False, r1, r2, 3.0)
+        results.extend(other)
+
+        without_lookup_table = results.entry_without_lookup_table()
+        self.assertEqual(without_lookup_table.valid_weights().total, 2.0)
+        self.assertEqual(without_lookup_table.wrong_weights().total, 0.25)
+        self.assertEqual(without_lookup_table.discarded_weights_for(r1).total, 0.5)
+        self.assertEqual(without_lookup_table.discarded_weights_for(r2).total, 3.0)
+        with_lookup_table = results.entry_with_lookup_table()
+        self.assertEqual(with_lookup_table.valid_weights().total, 0)
+        self.assertEqual(with_lookup_table.discarded_weights_for(r1).total, 2.5)
+        self.assertEqual(with_lookup_table.discarded_weights().total, 5.5)
+        self.assertEqual(with_lookup_table.discarded_weights().total_of_squares, 0.25 + 4 + 9)
+        self.assertEqual(len(results), 4)
+
+    def test_add_discarded_counts(self) -> None:
+        r0 = SyndromeExtractionRound('Round0', 0)
+        r2 = SyndromeExtractionRound('Round2', 2)
+        results = SimulationResultsForGapThreshold(10)
+        results.add_discarded(r2)
+        entry = results.entry_without_lookup_table()
+        entry.add_discarded_counts(np.array([3, 0, 1, 2]))
+        self.assertEqual(entry.num_discarded_samples_for(r0), 3)
+        self.assertEqual(entry.num_discarded_samples_for(r2), 2)
+        self.assertEqual(entry.num_discarded_samples_for(SyndromeExtractionRound('Round3', 3)), 2)
+        self.assertEqual(entry.num_discarded_samples_for(SyndromeExtractionRound('Round9', 9)), 0)
+        self.assertEqual(entry.num_discarded_samples(), 7)
+        self.assertEqual(entry.discarded_weights_for(r2).total, 2)
+
+        weighted = SimulationResultsForGapThreshold(10, importance_sampled=True).entry_without_lookup_table()
+        weighted.add_discarded_counts(np.array([2]), np.array([0.5]), np.array([0.125]))
+        weighted.extend(weighted)
+        self.assertEqual(weighted.num_discarded_samples_for(r0), 4)
+        self.assertEqual(weighted.discarded_weights().total, 1)
+        self.assertEqual(weighted.discarded_weights().total_of_squares, 0.25)
+
+
+class PerformSimulationTest(unittest.TestCase):
+    def test_gap_threshold_targets(self) -> None:
+        c = SteanePlusSurfaceCode(QubitMapping(20, 30), 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                  True, 0.002, False, False, 1, 2, False)
+        c.run()
+        detector_for_complementary_gap = c.detector_for_complementary_gap
+        assert detector_for_complementary_gap is not None
+
+        def simulate(gap_threshold: float, targets: list[GapThresholdTarget] | None) -> SimulationResults:
+            return perform_simulation(
+                c.primal_circuit, c.partially_noiseless_circuit, 300, gap_threshold, False, None,
+                c.num_detectors_for_lookup_table, detector_for_complementary_gap, 1, gap_threshold_targets=targets)
+
+        # The lookup table for the second threshold rejects every shot with a trivial syndrome for the table.
+        table = LookupTableWithNegativeSamplesOnly()
+        table.table[np.zeros(c.num_detectors_for_lookup_table, dtype=np.bool_).tobytes()] = 1
+        results = simulate(100, [GapThresholdTarget(100, None), GapThresholdTarget(300, table)])
+        assert isinstance(results, SimulationResultsForGapThresholds)
+        self.assertEqual(results.gap_thresholds, [100, 300])
+        self.assertEqual(len(results), 300)
+
+        for (gap_threshold, results_for_threshold) in zip(results.gap_thresholds, results.results):
+            expected = simulate(gap_threshold, None)
+            assert isinstance(expected, SimulationResultsForGapThreshold)
+            (entry, expected_entry) = (
+                results_for_threshold.entry_without_lookup_table(), expected.entry_without_lookup_table())
+            self.assertEqual(entry.num_valid_samples(), expected_entry.num_valid_samples())
+            self.assertEqual(entry.num_wrong_samples(), expected_entry.num_wrong_samples())
+            self.assertEqual(entry.num_discarded_samples(), expected_entry.num_discarded_samples())
+        self.assertEqual(results.results[0].entry_with_lookup_table().num_discarded_samples(),
+                         results.results[0].entry_without_lookup_table().num_discarded_samples())
+        self.assertGreater(results.results[1].entry_with_lookup_table().num_discarded_samples(),
+                           results.results[1].entry_without_lookup_table().num_discarded_samples())
+
+    def test_lookup_table_first(self) -> None:
+        c = SteanePlusSurfaceCode(QubitMapping(20, 30), 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                  True, 0.002, False, False, 1, 2, False)
+        c.run()
+        detector_for_complementary_gap = c.detector_for_complementary_gap
+        assert detector_for_complementary_gap is not None
+        rounds = SyndromeExtractionRounds(c.primal_circuit, '')
+        table = LookupTableWithNegativeSamplesOnly()
+        table.table[np.zeros(c.num_detectors_for_lookup_table, dtype=np.bool_).tobytes()] = 1
+
+        def simulate(interval: int, staged_sampling: bool = False) -> SimulationResultsForGapThreshold:
+            results = perform_simulation(
+                c.primal_circuit, c.partially_noiseless_circuit, 300, 300, False, table,
+                c.num_detectors_for_lookup_table, detector_for_complementary_gap, 1, staged_sampling=staged_sampling,
+                without_lookup_table_interval=interval)
+            assert isinstance(results, SimulationResultsForGapThreshold)
+            return results
+
+        def counts(entry: SimulationResultsForGapThreshold.Entry) -> list[int]:
+            return [entry.num_valid_samples(), entry.num_wrong_samples()] + \
+                [entry.num_discarded_samples_for(round) for round in rounds.rounds()]
+
+        expected = simulate(1)
+        self.assertGreater(expected.entry_with_lookup_table().num_discarded_samples(),
+                           expected.entry_without_lookup_table().num_discarded_samples())
+        for interval in [0, 3]:
+            results = simulate(interval)
+            self.assertEqual(len(results), 300)
+            self.assertEqual(counts(results.entry_with_lookup_table()), counts(expected.entry_with_lookup_table()))
+            self.assertEqual(len(results.entry_without_lookup_table()), 0 if interval == 0 else 100)
+
+        results = simulate(0, staged_sampling=True)
+        self.assertEqual(len(results), 300)
+        self.assertEqual(len(results.entry_without_lookup_table()), 0)
+
+    def test_checkpoint_without_parallelism(self) -> None:
+        c = SteanePlusSurfaceCode(QubitMapping(20, 30), 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                  True, 0.002, False, False, 1, 2, False)
+        c.run()
+        detector_for_complementary_gap = c.detector_for_complementary_gap
+        assert detector_for_complementary_gap is not None
+
+        with tempfile.TemporaryDirectory() as dir, WorkerPool(1, use_threads=True) as pool:
+            checkpointer = Checkpointer(os.path.join(dir, 'checkpoint'), {}, 1, 0)
+            results = perform_parallel_simulation(
+                c.primal_circuit, c.partially_noiseless_circuit, detector_for_complementary_gap, 300, 100, False,
+                None, c.num_detectors_for_lookup_table, np.random.SeedSequence(1), 1, 100, False, pool, checkpointer)
+            self.assertEqual(len(results), 300)
+            # A serial run is checkpointed, too.
+            state = Checkpointer.resume(os.path.join(dir, 'checkpoint'), {}, 0).phase(EVALUATION_PHASE)
+            assert state is not None
+            self.assertTrue(state.is_complete())
+            self.assertEqual(len(state.payload), 300)
+
+
+class ReweightedSimulationTest(unittest.TestCase):
+    def _new_instance(self, error_probability: float) -> SteanePlusSurfaceCode:
+        c = SteanePlusSurfaceCode(QubitMapping(20, 30), 3, 3, InitialValue.Plus, SteaneSyndromeExtractionPattern.ZXZ,
+                                  True, error_probability, False, False, 1, 2, False)
+        c.run()
+        return c
+
+    def test_perform_reweighted_simulation(self) -> None:
+        sampling_code = self._new_instance(0.002)
+        sampling_dem = sampling_code.primal_circuit.circuit.detector_error_model()
+        targets: list[ReweightingTarget] = []
+        for error_probability in [0.001, 0.002]:
+            c = self._new_instance(error_probability)
+            targets.append(ReweightingTarget(
+                error_probability, c.partially_noiseless_circuit, None,
+                ImportanceSampler(c.primal_circuit.circuit.detector_error_model(), sampling_dem)))
+        detector_for_complementary_gap = sampling_code.detector_for_complementary_gap
+        assert detector_for_complementary_gap is not None
+
+        results = perform_simulation(
+            sampling_code.primal_circuit, sampling_code.partially_noiseless_circuit, 200, 0, False, None,
+            sampling_code.num_detectors_for_lookup_table, detector_for_complementary_gap, 1,
+            reweighting_targets=targets)
+        other = perform_reweighted_simulation(
+            sampling_code.primal_circuit, targets, 100, 0, False, sampling_code.num_detectors_for_lookup_table,
+            detector_for_complementary_gap, 2)
+        assert isinstance(results, ReweightedSimulationResults)
+        results.extend(other)
+
+        self.assertEqual(results.error_probabilities, [0.001, 0.002])
+        self.assertEqual(len(results), 300)
+        # Every shot passing the post-selection passes the gap threshold 0, for both targets.
+        for target_results in results.results:
+            entry = target_results.entry_without_lookup_table()
+            self.assertEqual(
+                entry.num_discarded_samples(), results.results[0].entry_without_lookup_table().num_discarded_samples())
+        # The shots sampled with the target error probability have weight one.
+        entry = results.results[1].entry_without_lookup_table()
+        self.assertAlmostEqual(entry.valid_weights().total, entry.num_valid_samples())
+        self.assertAlmostEqual(entry.discarded_weights().total, entry.num_discarded_samples())
@@ -389,8 +389,7 @@ def main() -> None:
         # Note that Sinter has a bug regarding `postselection_mask`.
         # See https://github.com/quantumlib/Stim/issues/887. We use Sinter 1.13 to avoid the issue.
         postselection_mask = np.zeros(stim_circuit.num_detectors, dtype='uint8')
-        for id in circuit.detectors_for_post_selection:
-            postselection_mask[id.id] = 1
+        postselection_mask[circuit.post_selection_ids] = 1
         postselection_mask = np.packbits(postselection_mask, bitorder='little')
 
         task = sinter.Task(circuit=stim_circuit, postselection_mask=postselection_mask)
@@ -415,18 +414,14 @@ def main() -> None:
         num_valid = 0
         num_wrong = 0
         num_discarded = 0
+        postselection_ids = circuit.post_selection_ids
 
         for shot in range(num_shots):
             syndrome = detection_events[shot]
             actual = matcher.decode(syndrome)
             prediction = observable_flips[shot]
 
-            discard = False
-            for id in circuit.detectors_for_post_selection:
-                if syndrome[id.id] != 0:
-                    discard = True
-                    break
-            if discard:
+            if np.any(syndrome[postselection_ids] != 0):
                 num_discarded += 1
                 continue
             if np.array_equal(actual, prediction):
@@ -194,3 +194,80 @@ class LookupTableWithNegativeSamplesOnly:
         if self.match_all_nontrivial:
             return any(key)
         return key in self.table
+
+    def contains(self, syndromes: np.ndarray) -> np.ndarray:
+        '''Returns whether each row of `syndromes`, a 2D boolean array, is in the table.'''
+        if self.match_all_nontrivial:
+            return np.any(syndromes, axis=1)
+        return np.array([row.tobytes() in self.table for row in syndromes], dtype=np.bool_)
+
+
+class SortedArrayLookupTable:
+    '''\
+    A read-only LookupTableWithNegativeSamplesOnly stored in an .npy file as a sorted array of bit-packed
+    syndromes.
+
+    Worker processes memory-map the file instead of unpickling their own copies of the table, so all of them
+    probe the same physical pages. Pickling a SortedArrayLookupTable pickles only the path.
+    '''
+    def __init__(self, path: str, num_detectors: int, match_all_nontrivial: bool = False) -> None:
+        self.path = path
+        self.num_detectors = num_detectors
+        self.match_all_nontrivial = match_all_nontrivial
+        self._keys: np.ndarray | None = None
+
+    @staticmethod
+    def create(path: str, table: LookupTableWithNegativeSamplesOnly, num_detectors: int) -> SortedArrayLookupTable:
+        '''Writes `table`, whose keys are syndromes of `num_detectors` detectors, to `path`.'''
+        width = SortedArrayLookupTable._key_width(num_detectors)
+        keys = np.zeros((len(table.table), width), dtype=np.uint8)
+        for (i, key) in enumerate(table.table):
+            assert len(key) == num_detectors
+            keys[i] = np.packbits(np.frombuffer(key, dtype=np.uint8), bitorder='little')
+        keys = np.sort(keys.view('S{}'.format(width)).ravel())
+        with open(path, 'wb') as f:
+            np.save(f, keys)
+        return SortedArrayLookupTable(path, num_detectors, table.match_all_nontrivial)
+
+    @staticmethod
+    def _key_width(num_detectors: int) -> int:
+        return max(1, (num_detectors + 7) // 8)
+
+    @property
+    def keys(self) -> np.ndarray:
+        if self._keys is None:
+            self._keys = np.load(self.path, mmap_mode='r')
+        return self._keys
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_keys'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, bytes):
+            return NotImplemented
+        if self.match_all_nontrivial:
+            return any(key)
+        syndrome = np.frombuffer(key, dtype=np.uint8)
+        return bool(self.contains(syndrome[np.newaxis, :])[0])
+
+    def contains(self, syndromes: np.ndarray) -> np.ndarray:
+        '''Returns whether each row of `syndromes`, a 2D array of `num_detectors` columns, is in the table.'''
+        assert syndromes.shape[1] == self.num_detectors
+        if self.match_all_nontrivial:
+            return np.any(syndromes, axis=1)
+        keys = self.keys
+        queries = np.packbits(syndromes, axis=1, bitorder='little')
+        queries = np.ascontiguousarray(queries).view(keys.dtype).ravel()
+        if len(keys) == 0:
+            return np.zeros(len(queries), dtype=np.bool_)
+        indices = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        return keys[indices] == queries
+
+
+# A lookup table with negative samples only, either in memory or memory-mapped.
+NegativeLookupTable = LookupTableWithNegativeSamplesOnly | SortedArrayLookupTable
@@ -0,0 +1,59 @@
+import numpy as np
+import os
+import pickle
+import tempfile
+import unittest
+
+from lookup_table import *
+
+
+class SortedArrayLookupTableTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'table.npy')
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_contains(self) -> None:
+        rng = np.random.default_rng(1)
+        syndromes = rng.integers(0, 2, size=(200, 13)).astype(np.bool_)
+        # Syndromes differing only in the last (padded) byte.
+        syndromes[1] = syndromes[0]
+        syndromes[1, 12] = not syndromes[0, 12]
+        table = LookupTableWithNegativeSamplesOnly()
+        for syndrome in syndromes[::2]:
+            table.table[syndrome.tobytes()] = 1
+
+        sorted_table = SortedArrayLookupTable.create(self.path, table, 13)
+        self.assertEqual(len(sorted_table), len(table))
+        expected = np.array([syndrome.tobytes() in table for syndrome in syndromes])
+        self.assertTrue(np.array_equal(sorted_table.contains(syndromes), expected))
+        self.assertTrue(np.array_equal(table.contains(syndromes), expected))
+        self.assertEqual([syndrome.tobytes() in sorted_table for syndrome in syndromes], list(expected))
+
+    def test_pickle(self) -> None:
+        table = LookupTableWithNegativeSamplesOnly()
+        syndrome = np.array([1, 0, 1], dtype=np.bool_)
+        table.table[syndrome.tobytes()] = 3
+        sorted_table = SortedArrayLookupTable.create(self.path, table, 3)
+        self.assertIn(syndrome.tobytes(), sorted_table)
+
+        copy = pickle.loads(pickle.dumps(sorted_table))
+        self.assertIn(syndrome.tobytes(), copy)
+        self.assertNotIn(np.array([1, 1, 1], dtype=np.bool_).tobytes(), copy)
+        # The keys are not pickled.
+        self.assertLess(len(pickle.dumps(sorted_table)), 200)
+
+    def test_empty(self) -> None:
+        sorted_table = SortedArrayLookupTable.create(self.path, LookupTableWithNegativeSamplesOnly(), 3)
+        self.assertEqual(len(sorted_table), 0)
+        self.assertNotIn(np.array([1, 0, 1], dtype=np.bool_).tobytes(), sorted_table)
+        self.assertFalse(np.any(sorted_table.contains(np.ones((2, 3), dtype=np.bool_))))
+
+    def test_match_all_nontrivial(self) -> None:
+        sorted_table = SortedArrayLookupTable.create(
+            self.path, LookupTableWithNegativeSamplesOnly(match_all_nontrivial=True), 3)
+        self.assertIn(np.array([0, 0, 1], dtype=np.bool_).tobytes(), sorted_table)
+        self.assertNotIn(np.array([0, 0, 0], dtype=np.bool_).tobytes(), sorted_table)
+        self.assertEqual(list(sorted_table.contains(np.array([[0, 0, 0], [0, 1, 0]], dtype=np.bool_))), [False, True])
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import json
+import pickle
+import sqlite3
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from shard import Shard
+from typing import Any, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclass(frozen=True)
+class StoredResults:
+    '''\
+    The results of the shots sampled from the seeds of `shard` of `seed` (see `Shard.seed_sequence`) for a
+    configuration. `summary` holds the counts in a form other tools can read, and `payload` the results the
+    caller knows how to combine.
+    '''
+    seed: int
+    shard: Shard
+    num_shots: int
+    summary: dict[str, Any]
+    payload: Any
+
+
+def _config_text(config: dict[str, Any]) -> str:
+    return json.dumps(config, sort_keys=True)
+
+
+def ensure_results_table(con: sqlite3.Connection) -> None:
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS results (
+            config TEXT,
+            seed INTEGER,
+            shard_index INTEGER,
+            shard_count INTEGER,
+            num_shots INTEGER,
+            summary TEXT,
+            results_blob BLOB,
+            PRIMARY KEY (config, seed, shard_index, shard_count)
+        )
+    ''')
+    con.commit()
+
+
+def query_results(con: sqlite3.Connection, config: dict[str, Any]) -> list[StoredResults]:
+    '''Returns the results stored for `config`, in the order they were first stored.'''
+    cur = con.cursor()
+    res = cur.execute(
+        'SELECT seed, shard_index, shard_count, num_shots, summary, results_blob FROM results WHERE config = ? '
+        'ORDER BY rowid', (_config_text(config),))
+    stored: list[StoredResults] = []
+    for (seed, shard_index, shard_count, num_shots, summary, results_blob) in res.fetchall():
+        assert isinstance(results_blob, bytes)
+        stored.append(StoredResults(
+            seed, Shard(shard_index, shard_count), num_shots, json.loads(summary), pickle.loads(results_blob)))
+    return stored
+
+
+def store_results(con: sqlite3.Connection, config: dict[str, Any], results: StoredResults) -> None:
+    '''\
+    Stores `results` for `config`. Results stored earlier for the same configuration, seed and shard are
+    replaced, as they are for the same samples.
+    '''
+    cur = con.cursor()
+    cur.execute(
+        'INSERT INTO results (config, seed, shard_index, shard_count, num_shots, summary, results_blob) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (config, seed, shard_index, shard_count) DO UPDATE SET '
+        'num_shots = excluded.num_shots, summary = excluded.summary, results_blob = excluded.results_blob',
+        (
+            _config_text(config),
+            results.seed,
+            results.shard.index,
+            results.shard.count,
+            results.num_shots,
+            json.dumps(results.summary),
+            pickle.dumps(results.payload)
+        )
+    )
+    con.commit()
+
+
+def num_accumulated_shots(stored: list[StoredResults], seed: int, shard: Shard) -> int:
+    '''Returns the number of the shots in `stored` except those for `seed` and `shard`, which a run replaces.'''
+    return sum([r.num_shots for r in stored if (r.seed, r.shard) != (seed, shard)])
+
+
+def top_up_results(
+        path: str | None,
+        config: dict[str, Any],
+        seed: int,
+        num_shots: int,
+        simulate: Callable[[int], T],
+        merge: Callable[[list[T]], T],
+        summarize: Callable[[T], dict[str, Any]]) -> T:
+    '''\
+    Returns the results of `num_shots` shots for `config`, counting the shots accumulated in the results database
+    at `path`. `simulate(n)` runs only the `n` missing shots, and its results are stored under `seed` and merged
+    with the accumulated ones by `merge`. The results stored for `seed` before are for the same samples, so they
+    are replaced rather than counted. Without `path`, all the shots are simulated and nothing is stored.
+    '''
+    if path is None:
+        return simulate(num_shots)
+    with sqlite3.connect(path) as con:
+        ensure_results_table(con)
+        stored = query_results(con, config)
+    num_stored_shots = num_accumulated_shots(stored, seed, Shard(0, 1))
+    stored = [r for r in stored if (r.seed, r.shard) != (seed, Shard(0, 1))]
+    print('{} shots are accumulated in {}.'.format(num_stored_shots, path))
+    num_shots = max(0, num_shots - num_stored_shots)
+    results_list = [r.payload for r in stored]
+    if num_shots > 0 or len(results_list) == 0:
+        results = simulate(num_shots)
+        if num_shots > 0:
+            with sqlite3.connect(path) as con:
+                store_results(con, config, StoredResults(seed, Shard(0, 1), num_shots, summarize(results), results))
+            print('Stored the results of {} shots in {}.'.format(num_shots, path))
+        results_list.append(results)
+    return merge(results_list)
@@ -0,0 +1,75 @@
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from results_db import StoredResults, ensure_results_table, num_accumulated_shots, query_results, store_results
+from results_db import top_up_results
+from shard import Shard
+
+
+class ResultsDbTest(unittest.TestCase):
+    def test_store_and_query(self) -> None:
+        con = sqlite3.connect(':memory:')
+        ensure_results_table(con)
+        config = {'error_probability': 0.001, 'gap_threshold': 3.0}
+        other_config = {'error_probability': 0.002, 'gap_threshold': 3.0}
+
+        self.assertEqual(query_results(con, config), [])
+        store_results(con, config, StoredResults(1, Shard(0, 1), 100, {'num_shots': 100}, [1, 2]))
+        store_results(con, config, StoredResults(2, Shard(0, 1), 50, {'num_shots': 50}, [3]))
+        store_results(con, other_config, StoredResults(1, Shard(0, 1), 10, {'num_shots': 10}, [4]))
+
+        # The key order of the configuration doesn't matter.
+        stored = query_results(con, {'gap_threshold': 3.0, 'error_probability': 0.001})
+        self.assertEqual([(r.seed, r.num_shots, r.summary, r.payload) for r in stored],
+                         [(1, 100, {'num_shots': 100}, [1, 2]), (2, 50, {'num_shots': 50}, [3])])
+        self.assertEqual(num_accumulated_shots(stored, 3, Shard(0, 1)), 150)
+        self.assertEqual(num_accumulated_shots(stored, 1, Shard(0, 1)), 50)
+        self.assertEqual(num_accumulated_shots(stored, 1, Shard(0, 2)), 150)
+
+    def test_upsert(self) -> None:
+        con = sqlite3.connect(':memory:')
+        ensure_results_table(con)
+        config = {'error_probability': 0.001}
+
+        store_results(con, config, StoredResults(1, Shard(0, 1), 100, {}, 'a'))
+        store_results(con, config, StoredResults(1, Shard(0, 1), 200, {}, 'b'))
+        store_results(con, config, StoredResults(1, Shard(1, 2), 300, {}, 'c'))
+
+        stored = query_results(con, config)
+        self.assertEqual([(r.shard, r.num_shots, r.payload) for r in stored],
+                         [(Shard(0, 1), 200, 'b'), (Shard(1, 2), 300, 'c')])
+
+    def test_top_up(self) -> None:
+        simulated: list[int] = []
+
+        def top_up(path: str | None, seed: int, num_shots: int) -> list[int]:
+            def simulate(n: int) -> list[int]:
+                simulated.append(n)
+                return [seed] * n
+            with contextlib.redirect_stdout(io.StringIO()):
+                return top_up_results(path, {'a': 1}, seed, num_shots, simulate,
+                                      lambda results_list: sum(results_list, []), lambda r: {'num_shots': len(r)})
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'results.db')
+            self.assertEqual(top_up(path, 1, 3), [1, 1, 1])
+            # The second run simulates only the missing shots.
+            self.assertEqual(top_up(path, 2, 5), [1, 1, 1, 2, 2])
+            # Nothing is missing.
+            self.assertEqual(top_up(path, 3, 4), [1, 1, 1, 2, 2])
+            # A run with a seed used before replaces its results.
+            self.assertEqual(top_up(path, 2, 6), [1, 1, 1, 2, 2, 2])
+            self.assertEqual(simulated, [3, 2, 3])
+            with sqlite3.connect(path) as con:
+                self.assertEqual([(r.seed, r.num_shots) for r in query_results(con, {'a': 1})], [(1, 3), (2, 3)])
+
+        self.assertEqual(top_up(None, 4, 2), [4, 4])
+        self.assertEqual(simulated, [3, 2, 3, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import numpy as np
+import stim
+
+from collections.abc import Generator
+
+# The number of shots sampled at once by `sample_in_chunks`.
+DEFAULT_CHUNK_SIZE = 16384
+
+
+def sample_in_chunks(
+        circuit: stim.Circuit,
+        num_shots: int,
+        seed: int | None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Generator[tuple[np.ndarray, np.ndarray], None, None]:
+    '''\
+    Samples `num_shots` shots of `circuit` in chunks of at most `chunk_size` shots, and yields
+    (detection_events, observable_flips) for each chunk, as `sample(..., separate_observables=True)` of the
+    detector sampler returns them.
+
+    The chunks are written into a single buffer which is reused, so a chunk is valid only until the caller
+    asks for the next one. The caller may modify a chunk in place.
+
+    The chunks are sampled one after another by one sampler compiled with `seed`. Stim's output depends on
+    how the shots are split, so the samples for a seed depend on `chunk_size`. When `num_shots <= chunk_size`,
+    they are the same as `circuit.compile_detector_sampler(seed=seed).sample(num_shots, separate_observables=True)`.
+    '''
+    assert chunk_size > 0
+    if num_shots == 0:
+        return
+    sampler = circuit.compile_detector_sampler(seed=seed)
+    size = min(chunk_size, num_shots)
+    detection_events = np.empty((size, circuit.num_detectors), dtype=np.bool_)
+    observable_flips = np.empty((size, circuit.num_observables), dtype=np.bool_)
+    for start in range(0, num_shots, size):
+        n = min(size, num_shots - start)
+        sampler.sample(n, separate_observables=True, dets_out=detection_events[:n], obs_out=observable_flips[:n])
+        yield (detection_events[:n], observable_flips[:n])
@@ -0,0 +1,43 @@
+import numpy as np
+import stim
+import unittest
+
+from sampling import *
+
+
+class SampleInChunksTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.circuit = stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3,
+                                              after_clifford_depolarization=0.05)
+
+    def test_single_chunk(self) -> None:
+        (expected_events, expected_flips) = \
+            self.circuit.compile_detector_sampler(seed=1).sample(1000, separate_observables=True)
+        chunks = list(sample_in_chunks(self.circuit, 1000, 1, chunk_size=1000))
+        self.assertEqual(len(chunks), 1)
+        self.assertTrue(np.array_equal(chunks[0][0], expected_events))
+        self.assertTrue(np.array_equal(chunks[0][1], expected_flips))
+
+    def test_chunks(self) -> None:
+        # Sampling chunk by chunk with one sampler gives the same samples.
+        sampler = self.circuit.compile_detector_sampler(seed=2)
+        expected = [sampler.sample(n, separate_observables=True) for n in [300, 300, 300, 100]]
+
+        sizes: list[int] = []
+        for ((events, flips), (expected_events, expected_flips)) in zip(
+                sample_in_chunks(self.circuit, 1000, 2, chunk_size=300), expected, strict=True):
+            sizes.append(len(events))
+            self.assertEqual(events.shape, (len(events), self.circuit.num_detectors))
+            self.assertEqual(flips.shape, (len(events), self.circuit.num_observables))
+            self.assertTrue(np.array_equal(events, expected_events))
+            self.assertTrue(np.array_equal(flips, expected_flips))
+            # The caller may modify the chunk.
+            events[:] = True
+        self.assertEqual(sizes, [300, 300, 300, 100])
+
+    def test_no_shots(self) -> None:
+        self.assertEqual(list(sample_in_chunks(self.circuit, 0, 3)), [])
+
+    def test_buffer_is_reused(self) -> None:
+        chunks = [events for (events, _) in sample_in_chunks(self.circuit, 1000, 4, chunk_size=300)]
+        self.assertTrue(all(np.shares_memory(chunks[0], events) for events in chunks))
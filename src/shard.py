@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import argparse
+import numpy as np
+import pickle
+import re
+
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(frozen=True)
+class Shard:
+    '''\
+    The `index`-th of `count` disjoint parts of a simulation, run independently (e.g., on different nodes)
+    and merged afterwards.
+    '''
+    index: int
+    count: int
+
+    def __post_init__(self) -> None:
+        if self.count <= 0 or not 0 <= self.index < self.count:
+            raise ValueError('Invalid shard {}/{}.'.format(self.index, self.count))
+
+    @staticmethod
+    def parse(text: str) -> Shard:
+        '''Parses "i/N".'''
+        m = re.compile(r'^(\d+)/(\d+)$').match(text)
+        if m is None:
+            raise ValueError('Invalid shard: {}'.format(text))
+        return Shard(int(m.group(1)), int(m.group(2)))
+
+    def seed_sequence(self, seed: int) -> np.random.SeedSequence:
+        '''\
+        Returns the seed sequence for this shard. The sequences for different shards (and for different
+        numbers of shards) are independent children of `seed`, so their samples never overlap.
+        '''
+        return np.random.SeedSequence(seed, spawn_key=(self.count, self.index))
+
+    def __str__(self) -> str:
+        return '{}/{}'.format(self.index, self.count)
+
+
+def spawn_seeds(seed_sequence: np.random.SeedSequence, n: int) -> list[int]:
+    '''\
+    Returns `n` seeds for stim samplers, one per task. Each call spawns new children of `seed_sequence`, so
+    successive calls (e.g., for lookup table construction and evaluation) never reuse seeds.
+    '''
+    return [int(s.generate_state(1, dtype=np.uint64)[0]) for s in seed_sequence.spawn(n)]
+
+
+# Options common to the simulation scripts that don't change what a shard computes, including those added by
+# `add_shard_arguments()`.
+OPTIONS_NOT_AFFECTING_SHARD_RESULTS = {
+    'num_shots', 'parallelism', 'max_shots_per_task', 'max_memory_per_task', 'target_task_duration', 'show_progress',
+    'print_circuit', 'use_repeat_blocks', 'seed', 'shard', 'shard_output', 'merge_shards', 'results_db',
+    'no_results_db',
+}
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser) -> None:
+    '''Adds --shard, --shard-output and --merge-shards. The script must have --seed as well.'''
+    parser.add_argument('--shard', type=str, default=None, help='run only the i-th of N shards, given as "i/N"')
+    parser.add_argument('--shard-output', type=str, default=None)
+    parser.add_argument('--merge-shards', type=str, nargs='+', default=None)
+
+
+def parse_shard_arguments(args: argparse.Namespace) -> Shard | None:
+    '''\
+    Checks the options added by `add_shard_arguments()` and returns the shard to run, if any.
+    Raises ValueError if they are invalid.
+    '''
+    if args.shard is None:
+        if args.shard_output is not None:
+            raise ValueError('--shard-output must be used with --shard.')
+        return None
+    shard = Shard.parse(args.shard)
+    if args.seed is None:
+        raise ValueError('--shard must be used with --seed.')
+    if args.shard_output is None:
+        raise ValueError('--shard must be used with --shard-output.')
+    if args.merge_shards is not None:
+        raise ValueError('Cannot specify both --shard and --merge-shards.')
+    return shard
+
+
+def make_shard_config(args: argparse.Namespace, options_not_affecting_results: set[str]) -> dict[str, Any]:
+    '''\
+    Returns the options which shards of one simulation must share. They are stored with the results and
+    checked when merging.
+    '''
+    return {name: value for (name, value) in vars(args).items() if name not in options_not_affecting_results}
+
+
+@dataclass(frozen=True)
+class ShardFile:
+    '''\
+    What a shard writes to disk. `config` identifies the simulation and must be equal among shards to be
+    merged. `payload` is the partial result, which the caller knows how to combine.
+    '''
+    config: dict[str, Any]
+    seed: int
+    shard: Shard
+    num_shots: int
+    payload: Any
+
+
+def save_shard_file(path: str, shard_file: ShardFile) -> None:
+    with open(path, 'wb') as f:
+        pickle.dump(shard_file, f)
+
+
+def load_shard_files(paths: list[str]) -> list[ShardFile]:
+    '''\
+    Loads shard files and checks that they are disjoint shards of the same simulation.
+    Raises ValueError otherwise.
+    '''
+    shard_files: list[ShardFile] = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            shard_file = pickle.load(f)
+        if not isinstance(shard_file, ShardFile):
+            raise ValueError('{} is not a shard file.'.format(path))
+        shard_files.append(shard_file)
+
+    if len(shard_files) == 0:
+        raise ValueError('No shard files are given.')
+    first = shard_files[0]
+    indices: set[int] = set()
+    for (path, shard_file) in zip(paths, shard_files):
+        if shard_file.config != first.config:
+            raise ValueError('{} has a different configuration from {}.'.format(path, paths[0]))
+        if shard_file.seed != first.seed:
+            raise ValueError('{} has a different seed from {}.'.format(path, paths[0]))
+        if shard_file.shard.count != first.shard.count:
+            raise ValueError('{} has a different number of shards from {}.'.format(path, paths[0]))
+        if shard_file.shard.index in indices:
+            raise ValueError('Shard {} is given more than once.'.format(shard_file.shard))
+        indices.add(shard_file.shard.index)
+    return shard_files
+
+
+def load_shard_files_to_merge(paths: list[str], config: dict[str, Any]) -> list[ShardFile]:
+    '''\
+    Loads shard files as `load_shard_files()` does, checks that they were run with `config`, and reports what
+    is being merged. Raises ValueError if they can't be merged.
+    '''
+    shard_files = load_shard_files(paths)
+    if shard_files[0].config != config:
+        raise ValueError('The shards were run with different options.')
+    num_shards = shard_files[0].shard.count
+    if len(shard_files) < num_shards:
+        missing = sorted(set(range(num_shards)) - {f.shard.index for f in shard_files})
+        print('Warning: shards {} of {} are missing.'.format(missing, num_shards))
+    print('Merging {} shards with {} shots in total...'.format(
+        len(shard_files), sum([f.num_shots for f in shard_files])))
+    return shard_files
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from shard import *
+
+
+class ShardTest(unittest.TestCase):
+    def test_parse(self) -> None:
+        self.assertEqual(Shard.parse('0/1'), Shard(0, 1))
+        self.assertEqual(Shard.parse('3/8'), Shard(3, 8))
+        self.assertEqual(str(Shard(3, 8)), '3/8')
+
+        with self.assertRaises(ValueError):
+            Shard.parse('3')
+        with self.assertRaises(ValueError):
+            Shard.parse('8/8')
+        with self.assertRaises(ValueError):
+            Shard.parse('0/0')
+        with self.assertRaises(ValueError):
+            Shard.parse('-1/2')
+
+    def test_seeds_do_not_overlap(self) -> None:
+        seeds: set[int] = set()
+        for shard in [Shard(0, 1), Shard(0, 2), Shard(1, 2)]:
+            seed_sequence = shard.seed_sequence(10)
+            seeds |= set(spawn_seeds(seed_sequence, 5))
+            # The second call spawns new children.
+            seeds |= set(spawn_seeds(seed_sequence, 5))
+        self.assertEqual(len(seeds), 30)
+
+    def test_seeds_are_reproducible(self) -> None:
+        self.assertEqual(spawn_seeds(Shard(1, 2).seed_sequence(10), 3), spawn_seeds(Shard(1, 2).seed_sequence(10), 3))
+        self.assertNotEqual(spawn_seeds(Shard(1, 2).seed_sequence(10), 3),
+                            spawn_seeds(Shard(1, 2).seed_sequence(11), 3))
+
+
+class ShardArgumentsTest(unittest.TestCase):
+    def parse(self, argv: list[str]) -> argparse.Namespace:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--num-shots', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=None)
+        add_shard_arguments(parser)
+        return parser.parse_args(argv)
+
+    def test_parse(self) -> None:
+        self.assertIsNone(parse_shard_arguments(self.parse([])))
+        self.assertIsNone(parse_shard_arguments(self.parse(['--merge-shards', 'a', 'b'])))
+        self.assertEqual(
+            parse_shard_arguments(self.parse(['--seed', '1', '--shard', '1/2', '--shard-output', 'out'])), Shard(1, 2))
+
+    def test_parse_invalid(self) -> None:
+        for argv in [
+                ['--seed', '1', '--shard', '2/2', '--shard-output', 'out'],
+                ['--shard', '1/2', '--shard-output', 'out'],
+                ['--seed', '1', '--shard', '1/2'],
+                ['--shard-output', 'out'],
+                ['--seed', '1', '--shard', '1/2', '--shard-output', 'out', '--merge-shards', 'a']]:
+            with self.assertRaises(ValueError):
+                parse_shard_arguments(self.parse(argv))
+
+    def test_make_shard_config(self) -> None:
+        args = self.parse(['--seed', '1', '--shard', '1/2', '--shard-output', 'out'])
+        self.assertEqual(make_shard_config(args, OPTIONS_NOT_AFFECTING_SHARD_RESULTS), {})
+        excluded = {'seed', 'shard', 'shard_output', 'merge_shards'}
+        self.assertEqual(make_shard_config(args, excluded), {'num_shots': 1000})
+
+
+class ShardFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def save(self, name: str, shard_file: ShardFile) -> str:
+        path = os.path.join(self.dir.name, name)
+        save_shard_file(path, shard_file)
+        return path
+
+    def test_load(self) -> None:
+        path0 = self.save('0', ShardFile({'a': 1}, 5, Shard(0, 2), 100, [1, 2]))
+        path1 = self.save('1', ShardFile({'a': 1}, 5, Shard(1, 2), 200, [3]))
+
+        shard_files = load_shard_files([path0, path1])
+        self.assertEqual([f.shard for f in shard_files], [Shard(0, 2), Shard(1, 2)])
+        self.assertEqual([f.num_shots for f in shard_files], [100, 200])
+        self.assertEqual([f.payload for f in shard_files], [[1, 2], [3]])
+
+    def test_load_incompatible(self) -> None:
+        path0 = self.save('0', ShardFile({'a': 1}, 5, Shard(0, 2), 100, None))
+        path1 = self.save('1', ShardFile({'a': 2}, 5, Shard(1, 2), 100, None))
+        path2 = self.save('2', ShardFile({'a': 1}, 6, Shard(1, 2), 100, None))
+        path3 = self.save('3', ShardFile({'a': 1}, 5, Shard(1, 3), 100, None))
+
+        with self.assertRaises(ValueError):
+            load_shard_files([])
+        with self.assertRaises(ValueError):
+            load_shard_files([path0, path1])
+        with self.assertRaises(ValueError):
+            load_shard_files([path0, path2])
+        with self.assertRaises(ValueError):
+            load_shard_files([path0, path3])
+        with self.assertRaises(ValueError):
+            load_shard_files([path0, path0])
+
+    def test_load_to_merge(self) -> None:
+        path0 = self.save('0', ShardFile({'a': 1}, 5, Shard(0, 3), 100, None))
+        path2 = self.save('2', ShardFile({'a': 1}, 5, Shard(2, 3), 100, None))
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            shard_files = load_shard_files_to_merge([path0, path2], {'a': 1})
+        self.assertEqual([f.shard for f in shard_files], [Shard(0, 3), Shard(2, 3)])
+        self.assertIn('shards [1] of 3 are missing', output.getvalue())
+        with self.assertRaises(ValueError):
+            load_shard_files_to_merge([path0, path2], {'a': 2})
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import numpy as np
+import stim
+
+from collections.abc import Callable, Generator, Sequence
+from sampling import DEFAULT_CHUNK_SIZE
+
+
+# Noise channels acting on single qubits. Such noise on a qubit that no other instruction touches has no effect.
+_SINGLE_QUBIT_NOISE_GATES = {'DEPOLARIZE1', 'X_ERROR', 'Y_ERROR', 'Z_ERROR', 'PAULI_CHANNEL_1', 'I_ERROR'}
+
+
+def _remapped_target(target: stim.GateTarget, qubit: int) -> stim.GateTarget:
+    if target.is_x_target:
+        return stim.target_x(qubit, invert=target.is_inverted_result_target)
+    if target.is_y_target:
+        return stim.target_y(qubit, invert=target.is_inverted_result_target)
+    if target.is_z_target:
+        return stim.target_z(qubit, invert=target.is_inverted_result_target)
+    if target.is_inverted_result_target:
+        return stim.target_inv(qubit)
+    return stim.GateTarget(qubit)
+
+
+def compact_qubits(circuit: stim.Circuit) -> stim.Circuit:
+    '''\
+    Returns `circuit` flattened, without the single-qubit noise on the qubits no other instruction touches and
+    with the remaining qubits renumbered densely. The detection events and observable flips of the result have
+    the same distribution. Idling noise is placed on all mapped qubits, most of which a small code never uses,
+    so this shrinks the state of the flip simulator a lot.
+    '''
+    def qubits_of(instruction: stim.CircuitInstruction) -> list[int]:
+        return [t.value for t in instruction.targets_copy()
+                if t.is_qubit_target or t.is_x_target or t.is_y_target or t.is_z_target]
+
+    instructions = [i for i in circuit.flattened() if i.name != 'QUBIT_COORDS']
+    used: dict[int, int] = {}
+    for instruction in instructions:
+        if instruction.name not in _SINGLE_QUBIT_NOISE_GATES:
+            for q in qubits_of(instruction):
+                used.setdefault(q, len(used))
+
+    compacted = stim.Circuit()
+    for instruction in instructions:
+        targets: list[stim.GateTarget] = []
+        for target in instruction.targets_copy():
+            if target.is_measurement_record_target or target.is_sweep_bit_target or target.is_combiner:
+                targets.append(target)
+            elif target.value in used:
+                targets.append(_remapped_target(target, used[target.value]))
+        if instruction.name in _SINGLE_QUBIT_NOISE_GATES and len(targets) == 0:
+            continue
+        compacted.append(stim.CircuitInstruction(
+            instruction.name, targets, instruction.gate_args_copy(), tag=instruction.tag))
+    return compacted
+
+
+def split_into_stages(
+        circuit: stim.Circuit,
+        post_selection_ids: np.ndarray,
+        extra_boundaries: Sequence[int] = ()) -> list[stim.Circuit]:
+    '''\
+    Splits `circuit` at layering ticks (TICKs with tags), so that shots can be post-selected between stages.
+    A stage ends at a layering tick if a detector for post-selection precedes the tick and follows the end of
+    the previous stage, or if the tick closes the first `n` detectors for some `n` in `extra_boundaries`.
+    The last stage runs to the end of the circuit.
+    '''
+    boundaries = sorted(set(int(i) + 1 for i in post_selection_ids) | set(extra_boundaries))
+    stages: list[stim.Circuit] = []
+    stage = stim.Circuit()
+    num_detectors = 0
+    for instruction in circuit.flattened():
+        stage.append(instruction)
+        if instruction.name == 'DETECTOR':
+            num_detectors += 1
+        elif instruction.name == 'TICK' and instruction.tag != '' and len(boundaries) > 0 and \
+                boundaries[0] <= num_detectors:
+            stages.append(stage)
+            stage = stim.Circuit()
+            boundaries = [b for b in boundaries if b > num_detectors]
+    stages.append(stage)
+    return stages
+
+
+def sample_in_stages(
+        circuit: stim.Circuit,
+        post_selection_ids: np.ndarray,
+        num_shots: int,
+        seed: int | None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        reject: Callable[[np.ndarray], np.ndarray] | None = None,
+        num_detectors_for_reject: int = 0) -> Generator[tuple[np.ndarray, np.ndarray, np.ndarray], None, None]:
+    '''\
+    Samples `num_shots` shots of `circuit` in chunks of at most `chunk_size` shots like `sample_in_chunks`,
+    but stops simulating a shot once a detector for post-selection fires. The circuit is simulated in stages
+    (see `split_into_stages`) with stim's flip simulator. After each stage, only the shots passing the
+    post-selection so far are carried over to the next stage, so the cost of the rejected shots is that of the
+    stages they went through.
+
+    Yields (detection_events, observable_flips, rejected) for each chunk. The detection events of a shot
+    rejected after a stage are those of the stages it went through, followed by zeros, and its observable
+    flips are meaningless. So the rows failing the post-selection are as good as those of a full simulation
+    for counting the rejected shots per round, and the others are exact.
+
+    With `reject`, the shots whose first `num_detectors_for_reject` detection events `reject` returns True for
+    (given as a 2D array, one row per shot) are dropped, too, once those detectors are simulated. `rejected`
+    marks them; it is all False without `reject`.
+    '''
+    assert chunk_size > 0
+    if reject is not None:
+        assert num_detectors_for_reject > 0
+    circuit = compact_qubits(circuit)
+    stages = split_into_stages(
+        circuit, post_selection_ids, [] if reject is None else [num_detectors_for_reject])
+    num_qubits = circuit.num_qubits
+    num_detectors = circuit.num_detectors
+    num_observables = circuit.num_observables
+    rng = np.random.default_rng(seed)
+
+    def new_simulator(batch_size: int) -> stim.FlipSimulator:
+        # A simulator resuming a stage must start from the carried-over frames, so stabilizer randomization,
+        # which randomizes the initial state, is disabled. It doesn't change detection events or observable
+        # flips, which are deterministic without noise.
+        return stim.FlipSimulator(
+            batch_size=batch_size, num_qubits=num_qubits, disable_stabilizer_randomization=True,
+            seed=int(rng.integers(2 ** 63)))
+
+    for start in range(0, num_shots, chunk_size):
+        n = min(chunk_size, num_shots - start)
+        detection_events = np.zeros((n, num_detectors), dtype=np.bool_)
+        observable_flips = np.zeros((n, num_observables), dtype=np.bool_)
+        rejected = np.zeros(n, dtype=np.bool_)
+
+        def add_observable_flips(simulator: stim.FlipSimulator, shots: np.ndarray) -> None:
+            # The simulator knows only the observables included so far.
+            flips = simulator.get_observable_flips()
+            observable_flips[shots, :len(flips)] ^= flips.T
+
+        simulator = new_simulator(n)
+        # The shots being simulated, and the number of detectors before the stage `simulator` started with.
+        alive = np.arange(n)
+        detector_offset = 0
+        num_simulated_detectors = 0
+        for (i, stage) in enumerate(stages):
+            simulator.do(stage)
+            flips = simulator.get_detector_flips()
+            detection_events[alive, num_simulated_detectors:detector_offset + len(flips)] = \
+                flips[num_simulated_detectors - detector_offset:].T
+            num_simulated_detectors = detector_offset + len(flips)
+            if i == len(stages) - 1:
+                break
+
+            events = detection_events[alive]
+            ids = post_selection_ids[post_selection_ids < num_simulated_detectors]
+            survives = ~np.any(events[:, ids], axis=1)
+            if reject is not None and num_simulated_detectors >= num_detectors_for_reject > \
+                    num_simulated_detectors - len(flips):
+                rejected_now = survives & reject(events[:, :num_detectors_for_reject])
+                rejected[alive[rejected_now]] = True
+                survives &= ~rejected_now
+            if np.all(survives):
+                continue
+
+            add_observable_flips(simulator, alive)
+            alive = alive[survives]
+            if len(alive) == 0:
+                break
+            (xs, zs, measurement_flips, _, _) = simulator.to_numpy(
+                output_xs=True, output_zs=True, output_measure_flips=True)
+            simulator = new_simulator(len(alive))
+            simulator.broadcast_pauli_errors(pauli='X', mask=xs[:, survives])
+            simulator.broadcast_pauli_errors(pauli='Z', mask=zs[:, survives])
+            # The detectors of the following stages refer back to the measurements of the previous ones.
+            simulator.append_measurement_flips(measurement_flips[:, survives])
+            detector_offset = num_simulated_detectors
+        if len(alive) > 0:
+            add_observable_flips(simulator, alive)
+        yield (detection_events, observable_flips, rejected)
@@ -0,0 +1,97 @@
+import numpy as np
+import stim
+import unittest
+
+from staged_sampling import compact_qubits, sample_in_stages, split_into_stages
+
+
+# Qubit 2 flips with probability 1/2, and the first detector, for post-selection, tells whether it flipped.
+# The later detectors refer back to the first stage: D1 and the observable are the flip of qubit 5, and D2 is
+# always zero as qubit 5 keeps its flip.
+_CIRCUIT = stim.Circuit('''
+    R 2 5
+    X_ERROR(0.5) 2 5
+    DEPOLARIZE1(0.1) 7
+    M 2
+    DETECTOR rec[-1]
+    TICK['Round0']
+    M 5
+    DETECTOR rec[-1]
+    TICK['Round1']
+    M 5
+    DETECTOR rec[-1] rec[-2]
+    OBSERVABLE_INCLUDE(0) rec[-2]
+''')
+
+
+class CompactQubitsTest(unittest.TestCase):
+    def test_compact_qubits(self) -> None:
+        compacted = compact_qubits(_CIRCUIT)
+        self.assertEqual(compacted.num_qubits, 2)
+        self.assertNotIn('DEPOLARIZE1', str(compacted))
+        self.assertEqual(compacted.detector_error_model(), _CIRCUIT.detector_error_model())
+
+    def test_pauli_targets(self) -> None:
+        circuit = stim.Circuit('''
+            RX 3
+            R 8
+            DEPOLARIZE1(0.01) 3 4 8
+            MPP X3*Z8 !Z8
+            DETECTOR rec[-2]
+            DETECTOR rec[-1]
+        ''')
+        compacted = compact_qubits(circuit)
+        self.assertEqual(compacted.num_qubits, 2)
+        self.assertEqual(compacted.detector_error_model(), circuit.detector_error_model())
+
+
+class SplitIntoStagesTest(unittest.TestCase):
+    def test_split(self) -> None:
+        stages = split_into_stages(_CIRCUIT, np.array([0]))
+        self.assertEqual([s.num_detectors for s in stages], [1, 2])
+        stages = split_into_stages(_CIRCUIT, np.array([0]), [2])
+        self.assertEqual([s.num_detectors for s in stages], [1, 1, 1])
+        stages = split_into_stages(_CIRCUIT, np.array([], dtype=np.int64))
+        self.assertEqual([s.num_detectors for s in stages], [3])
+
+
+class SampleInStagesTest(unittest.TestCase):
+    def test_sample(self) -> None:
+        num_shots = 0
+        num_rejected = 0
+        for (detection_events, observable_flips, rejected) in sample_in_stages(
+                _CIRCUIT, np.array([0]), 1000, seed=1, chunk_size=300):
+            self.assertEqual(detection_events.shape[1], 3)
+            self.assertFalse(np.any(rejected))
+            num_shots += len(detection_events)
+            discarded = detection_events[:, 0]
+            num_rejected += int(np.count_nonzero(discarded))
+            # The rest of the rejected shots is not simulated.
+            self.assertFalse(np.any(detection_events[discarded, 1:]))
+            kept = ~discarded
+            np.testing.assert_array_equal(detection_events[kept, 1], observable_flips[kept, 0])
+            self.assertFalse(np.any(detection_events[kept, 2]))
+            self.assertTrue(np.any(detection_events[kept, 1]))
+        self.assertEqual(num_shots, 1000)
+        self.assertTrue(300 < num_rejected < 700)
+
+    def test_reject(self) -> None:
+        def reject(events: np.ndarray) -> np.ndarray:
+            self.assertEqual(events.shape[1], 2)
+            return events[:, 1]
+
+        for (detection_events, observable_flips, rejected) in sample_in_stages(
+                _CIRCUIT, np.array([0]), 1000, seed=1, reject=reject, num_detectors_for_reject=2):
+            discarded = detection_events[:, 0]
+            np.testing.assert_array_equal(rejected, ~discarded & detection_events[:, 1])
+            self.assertFalse(np.any(detection_events[rejected, 2]))
+            self.assertFalse(np.any(observable_flips[~discarded & ~rejected]))
+
+    def test_reproducible(self) -> None:
+        [(a, _, _)] = list(sample_in_stages(_CIRCUIT, np.array([0]), 100, seed=3))
+        [(b, _, _)] = list(sample_in_stages(_CIRCUIT, np.array([0]), 100, seed=3))
+        np.testing.assert_array_equal(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
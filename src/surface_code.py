@@ -1,9 +1,10 @@
 from __future__ import annotations
 
 import enum
+import numpy as np
 
 from enum import auto
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
 from util import Circuit, MeasurementIdentifier, MultiplexingCircuit
 
 
@@ -20,6 +21,34 @@ class SurfaceStabilizerPattern(enum.Enum):
     TWO_WEIGHT_RIGHT = auto(),
 
 
+# A step of a syndrome measurement: resetting the ancilla, measuring the ancilla, interacting with the data
+# qubit at the given offset from the ancilla, or idling (None).
+RESET: str = 'RESET'
+MEASURE: str = 'MEASURE'
+SurfaceSyndromeMeasurementStep = str | tuple[int, int] | None
+
+_LEFT_TOP = (-1, -1)
+_LEFT_BOTTOM = (-1, 1)
+_RIGHT_TOP = (1, -1)
+_RIGHT_BOTTOM = (1, 1)
+
+SURFACE_Z_SCHEDULES: dict[SurfaceStabilizerPattern, list[SurfaceSyndromeMeasurementStep]] = {
+    SurfaceStabilizerPattern.FOUR_WEIGHT: [RESET, _LEFT_TOP, _LEFT_BOTTOM, _RIGHT_TOP, _RIGHT_BOTTOM, MEASURE],
+    SurfaceStabilizerPattern.TWO_WEIGHT_UP: [RESET, _LEFT_TOP, None, _RIGHT_TOP, MEASURE, None],
+    SurfaceStabilizerPattern.TWO_WEIGHT_DOWN: [None, RESET, _LEFT_BOTTOM, None, _RIGHT_BOTTOM, MEASURE],
+    SurfaceStabilizerPattern.TWO_WEIGHT_LEFT: [RESET, _LEFT_TOP, _LEFT_BOTTOM, MEASURE, None, None],
+    SurfaceStabilizerPattern.TWO_WEIGHT_RIGHT: [None, None, RESET, _RIGHT_TOP, _RIGHT_BOTTOM, MEASURE],
+}
+
+SURFACE_X_SCHEDULES: dict[SurfaceStabilizerPattern, list[SurfaceSyndromeMeasurementStep]] = {
+    SurfaceStabilizerPattern.FOUR_WEIGHT: [RESET, _LEFT_TOP, _RIGHT_TOP, _LEFT_BOTTOM, _RIGHT_BOTTOM, MEASURE],
+    SurfaceStabilizerPattern.TWO_WEIGHT_UP: [RESET, _LEFT_TOP, _RIGHT_TOP, MEASURE, None, None],
+    SurfaceStabilizerPattern.TWO_WEIGHT_DOWN: [None, None, RESET, _LEFT_BOTTOM, _RIGHT_BOTTOM, MEASURE],
+    SurfaceStabilizerPattern.TWO_WEIGHT_LEFT: [RESET, _LEFT_TOP, None, _LEFT_BOTTOM, MEASURE, None],
+    SurfaceStabilizerPattern.TWO_WEIGHT_RIGHT: [None, RESET, _RIGHT_TOP, None, _RIGHT_BOTTOM, MEASURE],
+}
+
+
 class SurfaceZSyndromeMeasurement:
     '''\
     A Z syndrome measurement for the surface code.
@@ -41,59 +70,8 @@ class SurfaceZSyndromeMeasurement:
         self.already_satisfied = already_satisfied
         self.detector_tag = SURFACE_Z_TAG
 
-        (x, y) = ancilla_position
-        left_top = (x - 1, y - 1)
-        left_bottom = (x - 1, y + 1)
-        right_top = (x + 1, y - 1)
-        right_bottom = (x + 1, y + 1)
-
-        self.actions: list[Callable[[], None]]
-        match pattern:
-            case SurfaceStabilizerPattern.FOUR_WEIGHT:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: self._cx(left_bottom),
-                    lambda: self._cx(right_top),
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_UP:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: None,
-                    lambda: self._cx(right_top),
-                    self._measure,
-                    lambda: None,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_DOWN:
-                self.actions = [
-                    lambda: None,
-                    self._reset,
-                    lambda: self._cx(left_bottom),
-                    lambda: None,
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_LEFT:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: self._cx(left_bottom),
-                    self._measure,
-                    lambda: None,
-                    lambda: None,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_RIGHT:
-                self.actions = [
-                    lambda: None,
-                    lambda: None,
-                    self._reset,
-                    lambda: self._cx(right_top),
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
+        self.schedule = SURFACE_Z_SCHEDULES[pattern]
+        self.actions: list[Callable[[], None]] = [self._action(step) for step in self.schedule]
         assert len(self.actions) == 6
 
     @property
@@ -117,6 +95,19 @@ class SurfaceZSyndromeMeasurement:
         self.actions[self.stage]()
         self.stage = (self.stage + 1) % 6
 
+    def _action(self, step: SurfaceSyndromeMeasurementStep) -> Callable[[], None]:
+        match step:
+            case None:
+                return lambda: None
+            case 'RESET':
+                return self._reset
+            case 'MEASURE':
+                return self._measure
+            case (dx, dy):
+                (x, y) = self._ancilla_position
+                return lambda: self._cx((x + dx, y + dy))
+        raise ValueError(f'Invalid step {step}.')
+
     def _reset(self) -> None:
         self.circuit.place_reset_z(self._ancilla_position)
 
@@ -124,14 +115,17 @@ class SurfaceZSyndromeMeasurement:
         self.circuit.place_cx(position, self._ancilla_position)
 
     def _measure(self) -> None:
+        ms = self._on_measured(self.circuit.place_measurement_z(self._ancilla_position))
+        if ms is not None:
+            self.circuit.place_detector(ms, post_selection=self.post_selection, tag=self.detector_tag)
+
+    def _on_measured(self, i: MeasurementIdentifier) -> list[MeasurementIdentifier] | None:
+        '''Records the measurement `i`, and returns the measurements for the detector to place, if any.'''
         last = self.last_measurement
-        i = self.circuit.place_measurement_z(self._ancilla_position)
-        if last is None:
-            if self.already_satisfied:
-                self.circuit.place_detector([i], post_selection=self.post_selection, tag=self.detector_tag)
-        else:
-            self.circuit.place_detector([last, i], post_selection=self.post_selection, tag=self.detector_tag)
         self.last_measurement = i
+        if last is None:
+            return [i] if self.already_satisfied else None
+        return [last, i]
 
 
 # An X syndrome measurement for the surface code. Unlike syndrome measurements for the Steane code,
@@ -156,59 +150,8 @@ class SurfaceXSyndromeMeasurement:
         self.already_satisfied = already_satisfied
         self.detector_tag: str = SURFACE_X_TAG
 
-        (x, y) = ancilla_position
-        left_top = (x - 1, y - 1)
-        left_bottom = (x - 1, y + 1)
-        right_top = (x + 1, y - 1)
-        right_bottom = (x + 1, y + 1)
-
-        self.actions: list[Callable[[], None]]
-        match pattern:
-            case SurfaceStabilizerPattern.FOUR_WEIGHT:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: self._cx(right_top),
-                    lambda: self._cx(left_bottom),
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_UP:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: self._cx(right_top),
-                    self._measure,
-                    lambda: None,
-                    lambda: None,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_DOWN:
-                self.actions = [
-                    lambda: None,
-                    lambda: None,
-                    self._reset,
-                    lambda: self._cx(left_bottom),
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_LEFT:
-                self.actions = [
-                    self._reset,
-                    lambda: self._cx(left_top),
-                    lambda: None,
-                    lambda: self._cx(left_bottom),
-                    self._measure,
-                    lambda: None,
-                ]
-            case SurfaceStabilizerPattern.TWO_WEIGHT_RIGHT:
-                self.actions = [
-                    lambda: None,
-                    self._reset,
-                    lambda: self._cx(right_top),
-                    lambda: None,
-                    lambda: self._cx(right_bottom),
-                    self._measure,
-                ]
+        self.schedule = SURFACE_X_SCHEDULES[pattern]
+        self.actions: list[Callable[[], None]] = [self._action(step) for step in self.schedule]
         assert len(self.actions) == 6
 
     @property
@@ -232,6 +175,19 @@ class SurfaceXSyndromeMeasurement:
         self.actions[self.stage]()
         self.stage = (self.stage + 1) % 6
 
+    def _action(self, step: SurfaceSyndromeMeasurementStep) -> Callable[[], None]:
+        match step:
+            case None:
+                return lambda: None
+            case 'RESET':
+                return self._reset
+            case 'MEASURE':
+                return self._measure
+            case (dx, dy):
+                (x, y) = self._ancilla_position
+                return lambda: self._cx((x + dx, y + dy))
+        raise ValueError(f'Invalid step {step}.')
+
     def _reset(self) -> None:
         self.circuit.place_reset_x(self._ancilla_position)
 
@@ -239,14 +195,99 @@ class SurfaceXSyndromeMeasurement:
         self.circuit.place_cx(self._ancilla_position, position)
 
     def _measure(self) -> None:
+        ms = self._on_measured(self.circuit.place_measurement_x(self._ancilla_position))
+        if ms is not None:
+            self.circuit.place_detector(ms, post_selection=self.post_selection, tag=self.detector_tag)
+
+    def _on_measured(self, i: MeasurementIdentifier) -> list[MeasurementIdentifier] | None:
+        '''Records the measurement `i`, and returns the measurements for the detector to place, if any.'''
         last = self.last_measurement
-        i = self.circuit.place_measurement_x(self._ancilla_position)
-        if last is None:
-            if self.already_satisfied:
-                self.circuit.place_detector([i], post_selection=self.post_selection, tag=self.detector_tag)
-        else:
-            self.circuit.place_detector([last, i], post_selection=self.post_selection, tag=self.detector_tag)
         self.last_measurement = i
+        if last is None:
+            return [i] if self.already_satisfied else None
+        return [last, i]
 
 
 SurfaceSyndromeMeasurement = SurfaceXSyndromeMeasurement | SurfaceZSyndromeMeasurement
+
+
+class SurfaceSyndromeMeasurementScheduler:
+    '''\
+    Runs whole rounds of surface code syndrome measurements.
+
+    Calling `run()` on each syndrome measurement places gates one by one. This class instead precomputes
+    the target qubit IDs of each of the six time steps of a round from the ancilla positions and
+    stabilizer patterns, and places each kind of gate as a single instruction per time step.
+    Per-ancilla detector bookkeeping (the last measurement, post-selection and the detector tag) stays on
+    the syndrome measurements, and detectors are placed in the same order as `run()` would place them.
+    '''
+    def __init__(
+            self, circuit: Circuit | MultiplexingCircuit, measurements: Iterable[SurfaceSyndromeMeasurement]) -> None:
+        self.circuit = circuit
+        self.measurements = list(measurements)
+        mapping = circuit.mapping
+
+        depth = 6
+        self.reset_z_targets: list[list[int]] = [[] for _ in range(depth)]
+        self.reset_x_targets: list[list[int]] = [[] for _ in range(depth)]
+        self.cx_targets: list[list[tuple[int, int]]] = [[] for _ in range(depth)]
+        self.measurement_z_targets: list[list[int]] = [[] for _ in range(depth)]
+        self.measurement_x_targets: list[list[int]] = [[] for _ in range(depth)]
+        # Indices into `self.measurements` of the ancillas measured at each step, in the order of
+        # `measurement_z_targets` followed by `measurement_x_targets`, and in the order of `self.measurements`.
+        self._measured_by_basis: list[list[int]] = [[] for _ in range(depth)]
+        self._measured_in_order: list[list[int]] = [[] for _ in range(depth)]
+
+        for (index, m) in enumerate(self.measurements):
+            is_x = isinstance(m, SurfaceXSyndromeMeasurement)
+            (x, y) = m.ancilla_position
+            ancilla = mapping.get_id(x, y)
+            for (stage, step) in enumerate(m.schedule):
+                match step:
+                    case None:
+                        pass
+                    case 'RESET':
+                        (self.reset_x_targets if is_x else self.reset_z_targets)[stage].append(ancilla)
+                    case 'MEASURE':
+                        (self.measurement_x_targets if is_x else self.measurement_z_targets)[stage].append(ancilla)
+                        self._measured_in_order[stage].append(index)
+                    case (dx, dy):
+                        data = mapping.get_id(x + dx, y + dy)
+                        self.cx_targets[stage].append((ancilla, data) if is_x else (data, ancilla))
+        for stage in range(depth):
+            measured = self._measured_in_order[stage]
+            self._measured_by_basis[stage] = \
+                [i for i in measured if not isinstance(self.measurements[i], SurfaceXSyndromeMeasurement)] + \
+                [i for i in measured if isinstance(self.measurements[i], SurfaceXSyndromeMeasurement)]
+
+    def run_round(self) -> None:
+        '''Runs one round of all the syndrome measurements, placing a TICK after each time step.'''
+        assert all(m.is_complete() for m in self.measurements)
+        circuit = self.circuit
+        for stage in range(len(self.cx_targets)):
+            if len(self.reset_z_targets[stage]) > 0:
+                circuit.place_reset_z_by_ids(self.reset_z_targets[stage])
+            if len(self.reset_x_targets[stage]) > 0:
+                circuit.place_reset_x_by_ids(self.reset_x_targets[stage])
+            if len(self.cx_targets[stage]) > 0:
+                circuit.place_cx_by_ids(self.cx_targets[stage])
+            ids: list[MeasurementIdentifier] = []
+            if len(self.measurement_z_targets[stage]) > 0:
+                ids += circuit.place_measurement_z_by_ids(self.measurement_z_targets[stage])
+            if len(self.measurement_x_targets[stage]) > 0:
+                ids += circuit.place_measurement_x_by_ids(self.measurement_x_targets[stage])
+            measurement_ids = dict(zip(self._measured_by_basis[stage], ids))
+            rows: list[list[int]] = []
+            post_selection: list[bool] = []
+            tags: list[str] = []
+            for index in self._measured_in_order[stage]:
+                m = self.measurements[index]
+                ms = m._on_measured(measurement_ids[index])
+                if ms is None:
+                    continue
+                rows.append([i.id for i in ms] + [-1] * (2 - len(ms)))
+                post_selection.append(m.post_selection)
+                tags.append(m.detector_tag)
+            if len(rows) > 0:
+                circuit.place_detectors(rows, np.array(post_selection), tags)
+            circuit.place_tick()
@@ -6,12 +6,21 @@ import enum
 import math
 import numpy as np
 import pymatching
+import random
 import stim
+import sys
 
 from concurrent.futures import ProcessPoolExecutor
+from gap_histogram import GapHistogram
+from results_db import top_up_results
+from sampling import sample_in_chunks
+from shard import OPTIONS_NOT_AFFECTING_SHARD_RESULTS, Shard, ShardFile, add_shard_arguments
+from shard import load_shard_files_to_merge, make_shard_config, parse_shard_arguments, save_shard_file, spawn_seeds
+from task_sizing import TaskSizer, max_shots_for_memory, runs_serially, timed
+from typing import Any
 from util import QubitMapping, Circuit, MeasurementIdentifier, DetectorIdentifier, ObservableIdentifier, SuppressNoise
 from surface_code import SurfaceStabilizerPattern, SurfaceSyndromeMeasurement
-from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement
+from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement, SurfaceSyndromeMeasurementScheduler
 
 
 TICKS_FOR_SYNDROME_MEASUREMENT = 6
@@ -29,7 +38,12 @@ class ExpansionPattern(enum.Enum):
 
 class SurfaceCodePatch:
     def __init__(self, circuit: Circuit,
-                 distance1: int, distance2: int, rounds_for_gap: int, pattern: ExpansionPattern) -> None:
+                 distance1: int, distance2: int, rounds_for_gap: int, pattern: ExpansionPattern,
+                 use_repeat_blocks: bool = False) -> None:
+        '''\
+        When `use_repeat_blocks` is true, the steady-state rounds for the gap calculation are emitted as stim
+        REPEAT blocks instead of being unrolled.
+        '''
         assert distance1 <= distance2
         self.circuit = circuit
         self.distance1 = distance1
@@ -38,6 +52,7 @@ class SurfaceCodePatch:
         self.syndrome_measurements: dict[tuple[int, int], SurfaceSyndromeMeasurement] = {}
         self.detector_for_complementary_gap: DetectorIdentifier | None = None
         self.pattern = pattern
+        self.use_repeat_blocks = use_repeat_blocks
         match pattern:
             case ExpansionPattern.DOWNWARD:
                 self.offset = (1, 1)
@@ -244,10 +259,8 @@ class SurfaceCodePatch:
         (offset_x, offset_y) = self.offset
 
         with SuppressNoise(circuit):
-            for _ in range(TICKS_FOR_SYNDROME_MEASUREMENT * 2):
-                for m in self.syndrome_measurements.values():
-                    m.run()
-                circuit.place_tick()
+            for _ in range(2):
+                self.scheduler.run_round()
 
             pauli_string = stim.PauliString()
             match self.pattern:
@@ -273,18 +286,70 @@ class SurfaceCodePatch:
     def build(self) -> None:
         self._setup_initial_state()
         self._perform_code_expansion()
-        for _ in range(TICKS_FOR_SYNDROME_MEASUREMENT * self.rounds_for_gap):
-            for m in self.syndrome_measurements.values():
-                m.run()
-            self.circuit.place_tick()
+        self.scheduler = SurfaceSyndromeMeasurementScheduler(self.circuit, self.syndrome_measurements.values())
+        if self.use_repeat_blocks:
+            self.circuit.place_repeated(self.rounds_for_gap, self._perform_syndrome_extraction_round)
+        else:
+            for _ in range(self.rounds_for_gap):
+                self._perform_syndrome_extraction_round()
 
         self._perform_logical_z_measurement()
 
-
-class UncategorizedSample:
-    def __init__(self, gap: float, expected: bool) -> None:
-        self.gap = gap
-        self.expected = expected
+    def _perform_syndrome_extraction_round(self) -> None:
+        self.scheduler.run_round()
+
+
+class UncategorizedSamples:
+    '''\
+    Samples whose gaps fall between the thresholds of a `SimulationResults`, stored as parallel arrays of
+    float32 gaps and bool expectations. Appending grows the arrays geometrically, as a list does.
+    '''
+    def __init__(self) -> None:
+        self._gaps = np.empty(0, dtype=np.float32)
+        self._expected = np.empty(0, dtype=np.bool_)
+        self._size = 0
+
+    @property
+    def gaps(self) -> np.ndarray:
+        return self._gaps[:self._size]
+
+    @property
+    def expected(self) -> np.ndarray:
+        return self._expected[:self._size]
+
+    def append_many(self, gaps: np.ndarray, expected: np.ndarray) -> None:
+        assert len(gaps) == len(expected)
+        size = self._size + len(gaps)
+        if size > len(self._gaps):
+            capacity = max(size, 2 * len(self._gaps), 1024)
+            self._gaps = np.resize(self._gaps, capacity)
+            self._expected = np.resize(self._expected, capacity)
+        self._gaps[self._size:size] = gaps
+        self._expected[self._size:size] = expected
+        self._size = size
+
+    def extend(self, other: UncategorizedSamples) -> None:
+        self.append_many(other.gaps, other.expected)
+
+    def kth_smallest_gap(self, k: int) -> float:
+        '''Returns the `k`-th smallest gap (0-indexed), without sorting the gaps.'''
+        return float(np.partition(self.gaps, k)[k])
+
+    def num_expected_above(self, k: int) -> int:
+        '''Returns the number of expected samples other than those with the `k` smallest gaps.'''
+        if k <= 0:
+            return int(np.count_nonzero(self.expected))
+        if k >= self._size:
+            return 0
+        above = np.argpartition(self.gaps, k)[k:]
+        return int(np.count_nonzero(self.expected[above]))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getstate__(self) -> dict[str, object]:
+        # Don't pickle the spare capacity.
+        return {'_gaps': self.gaps.copy(), '_expected': self.expected.copy(), '_size': self._size}
 
 
 class SimulationResults:
@@ -294,7 +359,7 @@ class SimulationResults:
         self.num_valid_samples: int = 0
         self.num_wrong_samples: int = 0
         self.num_discarded_samples: int = 0
-        self.uncategorized_samples: list[UncategorizedSample] = []
+        self.uncategorized_samples = UncategorizedSamples()
 
     def append(self, gap: float, expected: bool) -> None:
         if gap < self.lower_threshold:
@@ -305,10 +370,22 @@ class SimulationResults:
             else:
                 self.num_wrong_samples += 1
         else:
-            self.uncategorized_samples.append(UncategorizedSample(gap, expected))
-
-    def append_discarded(self) -> None:
-        self.num_discarded_samples += 1
+            self.uncategorized_samples.append_many(
+                np.array([gap], dtype=np.float32), np.array([expected], dtype=np.bool_))
+
+    def append_many(self, gaps: np.ndarray, expected: np.ndarray) -> None:
+        '''Appends the samples with `gaps[i]` and `expected[i]` for each `i`.'''
+        discarded = gaps < self.lower_threshold
+        categorized = gaps >= self.upper_threshold
+        uncategorized = ~(discarded | categorized)
+        num_valid = int(np.count_nonzero(categorized & expected))
+        self.num_discarded_samples += int(np.count_nonzero(discarded))
+        self.num_valid_samples += num_valid
+        self.num_wrong_samples += int(np.count_nonzero(categorized)) - num_valid
+        self.uncategorized_samples.append_many(gaps[uncategorized], expected[uncategorized])
+
+    def append_discarded(self, num_samples: int = 1) -> None:
+        self.num_discarded_samples += num_samples
 
     def extend(self, other: SimulationResults):
         assert self.lower_threshold == other.lower_threshold
@@ -325,43 +402,114 @@ class SimulationResults:
                 self.num_discarded_samples + len(self.uncategorized_samples)
 
 
+Results = SimulationResults | GapHistogram
+
+# The discard rates `main` reports results for.
+DISCARD_RATES = [0, 0.01, 0.02, 0.05, 0.1, 0.15, 0.2]
+DEFAULT_GAP_BIN_WIDTH = 0.01
+DEFAULT_MAX_GAP = 256
+
+
+def new_results(
+        gap_filters: list[tuple[float, float]], gap_bin_width: float | None, max_gap: float) -> list[Results]:
+    '''\
+    Returns empty results: a single histogram of the gaps if `gap_bin_width` is given, and one
+    `SimulationResults` for each gap filter otherwise.
+    '''
+    if gap_bin_width is not None:
+        assert len(gap_filters) == 0
+        return [GapHistogram(gap_bin_width, max_gap)]
+    return [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
+
+
+def extend_results(results: list[Results], other: list[Results]) -> None:
+    assert len(results) == len(other)
+    for (rs, other_rs) in zip(results, other):
+        if isinstance(rs, GapHistogram):
+            assert isinstance(other_rs, GapHistogram)
+            rs.extend(other_rs)
+        else:
+            assert isinstance(other_rs, SimulationResults)
+            rs.extend(other_rs)
+
+
+def merge_results(results_list: list[Results]) -> Results:
+    '''Merges results of the same kind, e.g., those of the shards of a simulation.'''
+    assert len(results_list) > 0
+    first = results_list[0]
+    results: Results
+    if isinstance(first, GapHistogram):
+        results = GapHistogram(first.bin_width, first.max_gap)
+    else:
+        results = SimulationResults(first.lower_threshold, first.upper_threshold)
+    for r in results_list:
+        extend_results([results], [r])
+    return results
+
+
+def summarize_results(results: Results) -> dict[str, Any]:
+    '''Returns the counts in `results` as a JSON object. Uncategorized samples are counted as such.'''
+    if isinstance(results, GapHistogram):
+        return {
+            'num_shots': len(results),
+            'num_valid_samples': int(np.sum(results.num_valid_samples)),
+            'num_wrong_samples': int(np.sum(results.num_wrong_samples)),
+            'num_discarded_samples': results.num_discarded_samples,
+        }
+    return {
+        'num_shots': len(results),
+        'num_valid_samples': results.num_valid_samples,
+        'num_wrong_samples': results.num_wrong_samples,
+        'num_discarded_samples': results.num_discarded_samples,
+        'num_uncategorized_samples': len(results.uncategorized_samples),
+    }
+
+
 def perform_simulation(
         stim_circuit: stim.Circuit,
         num_shots: int,
         detector_for_complementary_gap: DetectorIdentifier,
         gap_filters: list[tuple[float, float]],
-        detectors_for_post_selection: list[DetectorIdentifier]) -> list[SimulationResults]:
+        postselection_ids: np.ndarray,
+        seed: int | None,
+        gap_bin_width: float | None = None,
+        max_gap: float = DEFAULT_MAX_GAP) -> list[Results]:
 
     dem = stim_circuit.detector_error_model(decompose_errors=True)
     matcher = pymatching.Matching.from_detector_error_model(dem)
-    sampler = stim_circuit.compile_detector_sampler()
 
-    detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
+    results = new_results(gap_filters, gap_bin_width, max_gap)
 
-    results = [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
-    postselection_ids = np.array([id.id for id in detectors_for_post_selection], dtype='uint')
-
-    for shot in range(num_shots):
-        syndrome = detection_events[shot]
-        if np.any(syndrome[postselection_ids] != 0):
-            for rs in results:
-                rs.append_discarded()
-            continue
+    for (detection_events, observable_flips) in sample_in_chunks(stim_circuit, num_shots, seed):
+        num_discarded = 0
+        gaps: list[float] = []
+        expectations: list[bool] = []
+        for shot in range(len(detection_events)):
+            syndrome = detection_events[shot]
+            if np.any(syndrome[postselection_ids] != 0):
+                num_discarded += 1
+                continue
 
-        prediction, weight = matcher.decode(syndrome, return_weight=True)
+            prediction, weight = matcher.decode(syndrome, return_weight=True)
 
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
-        c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
-        syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+            syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
+            c_prediction, c_weight = matcher.decode(syndrome, return_weight=True)
+            syndrome[detector_for_complementary_gap.id] = not syndrome[detector_for_complementary_gap.id]
 
-        if weight > c_weight:
-            prediction = c_prediction
+            if weight > c_weight:
+                prediction = c_prediction
 
-        actual = observable_flips[shot]
-        expected = np.array_equal(actual, prediction)
-        gap = abs(weight - c_weight)
+            actual = observable_flips[shot]
+            expected = np.array_equal(actual, prediction)
+            gaps.append(abs(weight - c_weight))
+            expectations.append(expected)
         for rs in results:
-            rs.append(gap, expected)
+            if isinstance(rs, GapHistogram):
+                rs.add_discarded(num_discarded)
+                rs.add_many(np.array(gaps, dtype=np.float64), np.array(expectations, dtype=np.bool_))
+            else:
+                rs.append_discarded(num_discarded)
+                rs.append_many(np.array(gaps, dtype=np.float64), np.array(expectations, dtype=np.bool_))
     return results
 
 
@@ -370,56 +518,64 @@ def perform_parallel_simulation(
         detector_for_complementary_gap: DetectorIdentifier,
         gap_filters: list[tuple[float, float]],
         num_shots: int,
+        seed: np.random.SeedSequence,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> list[SimulationResults]:
-    if num_shots / parallelism < 1000 or parallelism == 1:
+        show_progress: bool,
+        target_task_duration: float | None = None,
+        gap_bin_width: float | None = None,
+        max_gap: float = DEFAULT_MAX_GAP) -> list[Results]:
+    '''\
+    Simulates `num_shots` shots in parallel. Returns one `SimulationResults` for each gap filter, or a single
+    `GapHistogram` when `gap_bin_width` is given.
+    '''
+    if runs_serially(num_shots, parallelism, target_task_duration):
         return perform_simulation(
                 circuit.circuit,
                 num_shots,
                 detector_for_complementary_gap,
                 gap_filters,
-                circuit.detectors_for_post_selection)
+                circuit.post_selection_ids,
+                spawn_seeds(seed, 1)[0],
+                gap_bin_width,
+                max_gap)
 
-    results = [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
+    results = new_results(gap_filters, gap_bin_width, max_gap)
     progress = 0
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
     with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        while remaining_shots > 0:
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(perform_simulation,
-                                     circuit.circuit,
-                                     num_shots_for_this_task,
-                                     detector_for_complementary_gap,
-                                     gap_filters,
-                                     circuit.detectors_for_post_selection)
-            futures.append(future)
+        shots_for_future: dict[concurrent.futures.Future, int] = {}
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                while len(shots_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    future = executor.submit(timed,
+                                             perform_simulation,
+                                             circuit.circuit,
+                                             size,
+                                             detector_for_complementary_gap,
+                                             gap_filters,
+                                             circuit.post_selection_ids,
+                                             spawn_seeds(seed, 1)[0],
+                                             gap_bin_width,
+                                             max_gap)
+                    shots_for_future[future] = size
+                if len(shots_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        assert len(results) == len(future.result())
-                        assert len(results) > 0
-                        for i in range(len(results)):
-                            results[i].extend(future.result()[i])
-                        progress += len(future.result()[0])
-                    else:
-                        new_futures.append(future)
-                futures = new_futures
+                (done, _) = concurrent.futures.wait(
+                    shots_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, future_results) = future.result()
+                    assert len(results) > 0
+                    extend_results(results, future_results)
+                    progress += len(future_results[0])
+                    sizer.record(shots_for_future.pop(future), duration)
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in shots_for_future:
                 future.cancel()
     return results
 
@@ -433,8 +589,7 @@ def find_gap_threshold(results: SimulationResults, rate: float) -> float:
         return 0.0
 
     index = min(len(results.uncategorized_samples) - 1, int(round(rate * total)) - num_discarded)
-    gap = results.uncategorized_samples[index].gap
-    return gap
+    return results.uncategorized_samples.kth_smallest_gap(index)
 
 
 def construct_gap_filters(
@@ -457,38 +612,132 @@ def construct_gap_filters(
     return gap_filters
 
 
+def print_results_for_threshold_gap(results: SimulationResults) -> None:
+    assert len(results.uncategorized_samples) == 0
+    num_valid = results.num_valid_samples
+    num_wrong = results.num_wrong_samples
+    num_discarded = results.num_discarded_samples
+    print('VALID = {}, WRONG = {}, DISCARDED = {}'.format(num_valid, num_wrong, num_discarded))
+    print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
+
+
+def print_result_for_discard_rate(rate: float, num_valid: int, num_wrong: int, num_discarded: int) -> None:
+    print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}'.format(
+        rate * 100, num_valid, num_wrong, num_discarded))
+    if num_valid + num_wrong == 0:
+        print('WRONG / (VALID + WRONG) = nan')
+    else:
+        print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
+    print()
+
+
+def print_results_for_discard_rates(histogram: GapHistogram, discard_rates: list[float]) -> None:
+    for (rate, num_valid, num_wrong, num_discarded, _) in zip(
+            discard_rates, *histogram.discard(np.array(discard_rates))):
+        print_result_for_discard_rate(rate, num_valid, num_wrong, num_discarded)
+
+
+def print_results(results: Results) -> None:
+    if isinstance(results, GapHistogram):
+        print_results_for_discard_rates(results, DISCARD_RATES)
+    else:
+        print_results_for_threshold_gap(results)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='description')
     parser.add_argument('--num-shots', type=int, default=1000)
     parser.add_argument('--error-probability', type=float, default=0)
     parser.add_argument('--parallelism', type=int, default=1)
     parser.add_argument('--max-shots-per-task', type=int, default=2 ** 20)
+    parser.add_argument('--max-memory-per-task', type=int, default=1024,
+                        help='in MiB, for the sampled detection events of a task')
+    parser.add_argument('--target-task-duration', type=float, default=None,
+                        help='in seconds; size tasks from the measured cost per shot instead of --max-shots-per-task')
     parser.add_argument('--distance1', type=int, default=3)
     parser.add_argument('--distance2', type=int, default=7)
     parser.add_argument('--expansion-pattern', type=str, choices=list(['UPWARD', 'DOWNWARD']), default='DOWNWARD')
     parser.add_argument('--threshold-gap', type=float)
+    parser.add_argument('--gap-histogram', action='store_true',
+                        help='evaluate the discard rates in a single pass by accumulating a histogram of the gaps, '
+                             'instead of deriving gap filters from a preliminary run')
+    parser.add_argument('--gap-bin-width', type=float, default=DEFAULT_GAP_BIN_WIDTH)
+    parser.add_argument('--max-gap', type=float, default=DEFAULT_MAX_GAP,
+                        help='the last bin of the gap histogram also counts the gaps above this')
     parser.add_argument('--rounds-for-gap', type=int, default=7)
     parser.add_argument('--show-progress', action='store_true')
     parser.add_argument('--print-circuit', action='store_true')
+    parser.add_argument('--use-repeat-blocks', action='store_true')
+    parser.add_argument('--seed', type=int, default=None)
+    add_shard_arguments(parser)
+    parser.add_argument('--results-db', type=str, default='results.db',
+                        help='accumulate the results of the runs with the same options here, and run only the '
+                             'shots missing from --num-shots; used with --threshold-gap or --gap-histogram')
+    parser.add_argument('--no-results-db', action='store_true')
 
     args = parser.parse_args()
 
+    shard: Shard | None
+    try:
+        shard = parse_shard_arguments(args)
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return
+    # The gap filters are derived from a preliminary run, so only histograms of discard-rate runs can be merged.
+    if (shard is not None or args.merge_shards is not None) and args.threshold_gap is None and \
+            not args.gap_histogram:
+        print('Error: --shard and --merge-shards must be used with --threshold-gap or --gap-histogram.',
+              file=sys.stderr)
+        return
+    if args.gap_bin_width <= 0 or args.max_gap <= 0:
+        print('Error: --gap-bin-width and --max-gap must be positive.', file=sys.stderr)
+        return
+    if args.max_shots_per_task <= 0 or args.max_memory_per_task <= 0:
+        print('Error: --max-shots-per-task and --max-memory-per-task must be positive.', file=sys.stderr)
+        return
+    if args.target_task_duration is not None and args.target_task_duration <= 0:
+        print('Error: --target-task-duration must be positive.', file=sys.stderr)
+        return
+
+    seed: int
+    if args.seed is None:
+        seed = random.randrange(0, 2 ** 32)
+    else:
+        seed = args.seed
+    shard_config = make_shard_config(args, OPTIONS_NOT_AFFECTING_SHARD_RESULTS)
+
     print('  num-shots = {}'.format(args.num_shots))
     print('  error-probability = {}'.format(args.error_probability))
     print('  parallelism = {}'.format(args.parallelism))
     print('  max-shots-per-task = {}'.format(args.max_shots_per_task))
+    print('  max-memory-per-task = {}'.format(args.max_memory_per_task))
+    print('  target-task-duration = {}'.format(args.target_task_duration))
     print('  distance1 = {}'.format(args.distance1))
     print('  distance2 = {}'.format(args.distance2))
     print('  expansion-pattern = {}'.format(args.expansion_pattern))
     print('  threshold-gap = {}'.format(args.threshold_gap))
+    print('  gap-histogram = {}'.format(args.gap_histogram))
+    print('  gap-bin-width = {}'.format(args.gap_bin_width))
+    print('  max-gap = {}'.format(args.max_gap))
     print('  rounds-for-gap = {}'.format(args.rounds_for_gap))
     print('  show-progress = {}'.format(args.show_progress))
     print('  print-circuit = {}'.format(args.print_circuit))
+    print('  use-repeat-blocks = {}'.format(args.use_repeat_blocks))
+    if args.seed is None:
+        print('  seed = None ({})'.format(seed))
+    else:
+        print('  seed = {}'.format(seed))
+    print('  shard = {}'.format(shard))
+    print('  shard-output = {}'.format(args.shard_output))
+    print('  merge-shards = {}'.format(args.merge_shards))
+    print('  results-db = {}'.format(None if args.no_results_db else args.results_db))
 
     num_shots: int = args.num_shots
     error_probability: float = args.error_probability
     parallelism: int = args.parallelism
     max_shots_per_task: int = args.max_shots_per_task
+    max_memory_per_task: int = args.max_memory_per_task
+    target_task_duration: float | None = args.target_task_duration
     distance1: int = args.distance1
     distance2: int = args.distance2
     expansion_pattern: ExpansionPattern = args.expansion_pattern
@@ -500,13 +749,25 @@ def main() -> None:
         case _:
             raise ValueError(f'Invalid expansion pattern: {args.expansion_pattern}')
     threshold_gap: float | None = args.threshold_gap
+    gap_histogram: bool = args.gap_histogram
+    gap_bin_width: float = args.gap_bin_width
+    max_gap: float = args.max_gap
     rounds_for_gap: int = args.rounds_for_gap
     show_progress: bool = args.show_progress
     print_circuit: bool = args.print_circuit
+    use_repeat_blocks: bool = args.use_repeat_blocks
+    shard_output: str | None = args.shard_output
+    merge_shard_paths: list[str] | None = args.merge_shards
+    seed_sequence = (shard or Shard(0, 1)).seed_sequence(seed)
+    # The results of the shards are not stored, nor are those of the two-phase evaluation, which depend on the
+    # gap filters derived from its preliminary run.
+    results_db_path: str | None = args.results_db
+    if args.no_results_db or shard is not None or (threshold_gap is None and not gap_histogram):
+        results_db_path = None
 
     mapping = QubitMapping(30, 30)
     circuit = Circuit(mapping, error_probability)
-    patch = SurfaceCodePatch(circuit, distance1, distance2, rounds_for_gap, expansion_pattern)
+    patch = SurfaceCodePatch(circuit, distance1, distance2, rounds_for_gap, expansion_pattern, use_repeat_blocks)
 
     patch.build()
 
@@ -520,40 +781,63 @@ def main() -> None:
 
     detector_for_complementary_gap = patch.detector_for_complementary_gap
     assert detector_for_complementary_gap is not None
+    max_shots_per_task = min(max_shots_per_task, max_shots_for_memory(max_memory_per_task * 2 ** 20, circuit.circuit))
+
+    if merge_shard_paths is not None:
+        try:
+            shard_files = load_shard_files_to_merge(merge_shard_paths, shard_config)
+        except ValueError as e:
+            print('Error: {}'.format(e), file=sys.stderr)
+            return
+        print_results(merge_results([shard_file.payload for shard_file in shard_files]))
+        return
 
     if num_shots == 0:
         return
 
-    if threshold_gap is not None:
-        [results] = perform_parallel_simulation(
-            circuit,
-            detector_for_complementary_gap,
-            [(threshold_gap, threshold_gap)],
-            num_shots,
-            parallelism,
-            max_shots_per_task,
-            show_progress)
-        assert len(results.uncategorized_samples) == 0
-        num_valid = results.num_valid_samples
-        num_wrong = results.num_wrong_samples
-        num_discarded = results.num_discarded_samples
-        print('VALID = {}, WRONG = {}, DISCARDED = {}'.format(num_valid, num_wrong, num_discarded))
-        print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
+    if threshold_gap is not None or gap_histogram:
+        # A threshold gap run keeps every sample categorized, and a histogram run keeps none.
+        gap_filters: list[tuple[float, float]] = [] if threshold_gap is None else [(threshold_gap, threshold_gap)]
+
+        def simulate(num_shots: int) -> Results:
+            [results] = perform_parallel_simulation(
+                circuit,
+                detector_for_complementary_gap,
+                gap_filters,
+                num_shots,
+                seed_sequence,
+                parallelism,
+                max_shots_per_task,
+                show_progress,
+                target_task_duration,
+                None if threshold_gap is not None else gap_bin_width,
+                max_gap)
+            return results
+
+        results = top_up_results(
+            results_db_path, shard_config, seed, num_shots, simulate, merge_results, summarize_results)
+        if shard is not None:
+            assert shard_output is not None
+            save_shard_file(shard_output, ShardFile(shard_config, seed, shard, num_shots, results))
+            print('Saved the results to {}.'.format(shard_output))
+        print_results(results)
         return
 
+    discard_rates = DISCARD_RATES
     initial_shots = 100_000
     [initial_results] = perform_parallel_simulation(
         circuit,
         detector_for_complementary_gap,
         [(0, math.inf)],
         initial_shots,
+        seed_sequence,
         parallelism,
         max_shots_per_task,
-        show_progress=False)
-    initial_results.uncategorized_samples.sort(key=lambda r: r.gap)
+        show_progress=False,
+        target_task_duration=target_task_duration)
+    assert isinstance(initial_results, SimulationResults)
 
-    discard_rates = [0, 0.01, 0.02, 0.05, 0.1, 0.15, 0.2]
-    gap_filters: list[tuple[float, float]] = construct_gap_filters(discard_rates, initial_results, 0.02)
+    gap_filters = construct_gap_filters(discard_rates, initial_results, 0.02)
     assert len(discard_rates) == len(gap_filters)
     for (rate, (low, high)) in zip(discard_rates, gap_filters):
         print('Gap filter for cutoff rate {:4.1f}% is ({:.4f}, {:.4f}).'.format(rate * 100, low, high))
@@ -563,32 +847,30 @@ def main() -> None:
         detector_for_complementary_gap,
         gap_filters,
         num_shots,
+        seed_sequence,
         parallelism,
         max_shots_per_task,
-        show_progress)
-
-    for results in list_of_results:
-        results.uncategorized_samples.sort(key=lambda r: r.gap)
+        show_progress,
+        target_task_duration)
 
     for (rate, results) in zip(discard_rates, list_of_results):
+        assert isinstance(results, SimulationResults)
         num_valid = results.num_valid_samples
         num_wrong = results.num_wrong_samples
         num_discarded = results.num_discarded_samples
 
         num_to_be_discarded = round(len(results) * rate)
 
-        for sample in results.uncategorized_samples:
-            if num_discarded < num_to_be_discarded:
-                num_discarded += 1
-            elif sample.expected:
-                num_valid += 1
-            else:
-                num_wrong += 1
+        # Discard the uncategorized samples with the smallest gaps until `num_to_be_discarded` samples are
+        # discarded, and categorize the rest.
+        uncategorized = results.uncategorized_samples
+        num_newly_discarded = min(len(uncategorized), max(0, num_to_be_discarded - num_discarded))
+        num_newly_valid = uncategorized.num_expected_above(num_newly_discarded)
+        num_discarded += num_newly_discarded
+        num_valid += num_newly_valid
+        num_wrong += len(uncategorized) - num_newly_discarded - num_newly_valid
 
-        print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}'.format(
-            rate * 100, num_valid, num_wrong, num_discarded))
-        print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
-        print()
+        print_result_for_discard_rate(rate, num_valid, num_wrong, num_discarded)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,6 @@
+import contextlib
+import io
+import pickle
 import unittest
 
 from surface_code_expansion import *
@@ -152,3 +155,88 @@ class SurfaceCodePatchTest(unittest.TestCase):
         _ = stim_circuit.detector_error_model()
         # Assert that the circuit has a graph-like dem.
         _ = stim_circuit.detector_error_model(decompose_errors=True)
+
+    def test_repeat_blocks(self) -> None:
+        mapping = QubitMapping(20, 30)
+        unrolled = SurfaceCodePatch(Circuit(mapping, 1e-3), 3, 5, 4, ExpansionPattern.DOWNWARD)
+        repeated = SurfaceCodePatch(Circuit(mapping, 1e-3), 3, 5, 4, ExpansionPattern.DOWNWARD, use_repeat_blocks=True)
+        unrolled.build()
+        repeated.build()
+
+        self.assertIn('REPEAT', str(repeated.circuit.circuit))
+        self.assertEqual(repeated.circuit.circuit.num_detectors, unrolled.circuit.circuit.num_detectors)
+        self.assertEqual(repeated.circuit.detectors_for_post_selection, unrolled.circuit.detectors_for_post_selection)
+        self.assertEqual(repeated.circuit.circuit.detector_error_model(decompose_errors=True).flattened(),
+                         unrolled.circuit.circuit.detector_error_model(decompose_errors=True).flattened())
+
+
+class SimulationResultsTest(unittest.TestCase):
+    def test_append_many(self) -> None:
+        results = SimulationResults(1.0, 3.0)
+        results.append_many(np.array([0.5, 1.0, 2.5, 3.0, 4.0, 2.0]),
+                            np.array([True, True, False, True, False, True]))
+        results.append(0.0, True)
+        results.append_discarded(2)
+
+        self.assertEqual(results.num_discarded_samples, 4)
+        self.assertEqual(results.num_valid_samples, 1)
+        self.assertEqual(results.num_wrong_samples, 1)
+        self.assertEqual(results.uncategorized_samples.gaps.tolist(), [1.0, 2.5, 2.0])
+        self.assertEqual(results.uncategorized_samples.expected.tolist(), [True, False, True])
+        self.assertEqual(len(results), 9)
+
+    def test_extend_and_pickle(self) -> None:
+        results = SimulationResults(0, math.inf)
+        other = SimulationResults(0, math.inf)
+        for i in range(3000):
+            other.append(float(i % 7), i % 3 == 0)
+        results.extend(other)
+        results.extend(pickle.loads(pickle.dumps(other)))
+
+        self.assertEqual(len(results), 6000)
+        self.assertEqual(len(results.uncategorized_samples), 6000)
+        self.assertEqual(np.count_nonzero(results.uncategorized_samples.expected), 2000)
+
+    def test_find_gap_threshold(self) -> None:
+        results = SimulationResults(0, math.inf)
+        results.append_discarded(10)
+        gaps = np.arange(90, dtype=np.float64)[::-1]
+        results.append_many(gaps, np.ones(90, dtype=np.bool_))
+
+        self.assertEqual(find_gap_threshold(results, 0.05), 0.0)
+        self.assertEqual(find_gap_threshold(results, 0.5), 40.0)
+        self.assertEqual(find_gap_threshold(results, 1.0), 89.0)
+
+    def test_num_expected_above(self) -> None:
+        samples = UncategorizedSamples()
+        samples.append_many(np.array([3.0, 1.0, 4.0, 2.0, 5.0]), np.array([True, False, False, True, True]))
+
+        self.assertEqual(samples.num_expected_above(0), 3)
+        self.assertEqual(samples.num_expected_above(2), 2)
+        self.assertEqual(samples.num_expected_above(3), 1)
+        self.assertEqual(samples.num_expected_above(5), 0)
+        self.assertEqual(samples.kth_smallest_gap(1), 2.0)
+
+    def test_perform_simulation_with_gap_histogram(self) -> None:
+        patch = SurfaceCodePatch(Circuit(QubitMapping(30, 30), 0.005), 3, 5, 3, ExpansionPattern.DOWNWARD)
+        patch.build()
+        detector = patch.detector_for_complementary_gap
+        assert detector is not None
+        circuit = patch.circuit
+
+        [histogram] = perform_simulation(circuit.circuit, 2000, detector, [], circuit.post_selection_ids, 1, 0.01)
+        [results] = perform_simulation(circuit.circuit, 2000, detector, [(0, math.inf)], circuit.post_selection_ids, 1)
+        assert isinstance(histogram, GapHistogram)
+        assert isinstance(results, SimulationResults)
+
+        self.assertEqual(len(histogram), 2000)
+        self.assertEqual(histogram.num_discarded_samples, results.num_discarded_samples)
+        gaps = results.uncategorized_samples.gaps
+        self.assertEqual(histogram.num_valid_samples.tolist(), np.bincount(
+            histogram.bin_indices(gaps[results.uncategorized_samples.expected]),
+            minlength=len(histogram.num_valid_samples)).tolist())
+
+    def test_print_results_without_accepted_samples(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            print_results_for_discard_rates(GapHistogram(0.01, 10), [0.1])
+        self.assertIn('WRONG / (VALID + WRONG) = nan', output.getvalue())
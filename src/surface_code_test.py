@@ -1058,3 +1058,57 @@ class SurfaceXSyndromeMeasurementTest(unittest.TestCase):
             circuit.place_tick()
             m.run()
             mz.run()
+
+
+class SurfaceSyndromeMeasurementSchedulerTest(unittest.TestCase):
+    def _new_measurements(self, circuit: Circuit) -> list[SurfaceSyndromeMeasurement]:
+        ms: list[SurfaceSyndromeMeasurement] = [
+            SurfaceXSyndromeMeasurement(circuit, (2, 0), SurfaceStabilizerPattern.TWO_WEIGHT_DOWN, False),
+            SurfaceZSyndromeMeasurement(circuit, (2, 2), SurfaceStabilizerPattern.FOUR_WEIGHT, False),
+            SurfaceXSyndromeMeasurement(circuit, (4, 2), SurfaceStabilizerPattern.FOUR_WEIGHT, True),
+            SurfaceZSyndromeMeasurement(circuit, (6, 2), SurfaceStabilizerPattern.TWO_WEIGHT_LEFT, False),
+            SurfaceZSyndromeMeasurement(circuit, (0, 4), SurfaceStabilizerPattern.TWO_WEIGHT_RIGHT, False),
+            SurfaceXSyndromeMeasurement(circuit, (2, 4), SurfaceStabilizerPattern.FOUR_WEIGHT, True),
+            SurfaceZSyndromeMeasurement(circuit, (4, 4), SurfaceStabilizerPattern.FOUR_WEIGHT, False),
+            SurfaceXSyndromeMeasurement(circuit, (4, 6), SurfaceStabilizerPattern.TWO_WEIGHT_UP, False),
+        ]
+        ms[1].set_post_selection(True)
+        ms[2].set_detector_tag('TAG')
+        return ms
+
+    def test_run_round(self) -> None:
+        mapping = QubitMapping(10, 10)
+        circuit1 = Circuit(mapping, 0.001)
+        circuit2 = Circuit(mapping, 0.001)
+        ms1 = self._new_measurements(circuit1)
+        ms2 = self._new_measurements(circuit2)
+        scheduler = SurfaceSyndromeMeasurementScheduler(circuit2, ms2)
+
+        for _ in range(3):
+            for _ in range(6):
+                for m in ms1:
+                    m.run()
+                circuit1.place_tick()
+            scheduler.run_round()
+
+        self.assertEqual(circuit1.circuit.num_detectors, circuit2.circuit.num_detectors)
+        self.assertEqual(circuit1.detectors_for_post_selection, circuit2.detectors_for_post_selection)
+        for (m1, m2) in zip(ms1, ms2):
+            self.assertTrue(m2.is_complete())
+            self.assertEqual(m1.last_measurement is None, m2.last_measurement is None)
+        self.assertEqual([inst.tag for inst in circuit1.circuit if inst.name == 'DETECTOR'],
+                         [inst.tag for inst in circuit2.circuit if inst.name == 'DETECTOR'])
+        dem1 = circuit1.circuit.detector_error_model(allow_gauge_detectors=True)
+        dem2 = circuit2.circuit.detector_error_model(allow_gauge_detectors=True)
+        self.assertTrue(dem1.approx_equals(dem2, atol=1e-12))
+
+    def test_run_round_places_batched_instructions(self) -> None:
+        mapping = QubitMapping(10, 10)
+        circuit = Circuit(mapping, 0)
+        scheduler = SurfaceSyndromeMeasurementScheduler(circuit, self._new_measurements(circuit))
+
+        scheduler.run_round()
+        num_ticks = sum(1 for inst in circuit.circuit if inst.name == 'TICK')
+        num_cx = sum(1 for inst in circuit.circuit if inst.name == 'CX')
+        self.assertEqual(num_ticks, 6)
+        self.assertEqual(num_cx, 4)
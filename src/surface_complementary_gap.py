@@ -6,14 +6,21 @@ import enum
 import math
 import numpy as np
 import pymatching
+import random
 import stim
+import sys
 
 from concurrent.futures import ProcessPoolExecutor
 from enum import auto
+from gap_histogram import GapHistogram
+from results_db import top_up_results
+from shard import OPTIONS_NOT_AFFECTING_SHARD_RESULTS, Shard, make_shard_config, spawn_seeds
+from typing import Any
 from util import QubitMapping, Circuit
 from util import MeasurementIdentifier, DetectorIdentifier, ObservableIdentifier, SuppressNoise
 from surface_code import SurfaceStabilizerPattern, SurfaceSyndromeMeasurement
 from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement
+from task_sizing import TaskSizer, max_shots_for_memory, runs_serially, timed
 
 
 class InitialValue(enum.Enum):
@@ -263,10 +270,57 @@ class SurfacePatch:
                         ], post_selection)
 
 
-class UncategorizedSample:
-    def __init__(self, gap: float, expected: bool) -> None:
-        self.gap = gap
-        self.expected = expected
+class UncategorizedSamples:
+    '''\
+    Samples whose gaps fall between the thresholds of a `SimulationResults`, stored as parallel arrays of
+    float32 gaps and bool expectations. Appending grows the arrays geometrically, as a list does.
+    '''
+    def __init__(self) -> None:
+        self._gaps = np.empty(0, dtype=np.float32)
+        self._expected = np.empty(0, dtype=np.bool_)
+        self._size = 0
+
+    @property
+    def gaps(self) -> np.ndarray:
+        return self._gaps[:self._size]
+
+    @property
+    def expected(self) -> np.ndarray:
+        return self._expected[:self._size]
+
+    def append_many(self, gaps: np.ndarray, expected: np.ndarray) -> None:
+        assert len(gaps) == len(expected)
+        size = self._size + len(gaps)
+        if size > len(self._gaps):
+            capacity = max(size, 2 * len(self._gaps), 1024)
+            self._gaps = np.resize(self._gaps, capacity)
+            self._expected = np.resize(self._expected, capacity)
+        self._gaps[self._size:size] = gaps
+        self._expected[self._size:size] = expected
+        self._size = size
+
+    def extend(self, other: UncategorizedSamples) -> None:
+        self.append_many(other.gaps, other.expected)
+
+    def kth_smallest_gap(self, k: int) -> float:
+        '''Returns the `k`-th smallest gap (0-indexed), without sorting the gaps.'''
+        return float(np.partition(self.gaps, k)[k])
+
+    def num_expected_above(self, k: int) -> int:
+        '''Returns the number of expected samples other than those with the `k` smallest gaps.'''
+        if k <= 0:
+            return int(np.count_nonzero(self.expected))
+        if k >= self._size:
+            return 0
+        above = np.argpartition(self.gaps, k)[k:]
+        return int(np.count_nonzero(self.expected[above]))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getstate__(self) -> dict[str, object]:
+        # Don't pickle the spare capacity.
+        return {'_gaps': self.gaps.copy(), '_expected': self.expected.copy(), '_size': self._size}
 
 
 class SimulationResults:
@@ -276,7 +330,7 @@ class SimulationResults:
         self.num_valid_samples: int = 0
         self.num_wrong_samples: int = 0
         self.num_discarded_samples: int = 0
-        self.uncategorized_samples: list[UncategorizedSample] = []
+        self.uncategorized_samples = UncategorizedSamples()
 
     def append(self, gap: float, expected: bool) -> None:
         if gap < self.lower_threshold:
@@ -287,10 +341,22 @@ class SimulationResults:
             else:
                 self.num_wrong_samples += 1
         else:
-            self.uncategorized_samples.append(UncategorizedSample(gap, expected))
-
-    def append_discarded(self) -> None:
-        self.num_discarded_samples += 1
+            self.uncategorized_samples.append_many(
+                np.array([gap], dtype=np.float32), np.array([expected], dtype=np.bool_))
+
+    def append_many(self, gaps: np.ndarray, expected: np.ndarray) -> None:
+        '''Appends the samples with `gaps[i]` and `expected[i]` for each `i`.'''
+        discarded = gaps < self.lower_threshold
+        categorized = gaps >= self.upper_threshold
+        uncategorized = ~(discarded | categorized)
+        num_valid = int(np.count_nonzero(categorized & expected))
+        self.num_discarded_samples += int(np.count_nonzero(discarded))
+        self.num_valid_samples += num_valid
+        self.num_wrong_samples += int(np.count_nonzero(categorized)) - num_valid
+        self.uncategorized_samples.append_many(gaps[uncategorized], expected[uncategorized])
+
+    def append_discarded(self, num_samples: int = 1) -> None:
+        self.num_discarded_samples += num_samples
 
     def extend(self, other: SimulationResults):
         assert self.lower_threshold == other.lower_threshold
@@ -307,32 +373,65 @@ class SimulationResults:
                 self.num_discarded_samples + len(self.uncategorized_samples)
 
 
+Results = SimulationResults | GapHistogram
+
+DEFAULT_GAP_BIN_WIDTH = 0.01
+DEFAULT_MAX_GAP = 256
+
+
+def new_results(
+        gap_filters: list[tuple[float, float]], gap_bin_width: float | None, max_gap: float) -> list[Results]:
+    '''\
+    Returns empty results: a single histogram of the gaps if `gap_bin_width` is given, and one
+    `SimulationResults` for each gap filter otherwise.
+    '''
+    if gap_bin_width is not None:
+        assert len(gap_filters) == 0
+        return [GapHistogram(gap_bin_width, max_gap)]
+    return [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
+
+
+def extend_results(results: list[Results], other: list[Results]) -> None:
+    assert len(results) == len(other)
+    for (rs, other_rs) in zip(results, other):
+        if isinstance(rs, GapHistogram):
+            assert isinstance(other_rs, GapHistogram)
+            rs.extend(other_rs)
+        else:
+            assert isinstance(other_rs, SimulationResults)
+            rs.extend(other_rs)
+
+
 def perform_simulation(
         stim_circuit: stim.Circuit,
         num_shots: int,
         x_detector_for_complementary_gap: DetectorIdentifier,
         z_detector_for_complementary_gap: DetectorIdentifier,
         gap_filters: list[tuple[float, float]],
-        detectors_for_post_selection: list[DetectorIdentifier]) -> list[SimulationResults]:
+        postselection_ids: np.ndarray,
+        seed: int | None,
+        gap_bin_width: float | None = None,
+        max_gap: float = DEFAULT_MAX_GAP) -> list[Results]:
 
     dem = stim_circuit.detector_error_model(decompose_errors=True)
     matcher = pymatching.Matching.from_detector_error_model(dem)
 
-    sampler = stim_circuit.compile_detector_sampler()
+    sampler = stim_circuit.compile_detector_sampler(seed=seed)
     detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
 
-    results = [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
-    postselection_ids = np.array([id.id for id in detectors_for_post_selection], dtype='uint')
+    results = new_results(gap_filters, gap_bin_width, max_gap)
 
     mask = np.ones_like(detection_events[0], dtype=bool)
     mask[x_detector_for_complementary_gap.id] = False
     mask[z_detector_for_complementary_gap.id] = False
 
+    num_discarded = 0
+    gaps: list[float] = []
+    expectations: list[bool] = []
     for shot in range(num_shots):
         syndrome = detection_events[shot]
         if np.any(syndrome[postselection_ids] != 0):
-            for rs in results:
-                rs.append_discarded()
+            num_discarded += 1
             continue
 
         prediction, weight = matcher.decode(syndrome, return_weight=True)
@@ -372,8 +471,16 @@ def perform_simulation(
         if all(syndrome[mask] == 0):
             gap += 10.0
 
-        for rs in results:
-            rs.append(gap, expected)
+        gaps.append(gap)
+        expectations.append(expected)
+
+    for rs in results:
+        if isinstance(rs, GapHistogram):
+            rs.add_discarded(num_discarded)
+            rs.add_many(np.array(gaps, dtype=np.float64), np.array(expectations, dtype=np.bool_))
+        else:
+            rs.append_discarded(num_discarded)
+            rs.append_many(np.array(gaps, dtype=np.float64), np.array(expectations, dtype=np.bool_))
     return results
 
 
@@ -383,58 +490,68 @@ def perform_parallel_simulation(
         z_detector_for_complementary_gap: DetectorIdentifier,
         gap_filters: list[tuple[float, float]],
         num_shots: int,
+        seed: np.random.SeedSequence,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> list[SimulationResults]:
-    if num_shots / parallelism < 1000 or parallelism == 1:
-        return perform_simulation(
+        show_progress: bool,
+        target_task_duration: float | None = None,
+        gap_bin_width: float | None = None,
+        max_gap: float = DEFAULT_MAX_GAP) -> list[Results]:
+    '''\
+    Simulates `num_shots` shots in parallel. Returns one `SimulationResults` for each gap filter, or a single
+    `GapHistogram` when `gap_bin_width` is given.
+    '''
+    results = new_results(gap_filters, gap_bin_width, max_gap)
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
+    if runs_serially(num_shots, parallelism, target_task_duration):
+        while (size := sizer.next_task_size()) > 0:
+            extend_results(results, perform_simulation(
                 circuit.circuit,
-                num_shots,
+                size,
                 x_detector_for_complementary_gap,
                 z_detector_for_complementary_gap,
                 gap_filters,
-                circuit.detectors_for_post_selection)
+                circuit.post_selection_ids,
+                spawn_seeds(seed, 1)[0],
+                gap_bin_width,
+                max_gap))
+        return results
 
-    results = [SimulationResults(lower, upper) for (lower, upper) in gap_filters]
     progress = 0
     with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        while remaining_shots > 0:
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(perform_simulation,
-                                     circuit.circuit,
-                                     num_shots_for_this_task,
-                                     x_detector_for_complementary_gap,
-                                     z_detector_for_complementary_gap,
-                                     gap_filters,
-                                     circuit.detectors_for_post_selection)
-            futures.append(future)
+        shots_for_future: dict[concurrent.futures.Future, int] = {}
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                while len(shots_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    future = executor.submit(timed,
+                                             perform_simulation,
+                                             circuit.circuit,
+                                             size,
+                                             x_detector_for_complementary_gap,
+                                             z_detector_for_complementary_gap,
+                                             gap_filters,
+                                             circuit.post_selection_ids,
+                                             spawn_seeds(seed, 1)[0],
+                                             gap_bin_width,
+                                             max_gap)
+                    shots_for_future[future] = size
+                if len(shots_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        assert len(results) == len(future.result())
-                        assert len(results) > 0
-                        for i in range(len(results)):
-                            results[i].extend(future.result()[i])
-                        progress += len(future.result()[0])
-                    else:
-                        new_futures.append(future)
-                futures = new_futures
+                (done, _) = concurrent.futures.wait(
+                    shots_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, future_results) = future.result()
+                    assert len(results) > 0
+                    extend_results(results, future_results)
+                    progress += len(future_results[0])
+                    sizer.record(shots_for_future.pop(future), duration)
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in shots_for_future:
                 future.cancel()
     return results
 
@@ -448,8 +565,7 @@ def find_gap_threshold(results: SimulationResults, rate: float) -> float:
         return 0.0
 
     index = min(len(results.uncategorized_samples) - 1, int(round(rate * total)) - num_discarded)
-    gap = results.uncategorized_samples[index].gap
-    return gap
+    return results.uncategorized_samples.kth_smallest_gap(index)
 
 
 def construct_gap_filters(
@@ -472,34 +588,106 @@ def construct_gap_filters(
     return gap_filters
 
 
+def merge_histograms(histograms: list[GapHistogram]) -> GapHistogram:
+    '''Merges the histograms of runs with the same options.'''
+    assert len(histograms) > 0
+    merged = GapHistogram(histograms[0].bin_width, histograms[0].max_gap)
+    for histogram in histograms:
+        merged.extend(histogram)
+    return merged
+
+
+def summarize_histogram(histogram: GapHistogram) -> dict[str, Any]:
+    '''Returns the counts in `histogram` as a JSON object.'''
+    return {
+        'num_shots': len(histogram),
+        'num_valid_samples': int(np.sum(histogram.num_valid_samples)),
+        'num_wrong_samples': int(np.sum(histogram.num_wrong_samples)),
+        'num_discarded_samples': histogram.num_discarded_samples,
+    }
+
+
+def print_result_for_discard_rate(rate: float, num_valid: int, num_wrong: int, num_discarded: int) -> None:
+    print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}'.format(
+        rate * 100, num_valid, num_wrong, num_discarded))
+    if num_valid + num_wrong == 0:
+        print('WRONG / (VALID + WRONG) = nan')
+    else:
+        print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
+    print()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='description')
     parser.add_argument('--num-shots', type=int, default=1000)
     parser.add_argument('--error-probability', type=float, default=0)
     parser.add_argument('--parallelism', type=int, default=1)
     parser.add_argument('--max-shots-per-task', type=int, default=2 ** 20)
+    parser.add_argument('--max-memory-per-task', type=int, default=1024,
+                        help='in MiB, for the sampled detection events of a task')
+    parser.add_argument('--target-task-duration', type=float, default=None,
+                        help='in seconds; size tasks from the measured cost per shot instead of --max-shots-per-task')
     parser.add_argument('--surface-distance', type=int, default=3)
     parser.add_argument('--initial-value', choices=['+', '0'], default='+')
     parser.add_argument('--full-post-selection', action='store_true')
     parser.add_argument('--print-circuit', action='store_true')
     parser.add_argument('--show-progress', action='store_true')
+    parser.add_argument('--gap-histogram', action='store_true',
+                        help='evaluate the discard rates in a single pass by accumulating a histogram of the gaps, '
+                             'instead of deriving gap filters from a preliminary run')
+    parser.add_argument('--gap-bin-width', type=float, default=DEFAULT_GAP_BIN_WIDTH)
+    parser.add_argument('--max-gap', type=float, default=DEFAULT_MAX_GAP,
+                        help='the last bin of the gap histogram also counts the gaps above this')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--results-db', type=str, default='results.db',
+                        help='accumulate the results of the runs with the same options here, and run only the '
+                             'shots missing from --num-shots; used with --gap-histogram')
+    parser.add_argument('--no-results-db', action='store_true')
 
     args = parser.parse_args()
 
+    if args.gap_bin_width <= 0 or args.max_gap <= 0:
+        print('Error: --gap-bin-width and --max-gap must be positive.', file=sys.stderr)
+        return
+    if args.max_shots_per_task <= 0 or args.max_memory_per_task <= 0:
+        print('Error: --max-shots-per-task and --max-memory-per-task must be positive.', file=sys.stderr)
+        return
+    if args.target_task_duration is not None and args.target_task_duration <= 0:
+        print('Error: --target-task-duration must be positive.', file=sys.stderr)
+        return
+
+    seed: int
+    if args.seed is None:
+        seed = random.randrange(0, 2 ** 32)
+    else:
+        seed = args.seed
+
     print('  num-shots = {}'.format(args.num_shots))
     print('  error-probability = {}'.format(args.error_probability))
     print('  parallelism = {}'.format(args.parallelism))
     print('  max-shots-per-task = {}'.format(args.max_shots_per_task))
+    print('  max-memory-per-task = {}'.format(args.max_memory_per_task))
+    print('  target-task-duration = {}'.format(args.target_task_duration))
     print('  surface-distance = {}'.format(args.surface_distance))
     print('  initial-value = {}'.format(args.initial_value))
     print('  full-post-selection = {}'.format(args.full_post_selection))
     print('  print-circuit = {}'.format(args.print_circuit))
     print('  show-progress = {}'.format(args.show_progress))
+    print('  gap-histogram = {}'.format(args.gap_histogram))
+    print('  gap-bin-width = {}'.format(args.gap_bin_width))
+    print('  max-gap = {}'.format(args.max_gap))
+    if args.seed is None:
+        print('  seed = None ({})'.format(seed))
+    else:
+        print('  seed = {}'.format(seed))
+    print('  results-db = {}'.format(None if args.no_results_db else args.results_db))
 
     num_shots: int = args.num_shots
     error_probability: float = args.error_probability
     parallelism: int = args.parallelism
     max_shots_per_task: int = args.max_shots_per_task
+    max_memory_per_task: int = args.max_memory_per_task
+    target_task_duration: float | None = args.target_task_duration
     surface_distance: int = args.surface_distance
     match args.initial_value:
         case '+':
@@ -511,6 +699,13 @@ def main() -> None:
     full_post_selection: bool = args.full_post_selection
     print_circuit: bool = args.print_circuit
     show_progress: bool = args.show_progress
+    gap_histogram: bool = args.gap_histogram
+    gap_bin_width: float = args.gap_bin_width
+    max_gap: float = args.max_gap
+    seed_sequence = Shard(0, 1).seed_sequence(seed)
+    # The results of the two-phase evaluation are not stored, as they depend on the gap filters derived from its
+    # preliminary run.
+    results_db_path: str | None = None if args.no_results_db or not gap_histogram else args.results_db
 
     mapping = QubitMapping(30, 30)
     r = SurfacePatch(mapping, surface_distance, initial_value, error_probability, full_post_selection)
@@ -529,6 +724,32 @@ def main() -> None:
     z_detector_for_complementary_gap = r.z_detector_for_complementary_gap
     assert x_detector_for_complementary_gap is not None
     assert z_detector_for_complementary_gap is not None
+    max_shots_per_task = min(max_shots_per_task, max_shots_for_memory(max_memory_per_task * 2 ** 20, stim_circuit))
+
+    discard_rates = [0.25, 0.30, 0.35]
+    if gap_histogram:
+        def simulate(num_shots: int) -> GapHistogram:
+            [histogram] = perform_parallel_simulation(
+                r.circuit,
+                x_detector_for_complementary_gap,
+                z_detector_for_complementary_gap,
+                [],
+                num_shots,
+                seed_sequence,
+                parallelism,
+                max_shots_per_task,
+                show_progress,
+                target_task_duration,
+                gap_bin_width,
+                max_gap)
+            assert isinstance(histogram, GapHistogram)
+            return histogram
+        histogram = top_up_results(results_db_path, make_shard_config(args, OPTIONS_NOT_AFFECTING_SHARD_RESULTS),
+                                   seed, num_shots, simulate, merge_histograms, summarize_histogram)
+        for (rate, num_valid, num_wrong, num_discarded, _) in zip(
+                discard_rates, *histogram.discard(np.array(discard_rates))):
+            print_result_for_discard_rate(rate, num_valid, num_wrong, num_discarded)
+        return
 
     initial_shots = 100_000
     [initial_results] = perform_parallel_simulation(
@@ -537,12 +758,13 @@ def main() -> None:
         z_detector_for_complementary_gap,
         [(0, math.inf)],
         initial_shots,
+        seed_sequence,
         parallelism,
         max_shots_per_task,
-        show_progress=False)
-    initial_results.uncategorized_samples.sort(key=lambda r: r.gap)
+        show_progress=False,
+        target_task_duration=target_task_duration)
+    assert isinstance(initial_results, SimulationResults)
 
-    discard_rates = [0.25, 0.30, 0.35]
     gap_filters: list[tuple[float, float]] = construct_gap_filters(discard_rates, initial_results, 0.02)
     assert len(discard_rates) == len(gap_filters)
     for (rate, (low, high)) in zip(discard_rates, gap_filters):
@@ -554,32 +776,30 @@ def main() -> None:
         z_detector_for_complementary_gap,
         gap_filters,
         num_shots,
+        seed_sequence,
         parallelism,
         max_shots_per_task,
-        show_progress)
-
-    for results in list_of_results:
-        results.uncategorized_samples.sort(key=lambda r: r.gap)
+        show_progress,
+        target_task_duration)
 
     for (rate, results) in zip(discard_rates, list_of_results):
+        assert isinstance(results, SimulationResults)
         num_valid = results.num_valid_samples
         num_wrong = results.num_wrong_samples
         num_discarded = results.num_discarded_samples
 
         num_to_be_discarded = round(len(results) * rate)
 
-        for sample in results.uncategorized_samples:
-            if num_discarded < num_to_be_discarded:
-                num_discarded += 1
-            elif sample.expected:
-                num_valid += 1
-            else:
-                num_wrong += 1
+        # Discard the uncategorized samples with the smallest gaps until `num_to_be_discarded` samples are
+        # discarded, and categorize the rest.
+        uncategorized = results.uncategorized_samples
+        num_newly_discarded = min(len(uncategorized), max(0, num_to_be_discarded - num_discarded))
+        num_newly_valid = uncategorized.num_expected_above(num_newly_discarded)
+        num_discarded += num_newly_discarded
+        num_valid += num_newly_valid
+        num_wrong += len(uncategorized) - num_newly_discarded - num_newly_valid
 
-        print('Discard {:.1f}% samples, VALID = {}, WRONG = {}, DISCARDED = {}'.format(
-            rate * 100, num_valid, num_wrong, num_discarded))
-        print('WRONG / (VALID + WRONG) = {:.3e}'.format(num_wrong / (num_valid + num_wrong)))
-        print()
+        print_result_for_discard_rate(rate, num_valid, num_wrong, num_discarded)
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ import math
 import numpy as np
 import pymatching
 import stim
+import sys
 
 from concurrent.futures import ProcessPoolExecutor
 from enum import auto
@@ -16,6 +17,7 @@ from util import MeasurementIdentifier, DetectorIdentifier, ObservableIdentifier
 from steane_code import SteaneZ0145SyndromeMeasurement, SteaneZ0235SyndromeMeasurement, SteaneZ0246SyndromeMeasurement
 from surface_code import SurfaceStabilizerPattern, SurfaceSyndromeMeasurement
 from surface_code import SurfaceXSyndromeMeasurement, SurfaceZSyndromeMeasurement
+from task_sizing import TaskSizer, max_shots_for_memory, runs_serially, timed
 
 
 class InitialValue(enum.Enum):
@@ -486,7 +488,7 @@ def perform_simulation(
         num_shots: int,
         x_detector_for_complementary_gap: DetectorIdentifier,
         z_detector_for_complementary_gap: DetectorIdentifier,
-        detectors_for_post_selection: list[DetectorIdentifier]) -> SimulationResults:
+        postselection_ids: np.ndarray) -> SimulationResults:
 
     # We construct a decoder for `partially_noiseless_stim_circuit`, not to confuse the matching decoder with
     # non-matchable detectors. We perform post-selection for all detectors in the Steane code, so the difference
@@ -499,7 +501,6 @@ def perform_simulation(
     detection_events, observable_flips = sampler.sample(num_shots, separate_observables=True)
 
     results = SimulationResults()
-    postselection_ids = np.array([id.id for id in detectors_for_post_selection], dtype='uint')
 
     for shot in range(num_shots):
         syndrome = detection_events[shot]
@@ -552,53 +553,52 @@ def perform_parallel_simulation(
         num_shots: int,
         parallelism: int,
         num_shots_per_task: int,
-        show_progress: bool) -> SimulationResults:
-    if num_shots / parallelism < 1000 or parallelism == 1:
-        return perform_simulation(
+        show_progress: bool,
+        target_task_duration: float | None = None) -> SimulationResults:
+    results = SimulationResults()
+    sizer = TaskSizer(num_shots, parallelism, num_shots_per_task, target_task_duration)
+    if runs_serially(num_shots, parallelism, target_task_duration):
+        while (size := sizer.next_task_size()) > 0:
+            results.extend(perform_simulation(
                 primal_circuit.circuit,
                 partially_noiseless_circuit.circuit,
-                num_shots,
+                size,
                 x_detector_for_complementary_gap,
                 z_detector_for_complementary_gap,
-                primal_circuit.detectors_for_post_selection)
+                primal_circuit.post_selection_ids))
+        return results
 
-    results = SimulationResults()
     progress = 0
     with ProcessPoolExecutor(max_workers=parallelism) as executor:
-        futures: list[concurrent.futures.Future] = []
-        remaining_shots = num_shots
-
-        num_shots_per_task = min(num_shots_per_task, (num_shots + parallelism - 1) // parallelism)
-        while remaining_shots > 0:
-            num_shots_for_this_task = min(num_shots_per_task, remaining_shots)
-            remaining_shots -= num_shots_for_this_task
-            future = executor.submit(perform_simulation,
-                                     primal_circuit.circuit,
-                                     partially_noiseless_circuit.circuit,
-                                     num_shots_for_this_task,
-                                     x_detector_for_complementary_gap,
-                                     z_detector_for_complementary_gap,
-                                     primal_circuit.detectors_for_post_selection)
-            futures.append(future)
+        shots_for_future: dict[concurrent.futures.Future, int] = {}
         try:
-            while len(futures) > 0:
-                import sys
+            while True:
+                while len(shots_for_future) < 2 * parallelism and (size := sizer.next_task_size()) > 0:
+                    future = executor.submit(timed,
+                                             perform_simulation,
+                                             primal_circuit.circuit,
+                                             partially_noiseless_circuit.circuit,
+                                             size,
+                                             x_detector_for_complementary_gap,
+                                             z_detector_for_complementary_gap,
+                                             primal_circuit.post_selection_ids)
+                    shots_for_future[future] = size
+                if len(shots_for_future) == 0:
+                    break
                 if show_progress:
                     print('Progress: {}% ({}/{})\r'.format(
                         round((progress / num_shots) * 100), progress, num_shots), end='')
-                concurrent.futures.wait(futures, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
-                new_futures = []
-                for future in futures:
-                    if future.done():
-                        results.extend(future.result())
-                        progress += len(future.result())
-                    else:
-                        new_futures.append(future)
-                futures = new_futures
+                (done, _) = concurrent.futures.wait(
+                    shots_for_future, timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (duration, future_results) = future.result()
+                    results.extend(future_results)
+                    progress += len(future_results)
+                    sizer.record(shots_for_future.pop(future), duration)
             if show_progress:
                 print()
         finally:
-            for future in futures:
+            for future in shots_for_future:
                 future.cancel()
     return results
 
@@ -609,6 +609,10 @@ def main() -> None:
     parser.add_argument('--error-probability', type=float, default=0)
     parser.add_argument('--parallelism', type=int, default=1)
     parser.add_argument('--max-shots-per-task', type=int, default=2 ** 20)
+    parser.add_argument('--max-memory-per-task', type=int, default=1024,
+                        help='in MiB, for the sampled detection events of a task')
+    parser.add_argument('--target-task-duration', type=float, default=None,
+                        help='in seconds; size tasks from the measured cost per shot instead of --max-shots-per-task')
     parser.add_argument('--surface-distance', type=int, default=3)
     parser.add_argument('--initial-value', choices=['+', '0'], default='+')
     parser.add_argument('--full-post-selection', action='store_true')
@@ -617,10 +621,18 @@ def main() -> None:
 
     args = parser.parse_args()
 
+    if args.max_shots_per_task <= 0 or args.max_memory_per_task <= 0:
+        print('Error: --max-shots-per-task and --max-memory-per-task must be positive.', file=sys.stderr)
+        return
+    if args.target_task_duration is not None and args.target_task_duration <= 0:
+        print('Error: --target-task-duration must be positive.', file=sys.stderr)
+        return
     print('  num-shots = {}'.format(args.num_shots))
     print('  error-probability = {}'.format(args.error_probability))
     print('  parallelism = {}'.format(args.parallelism))
     print('  max-shots-per-task = {}'.format(args.max_shots_per_task))
+    print('  max-memory-per-task = {}'.format(args.max_memory_per_task))
+    print('  target-task-duration = {}'.format(args.target_task_duration))
     print('  surface-distance = {}'.format(args.surface_distance))
     print('  initial-value = {}'.format(args.initial_value))
     print('  full-post-selection = {}'.format(args.full_post_selection))
@@ -631,6 +643,8 @@ def main() -> None:
     error_probability: float = args.error_probability
     parallelism: int = args.parallelism
     max_shots_per_task: int = args.max_shots_per_task
+    max_memory_per_task: int = args.max_memory_per_task
+    target_task_duration: float | None = args.target_task_duration
     surface_distance: int = args.surface_distance
     match args.initial_value:
         case '+':
@@ -661,6 +675,8 @@ def main() -> None:
     z_detector_for_complementary_gap = r.z_detector_for_complementary_gap
     assert x_detector_for_complementary_gap is not None
     assert z_detector_for_complementary_gap is not None
+    max_shots_per_task = min(
+        max_shots_per_task, max_shots_for_memory(max_memory_per_task * 2 ** 20, primal_circuit.circuit))
 
     discard_rates = [0, 0.35, 0.40, 0.45, 0.50, 0.55, 0.60]
 
@@ -672,7 +688,8 @@ def main() -> None:
         num_shots,
         parallelism,
         max_shots_per_task,
-        show_progress)
+        show_progress,
+        target_task_duration)
 
     num_discarded = results.num_discarded_samples
     num_samples = len(results)
@@ -0,0 +1,393 @@
+from __future__ import annotations
+
+import argparse
+import concurrent
+import concurrent.futures
+import itertools
+import math
+import numpy as np
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+
+from lattice_surgery_complementary_gap import SteanePlusSurfaceCode, InitialValue, SteaneSyndromeExtractionPattern
+from dataclasses import asdict
+from lattice_surgery_complementary_gap import SimulationResultsForGapThreshold, perform_simulation
+from lattice_surgery_complementary_gap import merge_results, summarize_results
+from lookup_table import LookupTableKey, NegativeLookupTable, SortedArrayLookupTable
+from lookup_table import ensure_lookup_tables_table, query_lookup_table
+from results_db import StoredResults, ensure_results_table, query_results, store_results
+from shard import Shard, spawn_seeds
+from typing import Any
+from util import QubitMapping
+from worker_pool import WorkerPool
+
+
+def wilson_interval(num_wrong: int, num_samples: int, z: float = 1.96) -> tuple[float, float]:
+    '''Returns the Wilson score interval of the rate `num_wrong / num_samples`.'''
+    if num_samples == 0:
+        return (0.0, 1.0)
+    p = num_wrong / num_samples
+    denominator = 1 + z * z / num_samples
+    center = (p + z * z / (2 * num_samples)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / num_samples + z * z / (4 * num_samples * num_samples)) / denominator
+    return (max(0.0, center - half_width), min(1.0, center + half_width))
+
+
+def relative_interval_width(num_wrong: int, num_samples: int) -> float:
+    '''Returns the width of the Wilson interval relative to the estimate, or infinity with no wrong samples.'''
+    if num_wrong == 0:
+        return math.inf
+    (lower, upper) = wilson_interval(num_wrong, num_samples)
+    return (upper - lower) / (num_wrong / num_samples)
+
+
+class Cell:
+    '''A point of the grid: one configuration of `SteanePlusSurfaceCode` and a gap threshold.'''
+    def __init__(
+            self,
+            index: int,
+            error_probability: float,
+            surface_intermediate_distance: int,
+            surface_final_distance: int,
+            initial_value: InitialValue,
+            steane_syndrome_extraction_pattern: SteaneSyndromeExtractionPattern,
+            gap_threshold: float,
+            seed: int) -> None:
+        self.index = index
+        self.error_probability = error_probability
+        self.surface_intermediate_distance = surface_intermediate_distance
+        self.surface_final_distance = surface_final_distance
+        self.initial_value = initial_value
+        self.steane_syndrome_extraction_pattern = steane_syndrome_extraction_pattern
+        self.gap_threshold = gap_threshold
+        self.seed_sequence = np.random.SeedSequence(seed, spawn_key=(index,))
+        # `results` holds the results accumulated in the results database as well, and `new_results` only those
+        # of this run.
+        self.results = SimulationResultsForGapThreshold(gap_threshold)
+        self.new_results = SimulationResultsForGapThreshold(gap_threshold)
+        self.num_shots_in_flight = 0
+        self.code: SteanePlusSurfaceCode | None = None
+        self.lookup_table: NegativeLookupTable | None = None
+        # Identifies the results of this cell in the results database. It depends on the lookup table.
+        self.results_config: dict[str, Any] | None = None
+
+    def num_shots(self) -> int:
+        return len(self.results)
+
+    def counts(self) -> tuple[int, int]:
+        '''Returns the number of wrong samples and the number of accepted (valid or wrong) samples.'''
+        entry = self.results.entry_with_lookup_table()
+        return (entry.num_wrong_samples(), entry.num_valid_samples() + entry.num_wrong_samples())
+
+    def projected_relative_interval_width(self) -> float:
+        '''\
+        Returns the relative interval width expected once the chunks in flight complete, assuming that the width
+        scales as 1 / sqrt(num_shots).
+        '''
+        (num_wrong, num_accepted) = self.counts()
+        width = relative_interval_width(num_wrong, num_accepted)
+        if self.num_shots_in_flight == 0 or math.isinf(width):
+            return width
+        return width * math.sqrt(self.num_shots() / (self.num_shots() + self.num_shots_in_flight))
+
+    def description(self) -> str:
+        return 'error-probability = {}, surface-distance = {} -> {}, initial-value = {}, ' \
+            'steane-syndrome-extraction-pattern = {}, gap-threshold = {}'.format(
+                self.error_probability, self.surface_intermediate_distance, self.surface_final_distance,
+                self.initial_value.name, self.steane_syndrome_extraction_pattern.name, self.gap_threshold)
+
+
+def load_accumulated_results(con: sqlite3.Connection, cells: list[Cell], seed: int) -> None:
+    '''\
+    Adds the results stored in the results database for each cell to `cell.results`, except those for `seed`,
+    which this run replaces.
+    '''
+    for cell in cells:
+        assert cell.results_config is not None
+        stored = [r for r in query_results(con, cell.results_config) if r.seed != seed]
+        if len(stored) > 0:
+            results = merge_results([cell.results] + [r.payload for r in stored])
+            assert isinstance(results, SimulationResultsForGapThreshold)
+            cell.results = results
+
+
+def store_new_results(con: sqlite3.Connection, cells: list[Cell], seed: int) -> None:
+    '''Stores the results of this run for each cell which ran any shots in the results database under `seed`.'''
+    for cell in cells:
+        assert cell.results_config is not None
+        if len(cell.new_results) == 0:
+            continue
+        store_results(con, cell.results_config, StoredResults(
+            seed, Shard(0, 1), len(cell.new_results), summarize_results(cell.new_results), cell.new_results))
+
+
+def choose_next_cell(cells: list[Cell], max_shots_per_cell: int, target_relative_interval_width: float) -> Cell | None:
+    '''\
+    Returns the cell whose error rate is the most uncertain, among the cells which have not reached
+    `max_shots_per_cell` nor `target_relative_interval_width`. Returns None if there is no such cell.
+    '''
+    candidates = [
+        c for c in cells
+        if c.num_shots() + c.num_shots_in_flight < max_shots_per_cell and
+        c.projected_relative_interval_width() > target_relative_interval_width
+    ]
+    if len(candidates) == 0:
+        return None
+    # Among cells with equally wide intervals (e.g., with no wrong samples), prefer the one with fewer shots.
+    return max(candidates,
+               key=lambda c: (c.projected_relative_interval_width(), -c.num_shots() - c.num_shots_in_flight))
+
+
+def run_sweep(
+        cells: list[Cell],
+        with_heuristic_gap_calculation: bool,
+        max_shots: int,
+        max_shots_per_cell: int,
+        num_shots_per_chunk: int,
+        target_relative_interval_width: float,
+        pool: WorkerPool,
+        show_progress: bool) -> None:
+    '''\
+    Runs chunks of `num_shots_per_chunk` shots for `cells` on `pool`, always giving the next chunk to the cell
+    chosen by `choose_next_cell`, until `max_shots` shots are run or no cell needs more shots.
+    '''
+    executor = pool.executor
+    cell_for_future: dict[concurrent.futures.Future, Cell] = {}
+    num_shots_submitted = 0
+    num_shots_done = 0
+
+    def submit() -> bool:
+        nonlocal num_shots_submitted
+        if num_shots_submitted >= max_shots:
+            return False
+        cell = choose_next_cell(cells, max_shots_per_cell, target_relative_interval_width)
+        if cell is None:
+            return False
+        assert cell.code is not None
+        assert cell.code.detector_for_complementary_gap is not None
+        num_shots = min(num_shots_per_chunk, max_shots - num_shots_submitted,
+                        max_shots_per_cell - cell.num_shots() - cell.num_shots_in_flight)
+        future = executor.submit(perform_simulation,
+                                 cell.code.primal_circuit,
+                                 cell.code.partially_noiseless_circuit,
+                                 num_shots,
+                                 cell.gap_threshold,
+                                 with_heuristic_gap_calculation,
+                                 cell.lookup_table,
+                                 cell.code.num_detectors_for_lookup_table,
+                                 cell.code.detector_for_complementary_gap,
+                                 spawn_seeds(cell.seed_sequence, 1)[0])
+        cell_for_future[future] = cell
+        cell.num_shots_in_flight += num_shots
+        num_shots_submitted += num_shots
+        return True
+
+    # Keep twice as many chunks as workers in flight, so that workers don't wait for the scheduler.
+    for _ in range(pool.parallelism * 2):
+        if not submit():
+            break
+    try:
+        while len(cell_for_future) > 0:
+            if show_progress:
+                print('Progress: {}/{}\r'.format(num_shots_done, max_shots), end='')
+            (done, _) = concurrent.futures.wait(
+                cell_for_future.keys(), timeout=None, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                cell = cell_for_future.pop(future)
+                results = future.result()
+                assert isinstance(results, SimulationResultsForGapThreshold)
+                cell.results.extend(results)
+                cell.new_results.extend(results)
+                cell.num_shots_in_flight -= len(results)
+                num_shots_done += len(results)
+            while len(cell_for_future) < pool.parallelism * 2:
+                if not submit():
+                    break
+        if show_progress:
+            print()
+    finally:
+        for future in cell_for_future:
+            future.cancel()
+
+
+def _parse_list(text: str, parse: type, name: str) -> list:
+    values = [v.strip() for v in text.split(',')]
+    try:
+        return [parse(v) for v in values]
+    except ValueError:
+        raise ValueError('Invalid --{}: {}'.format(name, text))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='description')
+    parser.add_argument('--error-probabilities', type=str, required=True)
+    parser.add_argument('--surface-intermediate-distances', type=str, default=None)
+    parser.add_argument('--surface-final-distances', type=str, default='3')
+    parser.add_argument('--initial-values', type=str, default='+')
+    parser.add_argument('--steane-syndrome-extraction-patterns', type=str, default='ZXZ')
+    parser.add_argument('--gap-thresholds', type=str, required=True)
+    parser.add_argument('--perfect-initialization', action='store_true')
+    parser.add_argument('--with-heuristic-post-selection', action='store_true')
+    parser.add_argument('--with-heuristic-gap-calculation', action='store_true')
+    parser.add_argument('--full-post-selection', action='store_true')
+    parser.add_argument('--num-stabilization-rounds-after-surgery', type=int, default=3)
+    parser.add_argument('--num-epilogue-syndrome-extraction-rounds', type=int, default=10)
+    parser.add_argument('--max-shots', type=int, default=10 ** 6, help='in total')
+    parser.add_argument('--max-shots-per-cell', type=int, default=10 ** 6)
+    parser.add_argument('--shots-per-chunk', type=int, default=10 ** 4)
+    parser.add_argument('--target-relative-interval-width', type=float, default=0.2)
+    parser.add_argument('--parallelism', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--show-progress', action='store_true')
+    parser.add_argument('--results-db', type=str, default='results.db',
+                        help='accumulate the results of the cells here, and count them towards the limits')
+    parser.add_argument('--no-results-db', action='store_true')
+
+    args = parser.parse_args()
+
+    seed: int
+    if args.seed is None:
+        seed = random.randrange(0, 2 ** 32)
+    else:
+        seed = args.seed
+
+    print('  error-probabilities = {}'.format(args.error_probabilities))
+    print('  surface-intermediate-distances = {}'.format(args.surface_intermediate_distances))
+    print('  surface-final-distances = {}'.format(args.surface_final_distances))
+    print('  initial-values = {}'.format(args.initial_values))
+    print('  steane-syndrome-extraction-patterns = {}'.format(args.steane_syndrome_extraction_patterns))
+    print('  gap-thresholds = {}'.format(args.gap_thresholds))
+    print('  perfect-initialization = {}'.format(args.perfect_initialization))
+    print('  with-heuristic-post-selection = {}'.format(args.with_heuristic_post_selection))
+    print('  with-heuristic-gap-calculation = {}'.format(args.with_heuristic_gap_calculation))
+    print('  full-post-selection = {}'.format(args.full_post_selection))
+    print('  num-stabilization-rounds-after-surgery = {}'.format(args.num_stabilization_rounds_after_surgery))
+    print('  num-epilogue-syndrome-extraction-rounds = {}'.format(args.num_epilogue_syndrome_extraction_rounds))
+    print('  max-shots = {}'.format(args.max_shots))
+    print('  max-shots-per-cell = {}'.format(args.max_shots_per_cell))
+    print('  shots-per-chunk = {}'.format(args.shots_per_chunk))
+    print('  target-relative-interval-width = {}'.format(args.target_relative_interval_width))
+    print('  parallelism = {}'.format(args.parallelism))
+    if args.seed is None:
+        print('  seed = None ({})'.format(seed))
+    else:
+        print('  seed = {}'.format(seed))
+    print('  show-progress = {}'.format(args.show_progress))
+    print('  results-db = {}'.format(None if args.no_results_db else args.results_db))
+
+    initial_values = {'+': InitialValue.Plus, '0': InitialValue.Zero, 'S+': InitialValue.SPlus}
+    patterns = {
+        'XZZ': SteaneSyndromeExtractionPattern.XZZ,
+        'ZXZ': SteaneSyndromeExtractionPattern.ZXZ,
+        'ZZ': SteaneSyndromeExtractionPattern.ZZ,
+    }
+    try:
+        error_probabilities: list[float] = _parse_list(args.error_probabilities, float, 'error-probabilities')
+        surface_final_distances: list[int] = _parse_list(args.surface_final_distances, int, 'surface-final-distances')
+        surface_intermediate_distances: list[int | None] = [None]
+        if args.surface_intermediate_distances is not None:
+            surface_intermediate_distances = _parse_list(
+                args.surface_intermediate_distances, int, 'surface-intermediate-distances')
+        gap_thresholds: list[float] = _parse_list(args.gap_thresholds, float, 'gap-thresholds')
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return
+    if not re.compile(r'^(\+|0|S\+)(,(\+|0|S\+))*$').match(args.initial_values):
+        print('Error: --initial-values must be a comma-separated list of +, 0 and S+.', file=sys.stderr)
+        return
+    if not re.compile(r'^(XZZ|ZXZ|ZZ)(,(XZZ|ZXZ|ZZ))*$').match(args.steane_syndrome_extraction_patterns):
+        print('Error: --steane-syndrome-extraction-patterns must be a comma-separated list of XZZ, ZXZ and ZZ.',
+              file=sys.stderr)
+        return
+    perfect_initialization: bool = args.perfect_initialization
+    with_heuristic_post_selection: bool = args.with_heuristic_post_selection
+    with_heuristic_gap_calculation: bool = args.with_heuristic_gap_calculation
+    full_post_selection: bool = args.full_post_selection
+    num_stabilization_rounds_after_surgery: int = args.num_stabilization_rounds_after_surgery
+    num_epilogue_syndrome_extraction_rounds: int = args.num_epilogue_syndrome_extraction_rounds
+
+    cells: list[Cell] = []
+    for (error_probability, intermediate_distance, final_distance, initial_value, pattern, gap_threshold) in \
+            itertools.product(error_probabilities, surface_intermediate_distances, surface_final_distances,
+                              args.initial_values.split(','), args.steane_syndrome_extraction_patterns.split(','),
+                              gap_thresholds):
+        if not perfect_initialization and initial_value != 'S+':
+            print('Skipping initial-value = {}: perfect-initialization=False is supported only for S+.'.format(
+                initial_value))
+            continue
+        cells.append(Cell(
+            len(cells), error_probability, intermediate_distance or final_distance, final_distance,
+            initial_values[initial_value], patterns[pattern], gap_threshold, seed))
+
+    # Holds the memory-mapped lookup tables during the sweep.
+    lookup_table_dir = tempfile.TemporaryDirectory()
+    with sqlite3.connect('lookup_table.db') as lookup_table_con:
+        ensure_lookup_tables_table(lookup_table_con)
+        for cell in cells:
+            cell.code = SteanePlusSurfaceCode(
+                QubitMapping(30, 40), cell.surface_intermediate_distance, cell.surface_final_distance,
+                cell.initial_value, cell.steane_syndrome_extraction_pattern, perfect_initialization,
+                cell.error_probability, with_heuristic_post_selection, full_post_selection,
+                num_stabilization_rounds_after_surgery, num_epilogue_syndrome_extraction_rounds, False)
+            cell.code.run()
+            lookup_table_key = LookupTableKey(
+                error_probability=cell.error_probability,
+                surface_intermediate_distance=cell.surface_intermediate_distance,
+                surface_final_distance=cell.surface_final_distance,
+                initial_value=cell.initial_value.name,
+                steane_syndrome_extraction_pattern=cell.steane_syndrome_extraction_pattern.name,
+                perfect_initialization=perfect_initialization,
+                with_heuristic_post_selection=with_heuristic_post_selection,
+                with_heuristic_gap_calculation=with_heuristic_gap_calculation,
+                full_post_selection=full_post_selection,
+                num_stabilization_rounds_after_surgery=num_stabilization_rounds_after_surgery,
+                num_epilogue_syndrome_extraction_rounds=num_epilogue_syndrome_extraction_rounds,
+                gap_threshold=cell.gap_threshold)
+            lookup_table = query_lookup_table(lookup_table_con, lookup_table_key)
+            cell.results_config = dict(
+                asdict(lookup_table_key), lookup_table_sizes=[None if lookup_table is None else len(lookup_table)])
+            if lookup_table is not None:
+                # Chunks carry only the path of the table, which the workers memory-map.
+                cell.lookup_table = SortedArrayLookupTable.create(
+                    os.path.join(lookup_table_dir.name, '{}.npy'.format(cell.index)), lookup_table,
+                    cell.code.num_detectors_for_lookup_table)
+
+    results_db_path: str | None = None if args.no_results_db else args.results_db
+    if results_db_path is not None:
+        with sqlite3.connect(results_db_path) as results_con:
+            ensure_results_table(results_con)
+            load_accumulated_results(results_con, cells, seed)
+        print('{} shots are accumulated in {}.'.format(sum([c.num_shots() for c in cells]), results_db_path))
+
+    print('Running {} cells...'.format(len(cells)))
+    with WorkerPool(args.parallelism) as pool:
+        run_sweep(cells, with_heuristic_gap_calculation, args.max_shots, args.max_shots_per_cell,
+                  args.shots_per_chunk, args.target_relative_interval_width, pool, args.show_progress)
+    lookup_table_dir.cleanup()
+
+    if results_db_path is not None:
+        with sqlite3.connect(results_db_path) as results_con:
+            store_new_results(results_con, cells, seed)
+        print('Stored the results of {} shots in {}.'.format(
+            sum([len(c.new_results) for c in cells]), results_db_path))
+
+    for cell in cells:
+        entry = cell.results.entry_with_lookup_table()
+        (num_wrong, num_accepted) = cell.counts()
+        print(cell.description())
+        print('  lookup table size = {}'.format(None if cell.lookup_table is None else len(cell.lookup_table)))
+        print('  VALID = {}, WRONG = {}, DISCARDED = {}'.format(
+            entry.num_valid_samples(), num_wrong, entry.num_discarded_samples()))
+        if num_accepted > 0:
+            (lower, upper) = wilson_interval(num_wrong, num_accepted)
+            print('  WRONG / (VALID + WRONG) = {:.3e} ([{:.3e}, {:.3e}])'.format(
+                num_wrong / num_accepted, lower, upper))
+    print()
+
+
+if __name__ == '__main__':
+    main()
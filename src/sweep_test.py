@@ -0,0 +1,101 @@
+import math
+import sqlite3
+import unittest
+
+from lattice_surgery_complementary_gap import SyndromeExtractionRound
+from sweep import *
+
+
+class IntervalTest(unittest.TestCase):
+    def test_wilson_interval(self) -> None:
+        (lower, upper) = wilson_interval(10, 100)
+        self.assertAlmostEqual(lower, 0.05523, places=4)
+        self.assertAlmostEqual(upper, 0.17437, places=4)
+
+        (lower, upper) = wilson_interval(0, 100)
+        self.assertEqual(lower, 0)
+        self.assertAlmostEqual(upper, 0.03699, places=4)
+
+        self.assertEqual(wilson_interval(0, 0), (0, 1))
+
+    def test_relative_interval_width(self) -> None:
+        self.assertEqual(relative_interval_width(0, 100), math.inf)
+        self.assertAlmostEqual(relative_interval_width(10, 100), (0.17437 - 0.05523) / 0.1, places=3)
+        # More wrong samples give a narrower interval relative to the estimate.
+        self.assertLess(relative_interval_width(100, 10000), relative_interval_width(10, 1000))
+
+
+class ChooseNextCellTest(unittest.TestCase):
+    def _new_cell(self, index: int, num_valid: int, num_wrong: int) -> Cell:
+        cell = Cell(index, 1e-3, 3, 3, InitialValue.SPlus, SteaneSyndromeExtractionPattern.ZXZ, 1, 0)
+        r = SyndromeExtractionRound('Round0', 0)
+        for _ in range(num_valid):
+            cell.results.add(10, True, False, r, r)
+        for _ in range(num_wrong):
+            cell.results.add(10, False, False, r, r)
+        return cell
+
+    def test_widest_interval(self) -> None:
+        cell0 = self._new_cell(0, 1000, 100)
+        cell1 = self._new_cell(1, 1000, 10)
+        cell2 = self._new_cell(2, 1000, 30)
+        self.assertIs(choose_next_cell([cell0, cell1, cell2], 10 ** 6, 0), cell1)
+
+    def test_no_wrong_samples(self) -> None:
+        cell0 = self._new_cell(0, 1000, 1)
+        cell1 = self._new_cell(1, 1000, 0)
+        cell2 = self._new_cell(2, 100, 0)
+        self.assertIs(choose_next_cell([cell0, cell1, cell2], 10 ** 6, 0), cell2)
+
+    def test_shots_in_flight(self) -> None:
+        cell0 = self._new_cell(0, 1000, 10)
+        cell1 = self._new_cell(1, 1000, 20)
+        self.assertIs(choose_next_cell([cell0, cell1], 10 ** 6, 0), cell0)
+        cell0.num_shots_in_flight = 10000
+        self.assertIs(choose_next_cell([cell0, cell1], 10 ** 6, 0), cell1)
+
+    def test_limits(self) -> None:
+        cell0 = self._new_cell(0, 1000, 10)
+        cell1 = self._new_cell(1, 100, 50)
+        self.assertIs(choose_next_cell([cell0, cell1], 10 ** 6, 0), cell0)
+        self.assertIs(choose_next_cell([cell0, cell1], 1000, 0), cell1)
+        self.assertIs(choose_next_cell([cell0, cell1], 10 ** 6, relative_interval_width(50, 150)), cell0)
+        self.assertIsNone(choose_next_cell([cell0, cell1], 10 ** 6, 100))
+
+
+class ResultsDbTest(unittest.TestCase):
+    def _new_cell(self, index: int, gap_threshold: float) -> Cell:
+        cell = Cell(index, 1e-3, 3, 3, InitialValue.SPlus, SteaneSyndromeExtractionPattern.ZXZ, gap_threshold, 0)
+        cell.results_config = {'gap_threshold': gap_threshold, 'lookup_table_sizes': [None]}
+        return cell
+
+    def _add(self, cell: Cell, num_valid: int) -> None:
+        r = SyndromeExtractionRound('Round0', 0)
+        for _ in range(num_valid):
+            cell.results.add(10, True, False, r, r)
+            cell.new_results.add(10, True, False, r, r)
+
+    def test_top_up(self) -> None:
+        con = sqlite3.connect(':memory:')
+        ensure_results_table(con)
+        cells = [self._new_cell(0, 1), self._new_cell(1, 2)]
+        load_accumulated_results(con, cells, 10)
+        self.assertEqual([c.num_shots() for c in cells], [0, 0])
+        self._add(cells[0], 30)
+        store_new_results(con, cells, 10)
+
+        # A run with another seed counts the accumulated shots, and stores only its own.
+        cells = [self._new_cell(0, 1), self._new_cell(1, 2)]
+        load_accumulated_results(con, cells, 11)
+        self.assertEqual([c.num_shots() for c in cells], [30, 0])
+        self.assertIsNone(choose_next_cell(cells[:1], 30, 0))
+        self._add(cells[0], 20)
+        self._add(cells[1], 5)
+        store_new_results(con, cells, 11)
+        self.assertEqual([r.num_shots for r in query_results(con, {'gap_threshold': 1, 'lookup_table_sizes': [None]})],
+                         [30, 20])
+
+        # A run with the same seed replaces the results stored for it.
+        cells = [self._new_cell(0, 1), self._new_cell(1, 2)]
+        load_accumulated_results(con, cells, 11)
+        self.assertEqual([c.num_shots() for c in cells], [30, 0])
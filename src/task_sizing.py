@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import math
+import stim
+import time
+
+from collections.abc import Callable
+from typing import Any, TypeVar
+
+T = TypeVar('T')
+
+
+class TaskSizer:
+    '''\
+    Decides the number of shots of each task of a parallel simulation of `num_shots` shots.
+
+    Without `target_task_duration`, every task has min(max_shots_per_task, ceil(num_shots / parallelism)) shots.
+
+    With `target_task_duration` (in seconds), the first tasks are small probes with `min_shots_per_task` shots,
+    and later tasks are sized from the measured cost per shot (see `record()`) so that each takes about
+    `target_task_duration` seconds. A task grows at most fourfold over the largest measured one, so a noisy
+    probe doesn't produce a huge task. Towards the end, a task has at most 1 / (2 * parallelism) of the
+    remaining shots, so that the workers finish at about the same time.
+    '''
+    def __init__(
+            self,
+            num_shots: int,
+            parallelism: int,
+            max_shots_per_task: int,
+            target_task_duration: float | None = None,
+            min_shots_per_task: int = 1000) -> None:
+        assert num_shots >= 0
+        assert parallelism > 0
+        assert max_shots_per_task > 0
+        assert target_task_duration is None or target_task_duration > 0
+        assert min_shots_per_task > 0
+        self.remaining_shots = num_shots
+        self.parallelism = parallelism
+        self.max_shots_per_task = max_shots_per_task
+        self.target_task_duration = target_task_duration
+        self.min_shots_per_task = min(min_shots_per_task, max_shots_per_task)
+        self._static_num_shots_per_task = min(max_shots_per_task, (num_shots + parallelism - 1) // parallelism)
+        self._num_measured_shots = 0
+        self._measured_duration = 0.0
+        self._largest_measured_task = 0
+
+    def next_task_size(self) -> int:
+        '''Returns the number of shots of the next task, and counts them as scheduled. Returns 0 when done.'''
+        if self.remaining_shots == 0:
+            return 0
+        if self.target_task_duration is None:
+            size = self._static_num_shots_per_task
+        else:
+            if self._num_measured_shots == 0:
+                size = self.min_shots_per_task
+            else:
+                cost_per_shot = self._measured_duration / self._num_measured_shots
+                size = self.max_shots_per_task
+                if cost_per_shot > 0:
+                    size = min(size, int(self.target_task_duration / cost_per_shot))
+                size = min(size, 4 * self._largest_measured_task)
+            size = min(size, math.ceil(self.remaining_shots / (2 * self.parallelism)))
+            size = max(size, self.min_shots_per_task)
+        size = min(size, self.max_shots_per_task, self.remaining_shots)
+        self.remaining_shots -= size
+        return size
+
+    def record(self, num_shots: int, duration: float) -> None:
+        '''Records that a task with `num_shots` shots took `duration` seconds.'''
+        self._num_measured_shots += num_shots
+        self._measured_duration += duration
+        self._largest_measured_task = max(self._largest_measured_task, num_shots)
+
+
+def runs_serially(num_shots: int, parallelism: int, target_task_duration: float | None) -> bool:
+    '''\
+    Returns whether a simulation is too small to be worth parallelizing. With static sizing, a worker
+    should get at least 1000 shots. With `target_task_duration`, tasks start small anyway, so only a
+    simulation fitting in a single probe runs serially.
+    '''
+    if parallelism == 1:
+        return True
+    if target_task_duration is None:
+        return num_shots / parallelism < 1000
+    return num_shots <= 1000
+
+
+def max_shots_for_memory(memory_budget: int, circuit: stim.Circuit) -> int:
+    '''\
+    Returns the number of shots whose detection events and observable flips of `circuit` fit in
+    `memory_budget` bytes. Samplers return them as boolean arrays, one byte per bit.
+    '''
+    bytes_per_shot = max(1, circuit.num_detectors + circuit.num_observables)
+    return max(1, memory_budget // bytes_per_shot)
+
+
+def timed(f: Callable[..., T], *args: Any) -> tuple[float, T]:
+    '''Calls `f(*args)` and returns the elapsed time in seconds with the result. Submit this to measure tasks.'''
+    start = time.perf_counter()
+    result = f(*args)
+    return (time.perf_counter() - start, result)
@@ -0,0 +1,75 @@
+import stim
+import unittest
+
+from task_sizing import *
+
+
+def _sizes(sizer: TaskSizer) -> list[int]:
+    sizes: list[int] = []
+    while (size := sizer.next_task_size()) > 0:
+        sizes.append(size)
+    return sizes
+
+
+class TaskSizerTest(unittest.TestCase):
+    def test_static(self) -> None:
+        self.assertEqual(_sizes(TaskSizer(10_000, 4, 2 ** 20)), [2500, 2500, 2500, 2500])
+        self.assertEqual(_sizes(TaskSizer(10_000, 4, 3000)), [2500, 2500, 2500, 2500])
+        self.assertEqual(_sizes(TaskSizer(10_000, 2, 3000)), [3000, 3000, 3000, 1000])
+        self.assertEqual(_sizes(TaskSizer(0, 2, 3000)), [])
+
+    def test_probes(self) -> None:
+        sizer = TaskSizer(1_000_000, 2, 2 ** 20, target_task_duration=1.0)
+        self.assertEqual([sizer.next_task_size() for _ in range(4)], [1000, 1000, 1000, 1000])
+        self.assertEqual(sizer.remaining_shots, 996_000)
+
+    def test_target_task_duration(self) -> None:
+        sizer = TaskSizer(100_000_000, 2, 2 ** 20, target_task_duration=1.0)
+        self.assertEqual(sizer.next_task_size(), 1000)
+        # 128,000 shots per second, but a task grows at most fourfold.
+        sizer.record(1000, 1000 / 128_000)
+        self.assertEqual(sizer.next_task_size(), 4000)
+        sizer.record(4000, 4000 / 128_000)
+        self.assertEqual(sizer.next_task_size(), 16_000)
+        sizer.record(16_000, 16_000 / 128_000)
+        self.assertEqual(sizer.next_task_size(), 64_000)
+        sizer.record(64_000, 64_000 / 128_000)
+        self.assertEqual(sizer.next_task_size(), 128_000)
+        # The cost per shot is averaged over all measured shots: 170,000 shots in 2.25 seconds.
+        sizer.record(85_000, 1.5859375)
+        self.assertEqual(sizer.next_task_size(), 75_555)
+
+    def test_max_shots_per_task(self) -> None:
+        sizer = TaskSizer(100_000_000, 2, 5000, target_task_duration=1.0)
+        sizer.record(1000, 0.0)
+        self.assertEqual(sizer.next_task_size(), 4000)
+        sizer.record(4000, 0.0)
+        self.assertEqual(sizer.next_task_size(), 5000)
+
+    def test_tail(self) -> None:
+        sizer = TaskSizer(100_000, 2, 2 ** 20, target_task_duration=1000.0)
+        sizer.record(1000, 0.001)
+        sizes = _sizes(sizer)
+        self.assertEqual(sum(sizes), 100_000)
+        # Tasks get smaller towards the end.
+        self.assertEqual(sizes[:22], [4000] * 22)
+        self.assertEqual(sizes[22:], [3000, 2250, 1688, 1266, 1000, 1000, 1000, 796])
+
+    def test_max_shots_for_memory(self) -> None:
+        circuit = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=2)
+        bytes_per_shot = circuit.num_detectors + circuit.num_observables
+        self.assertEqual(max_shots_for_memory(bytes_per_shot * 10, circuit), 10)
+        self.assertEqual(max_shots_for_memory(bytes_per_shot * 10 + 1, circuit), 10)
+        self.assertEqual(max_shots_for_memory(1, circuit), 1)
+
+    def test_timed(self) -> None:
+        (duration, result) = timed(max, 3, 4)
+        self.assertEqual(result, 4)
+        self.assertGreaterEqual(duration, 0)
+
+    def test_runs_serially(self) -> None:
+        self.assertTrue(runs_serially(10 ** 6, 1, None))
+        self.assertTrue(runs_serially(3999, 4, None))
+        self.assertFalse(runs_serially(4000, 4, None))
+        self.assertTrue(runs_serially(1000, 4, 60.0))
+        self.assertFalse(runs_serially(1001, 4, 60.0))
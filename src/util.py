@@ -1,13 +1,44 @@
 from __future__ import annotations
 
 
+import numpy as np
 import stim
 
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
 from typing import Any
 
 
 POST_SELECTION_TAG: str = 'POST-SELECTION'
 
+# Instructions that don't use qubits, in terms of qubit usage.
+_ANNOTATION_GATES = {
+    'DETECTOR',
+    'MPAD',
+    'OBSERVABLE_INCLUDE',
+    'QUBIT_COORDS',
+    'SHIFT_COORDS',
+    'TICK'
+}
+# Measurement gates, each target of which is a measurement.
+_SINGLE_QUBIT_MEASUREMENT_GATES = {'M', 'MX', 'MY', 'MZ', 'MR', 'MRX', 'MRY', 'MRZ'}
+_ERROR_GATES = {
+    'CORRELATED_ERROR',
+    'DEPOLARIZE1',
+    'DEPOLARIZE2',
+    'E',
+    'ELSE_CORRELATED_ERROR',
+    'HERALDED_ERASE',
+    'HERALDED_PAULI_CHANNEL_1',
+    'II_ERROR',
+    'I_ERROR',
+    'PAULI_CHANNEL_1',
+    'PAULI_CHANNEL_2',
+    'X_ERROR',
+    'Y_ERROR',
+    'Z_ERROR'
+}
+
 
 class QubitMapping:
     '''A mapping between qubit IDs and coordinates.'''
@@ -28,52 +59,93 @@ class QubitMapping:
                 if x % 2 == 1 and y % 2 == 1:
                     self.mapping.append((id, (x, y)))
                     id += 1
+        self._ids: dict[tuple[int, int], int] = {position: id for (id, position) in self.mapping}
 
     def get_id(self, x: int, y: int) -> int:
         '''Returns the qubit ID for the given coordinate.'''
-        for id, (qx, qy) in self.mapping:
-            if x == qx and y == qy:
-                return id
-        raise ValueError(f'Qubit ({x}, {y}) not found in mapping.')
+        id = self._ids.get((x, y))
+        if id is None:
+            raise ValueError(f'Qubit ({x}, {y}) not found in mapping.')
+        return id
 
 
+@dataclass(frozen=True, slots=True)
 class MeasurementIdentifier:
     '''Representing a Stim measurement ID.'''
-    def __init__(self, id: int):
-        self.id = id
-
-    def __eq__(self, other: object):
-        if not isinstance(other, MeasurementIdentifier):
-            return False
-        return self.id == other.id
+    id: int
 
     def target_rec(self, circuit: Circuit) -> Any:
-        return stim.target_rec(self.id - circuit.circuit.num_measurements)
+        return stim.target_rec(self.id - circuit._num_measurements())
 
 
+@dataclass(frozen=True, slots=True)
 class DetectorIdentifier:
     '''Representing a Stim detector event ID.'''
-    def __init__(self, id: int):
-        self.id = id
+    id: int
 
-    def __eq__(self, other: object):
-        if not isinstance(other, DetectorIdentifier):
-            return False
-        return self.id == other.id
-
-    def __str__(self):
+    def __str__(self) -> str:
         return f'DetectorIdentifier({self.id})'
 
 
+@dataclass(frozen=True, slots=True)
 class ObservableIdentifier:
     '''Representing a Stim observable ID.'''
-    def __init__(self, id: int):
-        self.id = id
+    id: int
+
+
+@dataclass
+class DetectorMetadata:
+    '''\
+    A columnar table describing the detectors and the layering ticks of a circuit.
+
+    Each layering tick closes a round. `round_detector_ends[i]` is the number of
+    detectors placed before the i-th layering tick, and `round_qubit_usage[i]`
+    tells which qubits are used between the previous layering tick and the i-th
+    one. `detector_rounds[j]` is the index of the round that the j-th detector
+    belongs to, or -1 if no layering tick follows the detector.
+    '''
+    round_labels: list[str]
+    round_detector_ends: np.ndarray
+    round_qubit_usage: np.ndarray
+    detector_rounds: np.ndarray
+    tag_names: list[str]
+    detector_tags: np.ndarray
+    detector_post_selection: np.ndarray
 
-    def __eq__(self, other: object):
-        if not isinstance(other, ObservableIdentifier):
-            return False
-        return self.id == other.id
+    def detector_tag(self, detector_index: int) -> str:
+        return self.tag_names[self.detector_tags[detector_index]]
+
+
+class _InstructionRecorder:
+    '''\
+    Records the instructions appended to a Circuit while its emission is suppressed (see `place_repeated()`),
+    without building a stim circuit, and counts the measurements, detectors and observables among them.
+    '''
+    def __init__(self) -> None:
+        self.instructions: list[tuple[str, list[Any], Any, str]] = []
+        self.num_measurements = 0
+        self.num_detectors = 0
+        self.num_observables = 0
+
+    def append(self, name: str, targets: Any, arg: Any, tag: str) -> None:
+        targets = list(targets) if isinstance(targets, (list, tuple)) else [targets]
+        self.instructions.append((name, targets, arg, tag))
+        if name in _SINGLE_QUBIT_MEASUREMENT_GATES:
+            self.num_measurements += len(targets)
+        elif name == 'MPP':
+            # A product is a Pauli string, or Pauli targets joined by combiners.
+            num_combiners = sum(1 for t in targets if isinstance(t, stim.GateTarget) and t.is_combiner)
+            self.num_measurements += len(targets) - 2 * num_combiners
+        elif name == 'DETECTOR':
+            self.num_detectors += 1
+        elif name == 'OBSERVABLE_INCLUDE':
+            self.num_observables = max(self.num_observables, int(arg) + 1)
+
+    def to_stim_circuit(self) -> stim.Circuit:
+        circuit = stim.Circuit()
+        for (name, targets, arg, tag) in self.instructions:
+            circuit.append(name, targets, arg, tag=tag)
+        return circuit
 
 
 class Circuit:
@@ -95,23 +167,117 @@ class Circuit:
             self.circuit.append('QUBIT_COORDS', id, (x, y))
         self.noiseless_qubits: list[int] = []
         self.tainted_qubits: list[int] = []
-        self.detectors_for_post_selection: list[DetectorIdentifier] = []
+        # The IDs of the detectors for post-selection are stored in the prefix of a buffer that grows
+        # geometrically. See `post_selection_ids`.
+        self._post_selection_ids = np.zeros(64, dtype='uint')
+        self._num_post_selection_ids = 0
+        # Detector metadata, recorded by scanning the instructions incrementally. We scan instructions
+        # instead of hooking the placement methods, because some callers append instructions to the stim
+        # circuit directly. See `detector_metadata()`.
+        self._num_scanned_instructions = 0
+        self._qubits_in_use = np.zeros(len(mapping.mapping), dtype=bool)
+        self._round_labels: list[str] = []
+        self._round_detector_ends: list[int] = []
+        self._round_qubit_usage: list[np.ndarray] = []
+        self._detector_tags: list[str] = []
+        # While the emission is suppressed (see `place_repeated()`), instructions go to `_recorder` instead of
+        # `circuit`, and the measurements and the detectors of the suppressed instructions recorded before are
+        # counted.
+        self._recorder: _InstructionRecorder | None = None
+        self._num_suppressed_measurements = 0
+        self._num_suppressed_detectors = 0
+
+    def _append(self, name: str, targets: Any = (), arg: Any = None, tag: str = '') -> None:
+        if self._recorder is None:
+            self.circuit.append(name, targets, arg, tag=tag)
+        else:
+            self._recorder.append(name, targets, arg, tag)
 
     def place_tick(self) -> None:
         '''Adds idling noise, and places a TICK virtual gate.'''
         if self.error_probability > 0:
-            for id, (x, y) in self.mapping.mapping:
-                if id in self.tainted_qubits:
-                    continue
-                if id in self.noiseless_qubits:
-                    continue
-                self.circuit.append('DEPOLARIZE1', id, self.error_probability)
+            excluded = set(self.tainted_qubits) | set(self.noiseless_qubits)
+            targets = [id for id, _ in self.mapping.mapping if id not in excluded]
+            if len(targets) > 0:
+                self._append('DEPOLARIZE1', targets, self.error_probability)
         self.tainted_qubits.clear()
-        self.circuit.append('TICK')
+        self._append('TICK')
 
     def place_layering_tick(self, tag: str) -> None:
         '''Places a TICK virtual gate for layering. This does not add idling noise.'''
-        self.circuit.append('TICK', tag=tag)
+        self._append('TICK', tag=tag)
+        self._scan_instructions()
+
+    @property
+    def post_selection_ids(self) -> np.ndarray:
+        '''\
+        Returns the IDs of the detectors for post-selection as a read-only NumPy array, which can be used
+        to index detection events directly.
+        '''
+        ids = self._post_selection_ids[:self._num_post_selection_ids]
+        ids.flags.writeable = False
+        return ids
+
+    @property
+    def detectors_for_post_selection(self) -> list[DetectorIdentifier]:
+        '''Returns the detectors for post-selection.'''
+        return [DetectorIdentifier(int(id)) for id in self.post_selection_ids]
+
+    def detector_metadata(self) -> DetectorMetadata:
+        '''Returns the metadata of the detectors and layering ticks placed so far.'''
+        self._scan_instructions()
+        num_detectors = len(self._detector_tags)
+        ends = np.array(self._round_detector_ends, dtype=np.int64)
+        detector_rounds = np.searchsorted(ends, np.arange(num_detectors), side='right')
+        detector_rounds[detector_rounds == len(ends)] = -1
+        tag_names = sorted(set(self._detector_tags))
+        codes = {tag: i for (i, tag) in enumerate(tag_names)}
+        post_selection = np.zeros(num_detectors, dtype=bool)
+        post_selection[self.post_selection_ids] = True
+        if len(self._round_qubit_usage) > 0:
+            usage = np.array(self._round_qubit_usage)
+        else:
+            usage = np.zeros((0, len(self._qubits_in_use)), dtype=bool)
+        return DetectorMetadata(
+            round_labels=list(self._round_labels),
+            round_detector_ends=ends,
+            round_qubit_usage=usage,
+            detector_rounds=detector_rounds,
+            tag_names=tag_names,
+            detector_tags=np.array([codes[tag] for tag in self._detector_tags], dtype=np.int32),
+            detector_post_selection=post_selection)
+
+    def _scan_instructions(self) -> None:
+        if self._num_scanned_instructions == len(self.circuit):
+            return
+        for inst in flattened_instructions(self.circuit[self._num_scanned_instructions:]):
+            name = inst.name
+            if name == 'TICK':
+                if inst.tag != '':
+                    self._round_labels.append(inst.tag)
+                    self._round_detector_ends.append(len(self._detector_tags))
+                    self._round_qubit_usage.append(self._qubits_in_use.copy())
+                    self._qubits_in_use[:] = False
+            elif name == 'DETECTOR':
+                self._detector_tags.append(inst.tag)
+            elif name not in _ANNOTATION_GATES and name not in _ERROR_GATES:
+                for target in inst.targets_copy():
+                    if target.is_combiner:
+                        continue
+                    if target.is_qubit_target or target.is_x_target or target.is_y_target or target.is_z_target:
+                        self._qubits_in_use[target.value] = True
+                    else:
+                        raise ValueError('Unsupported gate target')
+        self._num_scanned_instructions = len(self.circuit)
+
+    def _append_post_selection_ids(self, ids: np.ndarray) -> None:
+        size = self._num_post_selection_ids + len(ids)
+        if size > len(self._post_selection_ids):
+            buffer = np.zeros(max(size, 2 * len(self._post_selection_ids)), dtype='uint')
+            buffer[:self._num_post_selection_ids] = self._post_selection_ids[:self._num_post_selection_ids]
+            self._post_selection_ids = buffer
+        self._post_selection_ids[self._num_post_selection_ids:size] = ids
+        self._num_post_selection_ids = size
 
     def is_tainted_by_id(self, id: int) -> bool:
         '''\
@@ -138,9 +304,9 @@ class Circuit:
         target = self.mapping.get_id(*target_position)
         if target in self.tainted_qubits:
             raise ValueError(f'Cannot place {gate} gate on tainted qubit.')
-        self.circuit.append(gate, target)
+        self._append(gate, target)
         if target not in self.noiseless_qubits and self.error_probability > 0:
-            self.circuit.append('DEPOLARIZE1', target, self.error_probability)
+            self._append('DEPOLARIZE1', target, self.error_probability)
         self.tainted_qubits.append(target)
 
     def place_cx(self, control_position: tuple[int, int], target_position: tuple[int, int]) -> None:
@@ -152,16 +318,16 @@ class Circuit:
         target = self.mapping.get_id(target_position[0], target_position[1])
         if control in self.tainted_qubits or target in self.tainted_qubits:
             raise ValueError(f'Cannot place CX gate on tainted qubits.')
-        self.circuit.append('CX', (control, target))
+        self._append('CX', (control, target))
         if self.error_probability > 0:
             if control in self.noiseless_qubits and target in self.noiseless_qubits:
                 pass
             elif control in self.noiseless_qubits:
-                self.circuit.append('DEPOLARIZE1', [target], self.error_probability)
+                self._append('DEPOLARIZE1', [target], self.error_probability)
             elif target in self.noiseless_qubits:
-                self.circuit.append('DEPOLARIZE1', [control], self.error_probability)
+                self._append('DEPOLARIZE1', [control], self.error_probability)
             else:
-                self.circuit.append('DEPOLARIZE2', [control, target], self.error_probability)
+                self._append('DEPOLARIZE2', [control, target], self.error_probability)
         self.tainted_qubits.append(control)
         self.tainted_qubits.append(target)
 
@@ -170,9 +336,9 @@ class Circuit:
         target = self.mapping.get_id(*target_position)
         if target in self.tainted_qubits:
             raise ValueError(f'Cannot place reset Z gate on tainted qubit.')
-        self.circuit.append('R', target)
+        self._append('R', target)
         if target not in self.noiseless_qubits and self.error_probability > 0:
-            self.circuit.append('X_ERROR', target, self.error_probability)
+            self._append('X_ERROR', target, self.error_probability)
         self.tainted_qubits.append(target)
 
     def place_reset_x(self, target_position: tuple[int, int]) -> None:
@@ -180,9 +346,9 @@ class Circuit:
         target = self.mapping.get_id(*target_position)
         if target in self.tainted_qubits:
             raise ValueError(f'Cannot place reset X gate on tainted qubit.')
-        self.circuit.append('RX', target)
+        self._append('RX', target)
         if target not in self.noiseless_qubits and self.error_probability > 0:
-            self.circuit.append('Z_ERROR', target, self.error_probability)
+            self._append('Z_ERROR', target, self.error_probability)
         self.tainted_qubits.append(target)
 
     def place_measurement_z(self, target_position: tuple[int, int]) -> MeasurementIdentifier:
@@ -191,11 +357,11 @@ class Circuit:
         if target in self.tainted_qubits:
             raise ValueError(f'Cannot place measurement Z gate on tainted qubit.')
         if target not in self.noiseless_qubits and self.error_probability > 0:
-            self.circuit.append('X_ERROR', target, self.error_probability)
+            self._append('X_ERROR', target, self.error_probability)
 
-        self.circuit.append('M', target)
+        self._append('M', target)
         self.tainted_qubits.append(target)
-        return MeasurementIdentifier(self.circuit.num_measurements - 1)
+        return self._new_measurement_identifier()
 
     def place_measurement_x(self, target_position: tuple[int, int]) -> MeasurementIdentifier:
         '''Places a measurement_x gate, and returns the measurement ID.'''
@@ -203,10 +369,10 @@ class Circuit:
         if target in self.tainted_qubits:
             raise ValueError(f'Cannot place measurement X gate on tainted qubit.')
         if target not in self.noiseless_qubits and self.error_probability > 0:
-            self.circuit.append('Z_ERROR', target, self.error_probability)
-        self.circuit.append('MX', target)
+            self._append('Z_ERROR', target, self.error_probability)
+        self._append('MX', target)
         self.tainted_qubits.append(target)
-        return MeasurementIdentifier(self.circuit.num_measurements - 1)
+        return self._new_measurement_identifier()
 
     def place_mpp(self, target: stim.PauliString) -> MeasurementIdentifier:
         '''Places a multi-qubit Pauli product measurement, and returns the measurement ID.'''
@@ -223,115 +389,410 @@ class Circuit:
                 continue
             match p:
                 case 1:  # X
-                    self.circuit.append('Z_ERROR', i, self.error_probability)
+                    self._append('Z_ERROR', i, self.error_probability)
                 case 2:  # Y
-                    self.circuit.append('Z_ERROR', i, self.error_probability)
+                    self._append('Z_ERROR', i, self.error_probability)
                 case 3:  # Z
-                    self.circuit.append('X_ERROR', i, self.error_probability)
+                    self._append('X_ERROR', i, self.error_probability)
                 case _:
                     raise ValueError(f'Invalid Pauli value {p} for qubit {i}.')
-        self.circuit.append('MPP', [target])
-        return MeasurementIdentifier(self.circuit.num_measurements - 1)
+        self._append('MPP', [target])
+        return self._new_measurement_identifier()
+
+    def place_reset_z_by_ids(self, targets: list[int]) -> None:
+        '''Places reset_z gates on the qubits with the given IDs, as a single instruction.'''
+        self._taint_by_ids(targets, 'reset Z')
+        self._append('R', targets)
+        self._append_noise_by_ids('X_ERROR', targets)
+
+    def place_reset_x_by_ids(self, targets: list[int]) -> None:
+        '''Places reset_x gates on the qubits with the given IDs, as a single instruction.'''
+        self._taint_by_ids(targets, 'reset X')
+        self._append('RX', targets)
+        self._append_noise_by_ids('Z_ERROR', targets)
+
+    def place_cx_by_ids(self, pairs: list[tuple[int, int]]) -> None:
+        '''\
+        Places CX gates on the given (control, target) pairs of qubit IDs, as a single instruction.
+        Unlike `place_cx()`, this method doesn't check nearest-neighbor connectivity.
+        '''
+        targets = [id for pair in pairs for id in pair]
+        self._taint_by_ids(targets, 'CX')
+        self._append('CX', targets)
+        if self.error_probability > 0:
+            noiseless = set(self.noiseless_qubits)
+            single: list[int] = []
+            double: list[int] = []
+            for (control, target) in pairs:
+                if control in noiseless and target in noiseless:
+                    pass
+                elif control in noiseless:
+                    single.append(target)
+                elif target in noiseless:
+                    single.append(control)
+                else:
+                    double += [control, target]
+            if len(single) > 0:
+                self._append('DEPOLARIZE1', single, self.error_probability)
+            if len(double) > 0:
+                self._append('DEPOLARIZE2', double, self.error_probability)
+
+    def place_measurement_z_by_ids(self, targets: list[int]) -> list[MeasurementIdentifier]:
+        '''\
+        Places measurement_z gates on the qubits with the given IDs, as a single instruction, and
+        returns the measurement IDs in the order of `targets`.
+        '''
+        self._taint_by_ids(targets, 'measurement Z')
+        self._append_noise_by_ids('X_ERROR', targets)
+        self._append('M', targets)
+        return self._new_measurement_identifiers(len(targets))
+
+    def place_measurement_x_by_ids(self, targets: list[int]) -> list[MeasurementIdentifier]:
+        '''\
+        Places measurement_x gates on the qubits with the given IDs, as a single instruction, and
+        returns the measurement IDs in the order of `targets`.
+        '''
+        self._taint_by_ids(targets, 'measurement X')
+        self._append_noise_by_ids('Z_ERROR', targets)
+        self._append('MX', targets)
+        return self._new_measurement_identifiers(len(targets))
+
+    def _taint_by_ids(self, targets: list[int], gate: str) -> None:
+        tainted = set(self.tainted_qubits)
+        if any(target in tainted for target in targets) or len(set(targets)) != len(targets):
+            raise ValueError(f'Cannot place {gate} gate on tainted qubits.')
+        self.tainted_qubits.extend(targets)
+
+    def _append_noise_by_ids(self, noise: str, targets: list[int]) -> None:
+        if self.error_probability == 0:
+            return
+        noiseless = set(self.noiseless_qubits)
+        noisy = [target for target in targets if target not in noiseless]
+        if len(noisy) > 0:
+            self._append(noise, noisy, self.error_probability)
 
     def place_detector(
             self, measurements: list[MeasurementIdentifier], post_selection: bool = False,
             tag: str = '') -> DetectorIdentifier:
         '''Places a detector with the given measurements.'''
-        circuit = self.circuit
-        self.circuit.append('DETECTOR', [i.target_rec(self) for i in measurements], tag=tag)
-        id = DetectorIdentifier(self.circuit.num_detectors - 1)
+        self._append('DETECTOR', [i.target_rec(self) for i in measurements], tag=tag)
+        id = DetectorIdentifier(self._num_detectors() - 1)
         if post_selection:
-            self.detectors_for_post_selection.append(id)
+            self._append_post_selection_ids(np.array([id.id]))
         return id
 
+    def place_detectors(
+            self, measurements: np.ndarray | list[list[int]], post_selection: bool | np.ndarray = False,
+            tags: str | list[str] = '') -> list[DetectorIdentifier]:
+        '''\
+        Places detectors in a batch, and returns their IDs.
+
+        Each row of `measurements` holds the measurement IDs of a detector. Negative entries are
+        ignored, so that detectors with fewer measurements can be padded. `post_selection` and `tags`
+        are either shared by all the detectors or given per detector.
+        '''
+        rows = np.asarray(measurements, dtype=np.int64)
+        if rows.ndim == 1:
+            rows = rows.reshape(-1, 1)
+        n = len(rows)
+        if isinstance(tags, str):
+            tags = [tags] * n
+        assert len(tags) == n
+
+        num_measurements = self._num_measurements()
+        first = self._num_detectors()
+        for (row, tag) in zip(rows.tolist(), tags):
+            self._append('DETECTOR', [stim.target_rec(m - num_measurements) for m in row if m >= 0], tag=tag)
+
+        ids = [DetectorIdentifier(id) for id in range(first, first + n)]
+        self._append_post_selection_ids(np.arange(first, first + n)[np.broadcast_to(post_selection, (n,))])
+        return ids
+
     def place_observable_include(
             self,
             measurements: list[MeasurementIdentifier],
             id: ObservableIdentifier | None = None) -> ObservableIdentifier:
         '''Adds measurement records to a specified logical observable.'''
-        id = id or ObservableIdentifier(self.circuit.num_observables)
+        id = id or ObservableIdentifier(self._num_observables())
         targets = [m.target_rec(self) for m in measurements]
-        self.circuit.append('OBSERVABLE_INCLUDE', targets, id.id)
+        self._append('OBSERVABLE_INCLUDE', targets, id.id)
         return id
 
+    def place_repeated(self, count: int, body: Callable[[], None]) -> None:
+        '''\
+        Calls `body` `count` times. Once two consecutive calls emit identical
+        instructions, the following identical calls are emitted as a stim REPEAT
+        block.
+        See `place_repeated()` at the module level for details.
+        '''
+        place_repeated([self], count, body)
+
+    def _new_measurement_identifier(self) -> MeasurementIdentifier:
+        return self._new_measurement_identifiers(1)[0]
+
+    def _new_measurement_identifiers(self, n: int) -> list[MeasurementIdentifier]:
+        num_measurements = self._num_measurements()
+        return [MeasurementIdentifier(i) for i in range(num_measurements - n, num_measurements)]
+
+    def _num_measurements(self) -> int:
+        if self._recorder is None:
+            return self.circuit.num_measurements
+        return self._num_suppressed_measurements + self._recorder.num_measurements
+
+    def _num_detectors(self) -> int:
+        if self._recorder is None:
+            return self.circuit.num_detectors
+        return self._num_suppressed_detectors + self._recorder.num_detectors
+
+    def _num_observables(self) -> int:
+        if self._recorder is None:
+            return self.circuit.num_observables
+        return max(self.circuit.num_observables, self._recorder.num_observables)
+
+    def _start_recording(self) -> tuple[int, int, int]:
+        self._scan_instructions()
+        return (len(self.circuit), len(self._round_labels), len(self._detector_tags))
+
+    def _suppress_emission(self) -> None:
+        '''\
+        Makes the following instructions be recorded instead of emitted, as if they were placed at the end of
+        the circuit. See `_take_suppressed_instructions()`.
+        '''
+        assert self._recorder is None
+        self._num_suppressed_measurements = self.circuit.num_measurements
+        self._num_suppressed_detectors = self.circuit.num_detectors
+        self._recorder = _InstructionRecorder()
+
+    def _take_suppressed_instructions(self) -> _InstructionRecorder:
+        '''\
+        Returns the instructions recorded since the emission was suppressed or since the last call, which
+        count as placed at the end of the circuit, and starts a new recording.
+        '''
+        recorder = self._recorder
+        assert recorder is not None
+        self._num_suppressed_measurements += recorder.num_measurements
+        self._num_suppressed_detectors += recorder.num_detectors
+        self._recorder = _InstructionRecorder()
+        return recorder
+
+    def _resume_emission(self) -> None:
+        assert self._recorder is not None
+        assert len(self._recorder.instructions) == 0
+        self._recorder = None
+
+    def _collapse_recording(self, start: tuple[int, int, int], repetitions: int) -> None:
+        '''\
+        Replaces the instructions recorded since `start` with a REPEAT block that
+        runs them `repetitions` times. The post-selection IDs of the repetitions
+        are placed by the suppressed calls of the body, see `place_repeated()`.
+        '''
+        (instruction_start, round_start, detector_start) = start
+        self._scan_instructions()
+        body = self.circuit[instruction_start:]
+        for _ in range(len(self.circuit) - instruction_start):
+            self.circuit.pop()
+        self.circuit.append(stim.CircuitRepeatBlock(repetitions, body))
+        self._num_scanned_instructions = len(self.circuit)
+
+        # The previous call emitted the same instructions, so the qubits used before the first layering tick
+        # in the body are the same for all the repetitions, and we can copy the metadata of the recorded one.
+        labels = self._round_labels[round_start:]
+        ends = self._round_detector_ends[round_start:]
+        usage = self._round_qubit_usage[round_start:]
+        tags = self._detector_tags[detector_start:]
+        assert len(tags) == body.num_detectors
+        for i in range(1, repetitions):
+            self._round_labels += labels
+            self._round_detector_ends += [end + i * body.num_detectors for end in ends]
+            self._round_qubit_usage += usage
+            self._detector_tags += tags
+
 
 class MultiplexingCircuit:
     '''\
     A wrapper for util.Circuit.
 
-    A MultiplexingCircuit has two Circuit instances and dispatches the same operation for them.
-    This class assumes that the two circuits share the same Measurement/Detector/Observable identifiers.
+    A MultiplexingCircuit has one or more Circuit instances and dispatches the same operation for all of them.
+    Each circuit may have its own error probability and its own set of noiseless qubits, which lets us build
+    several variants of a protocol with a single execution of the schedule generators.
+    This class assumes that the circuits share the same Measurement/Detector/Observable identifiers.
     '''
-    def __init__(self, circuit1: Circuit, circuit2: Circuit):
-        self.circuit1 = circuit1
-        self.circuit2 = circuit2
-        assert circuit1.mapping is circuit2.mapping
-        self.mapping = circuit1.mapping
+    def __init__(self, *circuits: Circuit):
+        assert len(circuits) > 0
+        self.circuits: list[Circuit] = list(circuits)
+        for circuit in self.circuits:
+            assert circuit.mapping is self.circuits[0].mapping
+        self.mapping = self.circuits[0].mapping
+
+    @property
+    def circuit1(self) -> Circuit:
+        return self.circuits[0]
+
+    @property
+    def circuit2(self) -> Circuit:
+        return self.circuits[1]
 
     def is_tainted_by_id(self, id: int) -> bool:
-        return self.circuit1.is_tainted_by_id(id)
+        return self.circuits[0].is_tainted_by_id(id)
 
     def is_tainted_by_position(self, x: int, y: int) -> bool:
-        return self.circuit1.is_tainted_by_position(x, y)
+        return self.circuits[0].is_tainted_by_position(x, y)
 
     def place_tick(self) -> None:
-        self.circuit1.place_tick()
-        self.circuit2.place_tick()
+        for circuit in self.circuits:
+            circuit.place_tick()
 
     def place_layering_tick(self, tag: str) -> None:
-        self.circuit1.place_layering_tick(tag)
-        self.circuit2.place_layering_tick(tag)
+        for circuit in self.circuits:
+            circuit.place_layering_tick(tag)
 
     def place_single_qubit_gate(self, gate: str, target_position: tuple[int, int]) -> None:
-        self.circuit1.place_single_qubit_gate(gate, target_position)
-        self.circuit2.place_single_qubit_gate(gate, target_position)
+        for circuit in self.circuits:
+            circuit.place_single_qubit_gate(gate, target_position)
 
     def place_cx(self, control_position: tuple[int, int], target_position: tuple[int, int]) -> None:
-        self.circuit1.place_cx(control_position, target_position)
-        self.circuit2.place_cx(control_position, target_position)
+        for circuit in self.circuits:
+            circuit.place_cx(control_position, target_position)
 
     def place_reset_z(self, target_position: tuple[int, int]) -> None:
-        self.circuit1.place_reset_z(target_position)
-        self.circuit2.place_reset_z(target_position)
+        for circuit in self.circuits:
+            circuit.place_reset_z(target_position)
 
     def place_reset_x(self, target_position: tuple[int, int]) -> None:
-        self.circuit1.place_reset_x(target_position)
-        self.circuit2.place_reset_x(target_position)
+        for circuit in self.circuits:
+            circuit.place_reset_x(target_position)
 
     def place_measurement_z(self, target_position: tuple[int, int]) -> MeasurementIdentifier:
-        m1 = self.circuit1.place_measurement_z(target_position)
-        m2 = self.circuit2.place_measurement_z(target_position)
-        assert m1 == m2
-        return m1
+        ms = [circuit.place_measurement_z(target_position) for circuit in self.circuits]
+        assert all(m == ms[0] for m in ms)
+        return ms[0]
 
     def place_measurement_x(self, target_position: tuple[int, int]) -> MeasurementIdentifier:
-        m1 = self.circuit1.place_measurement_x(target_position)
-        m2 = self.circuit2.place_measurement_x(target_position)
-        assert m1 == m2
-        return m1
+        ms = [circuit.place_measurement_x(target_position) for circuit in self.circuits]
+        assert all(m == ms[0] for m in ms)
+        return ms[0]
 
     def place_mpp(self, target: stim.PauliString) -> MeasurementIdentifier:
-        m1 = self.circuit1.place_mpp(target)
-        m2 = self.circuit2.place_mpp(target)
-        assert m1 == m2
-        return m1
+        ms = [circuit.place_mpp(target) for circuit in self.circuits]
+        assert all(m == ms[0] for m in ms)
+        return ms[0]
+
+    def place_reset_z_by_ids(self, targets: list[int]) -> None:
+        for circuit in self.circuits:
+            circuit.place_reset_z_by_ids(targets)
+
+    def place_reset_x_by_ids(self, targets: list[int]) -> None:
+        for circuit in self.circuits:
+            circuit.place_reset_x_by_ids(targets)
+
+    def place_cx_by_ids(self, pairs: list[tuple[int, int]]) -> None:
+        for circuit in self.circuits:
+            circuit.place_cx_by_ids(pairs)
+
+    def place_measurement_z_by_ids(self, targets: list[int]) -> list[MeasurementIdentifier]:
+        ms = [circuit.place_measurement_z_by_ids(targets) for circuit in self.circuits]
+        assert all(m == ms[0] for m in ms)
+        return ms[0]
+
+    def place_measurement_x_by_ids(self, targets: list[int]) -> list[MeasurementIdentifier]:
+        ms = [circuit.place_measurement_x_by_ids(targets) for circuit in self.circuits]
+        assert all(m == ms[0] for m in ms)
+        return ms[0]
 
     def place_detector(
             self, measurements: list[MeasurementIdentifier], post_selection: bool = False,
             tag: str = '') -> DetectorIdentifier:
-        d1 = self.circuit1.place_detector(measurements, post_selection, tag=tag)
-        d2 = self.circuit2.place_detector(measurements, post_selection, tag=tag)
-        assert d1 == d2
-        return d1
+        ds = [circuit.place_detector(measurements, post_selection, tag=tag) for circuit in self.circuits]
+        assert all(d == ds[0] for d in ds)
+        return ds[0]
+
+    def place_detectors(
+            self, measurements: np.ndarray | list[list[int]], post_selection: bool | np.ndarray = False,
+            tags: str | list[str] = '') -> list[DetectorIdentifier]:
+        ds = [circuit.place_detectors(measurements, post_selection, tags) for circuit in self.circuits]
+        assert all(d == ds[0] for d in ds)
+        return ds[0]
 
     def place_observable_include(
             self,
             measurements: list[MeasurementIdentifier],
             id: ObservableIdentifier | None = None) -> ObservableIdentifier:
-        i = self.circuit1.place_observable_include(measurements, id)
-        j = self.circuit2.place_observable_include(measurements, id)
-        assert i == j
-        return i
+        ids = [circuit.place_observable_include(measurements, id) for circuit in self.circuits]
+        assert all(i == ids[0] for i in ids)
+        return ids[0]
+
+    def place_repeated(self, count: int, body: Callable[[], None]) -> None:
+        place_repeated(self.circuits, count, body)
+
+
+def flattened_instructions(circuit: stim.Circuit) -> Iterator[stim.CircuitInstruction]:
+    '''Iterates over the instructions in `circuit`, expanding REPEAT blocks.'''
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            body = inst.body_copy()
+            for _ in range(inst.repeat_count):
+                yield from flattened_instructions(body)
+        else:
+            yield inst
+
+
+def place_repeated(circuits: list[Circuit], count: int, body: Callable[[], None]) -> None:
+    '''\
+    Calls `body` `count` times, where `body` places the same operations on all of `circuits`.
+
+    The calls are emitted one by one until two consecutive calls emit identical
+    instructions on every circuit. From then on the circuits are in a steady
+    state: the following calls are made with the emission suppressed, and as
+    long as they place the same instructions, the latest emitted call and them
+    are emitted as a single stim REPEAT block instead of being unrolled. A call
+    placing different instructions is emitted as is, and the search for a
+    steady state starts over.
+
+    Every call of `body` is made, and gets the measurement and detector
+    identifiers of the repetition it places, so `body` may keep any state.
+    Only the emission of the instructions is saved.
+    '''
+    previous: list[stim.Circuit] | None = None
+    remaining = count
+    while remaining > 0:
+        starts = [circuit._start_recording() for circuit in circuits]
+        body()
+        remaining -= 1
+        chunks = [circuit.circuit[start[0]:] for (circuit, start) in zip(circuits, starts)]
+        if remaining == 0 or chunks != previous:
+            previous = chunks
+            continue
+
+        # The first suppressed call is compared with the emitted one, and the others with the first one, which
+        # is cheaper than building stim circuits.
+        repetitions = 1
+        first: list[_InstructionRecorder] | None = None
+        diverged: list[stim.Circuit] | None = None
+        for circuit in circuits:
+            circuit._suppress_emission()
+        try:
+            while remaining > 0:
+                body()
+                remaining -= 1
+                recorded = [circuit._take_suppressed_instructions() for circuit in circuits]
+                if first is None and [r.to_stim_circuit() for r in recorded] == chunks:
+                    first = recorded
+                elif first is None or [r.instructions for r in recorded] != [r.instructions for r in first]:
+                    diverged = [r.to_stim_circuit() for r in recorded]
+                    break
+                repetitions += 1
+        finally:
+            for circuit in circuits:
+                circuit._take_suppressed_instructions()
+                circuit._resume_emission()
+        if repetitions > 1:
+            for (circuit, start) in zip(circuits, starts):
+                circuit._collapse_recording(start, repetitions)
+        if diverged is None:
+            return
+        for (circuit, instructions) in zip(circuits, diverged):
+            circuit.circuit += instructions
+        previous = diverged
 
 
 class SuppressNoise:
@@ -349,26 +810,23 @@ class SuppressNoise:
     '''
     def __init__(self, circuit: Circuit | MultiplexingCircuit):
         self.circuit = circuit
-        self.error_probability: float | None = None
+        self.error_probabilities: list[float] | None = None
 
-    def __enter__(self):
-        assert self.error_probability is None
+    def _circuits(self) -> list[Circuit]:
         if isinstance(self.circuit, Circuit):
-            self.error_probability = self.circuit.error_probability
-            self.circuit.error_probability = 0
-        else:
-            assert isinstance(self.circuit, MultiplexingCircuit)
-            assert self.circuit.circuit1.error_probability == self.circuit.circuit2.error_probability
-            self.error_probability = self.circuit.circuit1.error_probability
-            self.circuit.circuit1.error_probability = 0
-            self.circuit.circuit2.error_probability = 0
+            return [self.circuit]
+        assert isinstance(self.circuit, MultiplexingCircuit)
+        return self.circuit.circuits
+
+    def __enter__(self):
+        assert self.error_probabilities is None
+        circuits = self._circuits()
+        self.error_probabilities = [circuit.error_probability for circuit in circuits]
+        for circuit in circuits:
+            circuit.error_probability = 0
 
     def __exit__(self, ex_type, ex_value, trace):
-        assert self.error_probability is not None
-        if isinstance(self.circuit, Circuit):
-            self.circuit.error_probability = self.error_probability
-        else:
-            assert isinstance(self.circuit, MultiplexingCircuit)
-            self.circuit.circuit1.error_probability = self.error_probability
-            self.circuit.circuit2.error_probability = self.error_probability
-        self.error_probability = None
+        assert self.error_probabilities is not None
+        for (circuit, error_probability) in zip(self._circuits(), self.error_probabilities):
+            circuit.error_probability = error_probability
+        self.error_probabilities = None
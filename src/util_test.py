@@ -1,3 +1,4 @@
+import numpy as np
 import stim
 import unittest
 import textwrap
@@ -213,3 +214,276 @@ class CircuitTest(unittest.TestCase):
         OBSERVABLE_INCLUDE(4) rec[-3] rec[-2]
         OBSERVABLE_INCLUDE(1) rec[-2] rec[-1]''')
         self.assertEqual(str(circuit.circuit), expectation)
+
+
+class MultiplexingCircuitTest(unittest.TestCase):
+    def test_dispatch_to_many_circuits(self):
+        mapping = QubitMapping(4, 4)
+        c0 = Circuit(mapping, 0.01)
+        c1 = Circuit(mapping, 0.01)
+        c2 = Circuit(mapping, 0.02)
+        c1.mark_qubits_as_noiseless([(0, 0)])
+        prologue = str(c0.circuit)
+        circuit = MultiplexingCircuit(c0, c1, c2)
+
+        i = circuit.place_measurement_z((0, 0))
+        d = circuit.place_detector([i], post_selection=True)
+
+        self.assertEqual(i, MeasurementIdentifier(0))
+        self.assertEqual(d, DetectorIdentifier(0))
+        self.assertEqual(str(c0.circuit), prologue + textwrap.dedent('''
+        X_ERROR(0.01) 0
+        M 0
+        DETECTOR rec[-1]'''))
+        self.assertEqual(str(c1.circuit), prologue + textwrap.dedent('''
+        M 0
+        DETECTOR rec[-1]'''))
+        self.assertEqual(str(c2.circuit), prologue + textwrap.dedent('''
+        X_ERROR(0.02) 0
+        M 0
+        DETECTOR rec[-1]'''))
+        for c in [c0, c1, c2]:
+            self.assertEqual(c.detectors_for_post_selection, [DetectorIdentifier(0)])
+
+    def test_suppress_noise(self):
+        mapping = QubitMapping(4, 4)
+        c0 = Circuit(mapping, 0.01)
+        c1 = Circuit(mapping, 0.02)
+        c2 = Circuit(mapping, 0.03)
+        circuit = MultiplexingCircuit(c0, c1, c2)
+
+        with SuppressNoise(circuit):
+            self.assertEqual([c.error_probability for c in circuit.circuits], [0, 0, 0])
+        self.assertEqual([c.error_probability for c in circuit.circuits], [0.01, 0.02, 0.03])
+
+
+class PlaceRepeatedTest(unittest.TestCase):
+    def test_place_repeated(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        prologue = str(circuit.circuit)
+        last: list[MeasurementIdentifier] = [circuit.place_measurement_z((0, 0))]
+        circuit.place_tick()
+
+        def body():
+            i = circuit.place_measurement_z((0, 0))
+            circuit.place_detector([last[0], i], post_selection=True)
+            last[0] = i
+            circuit.place_tick()
+
+        circuit.place_repeated(4, body)
+        expectation = prologue + textwrap.dedent('''
+        M 0
+        TICK
+        M 0
+        DETECTOR rec[-2] rec[-1]
+        TICK
+        REPEAT 3 {
+            M 0
+            DETECTOR rec[-2] rec[-1]
+            TICK
+        }''')
+        self.assertEqual(str(circuit.circuit), expectation)
+        self.assertEqual(last[0], MeasurementIdentifier(4))
+        self.assertEqual(circuit.detectors_for_post_selection, [DetectorIdentifier(i) for i in range(4)])
+
+        d = circuit.place_detector([last[0], circuit.place_measurement_z((0, 0))])
+        self.assertEqual(d, DetectorIdentifier(4))
+        self.assertEqual(str(circuit.circuit[-1]), 'DETECTOR rec[-2] rec[-1]')
+
+    def test_place_repeated_without_steady_state(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        positions = [(0, 0), (0, 2), (2, 0)]
+
+        def body():
+            circuit.place_measurement_z(positions.pop())
+            circuit.place_tick()
+
+        circuit.place_repeated(3, body)
+        self.assertEqual(circuit.circuit.num_measurements, 3)
+        self.assertNotIn('REPEAT', str(circuit.circuit))
+
+    def test_place_repeated_with_state(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        measurements: list[MeasurementIdentifier] = []
+
+        def body():
+            measurements.append(circuit.place_measurement_z((0, 0)))
+            circuit.place_tick()
+
+        circuit.place_repeated(5, body)
+        self.assertIn('REPEAT 4', str(circuit.circuit))
+        # Every call runs, and gets the identifiers of its own repetition.
+        self.assertEqual(measurements, [MeasurementIdentifier(i) for i in range(5)])
+
+    def test_place_repeated_diverging(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        prologue = str(circuit.circuit)
+        positions = [(0, 2)] + [(0, 0)] * 4
+
+        def body():
+            circuit.place_measurement_z(positions.pop())
+            circuit.place_tick()
+
+        circuit.place_repeated(5, body)
+        expectation = prologue + textwrap.dedent('''
+        M 0
+        TICK
+        REPEAT 3 {
+            M 0
+            TICK
+        }
+        M 1
+        TICK''')
+        self.assertEqual(str(circuit.circuit), expectation)
+
+
+class PlaceByIdsTest(unittest.TestCase):
+    def test_place_by_ids(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0.01)
+        circuit.mark_qubits_as_noiseless([(0, 2)])
+        prologue = str(circuit.circuit)
+
+        circuit.place_reset_z_by_ids([0, 1])
+        circuit.place_reset_x_by_ids([4])
+        circuit.place_tick()
+        circuit.place_cx_by_ids([(0, 4), (1, 5)])
+        circuit.place_tick()
+        ms = circuit.place_measurement_z_by_ids([4, 5])
+        ms += circuit.place_measurement_x_by_ids([0, 1])
+        expectation = prologue + textwrap.dedent('''
+        R 0 1
+        X_ERROR(0.01) 0
+        RX 4
+        Z_ERROR(0.01) 4
+        DEPOLARIZE1(0.01) 2 3 5 6 7
+        TICK
+        CX 0 4 1 5
+        DEPOLARIZE1(0.01) 5
+        DEPOLARIZE2(0.01) 0 4
+        DEPOLARIZE1(0.01) 2 3 6 7
+        TICK
+        X_ERROR(0.01) 4 5
+        M 4 5
+        Z_ERROR(0.01) 0
+        MX 0 1''')
+        self.assertEqual(str(circuit.circuit), expectation)
+        self.assertEqual(ms, [MeasurementIdentifier(i) for i in range(4)])
+
+    def test_place_by_ids_on_tainted_qubits(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0.01)
+
+        circuit.place_reset_z_by_ids([0])
+        self.assertRaises(ValueError, lambda: circuit.place_cx_by_ids([(0, 4)]))
+        self.assertRaises(ValueError, lambda: circuit.place_reset_x_by_ids([1, 1]))
+
+
+class PlaceDetectorsTest(unittest.TestCase):
+    def test_place_detectors(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        prologue = str(circuit.circuit)
+
+        ms = circuit.place_measurement_z_by_ids([0, 1, 2])
+        d = circuit.place_detector([ms[0]])
+        ds = circuit.place_detectors(
+            np.array([[0, 1], [1, 2], [2, -1]]), post_selection=np.array([True, False, True]), tags=['A', 'B', 'C'])
+        expectation = prologue + textwrap.dedent('''
+        M 0 1 2
+        DETECTOR rec[-3]
+        DETECTOR[A] rec[-3] rec[-2]
+        DETECTOR[B] rec[-2] rec[-1]
+        DETECTOR[C] rec[-1]''')
+        self.assertEqual(str(circuit.circuit), expectation)
+        self.assertEqual(ds, [DetectorIdentifier(1), DetectorIdentifier(2), DetectorIdentifier(3)])
+        self.assertEqual(circuit.detectors_for_post_selection, [DetectorIdentifier(1), DetectorIdentifier(3)])
+        self.assertEqual(circuit.post_selection_ids.tolist(), [1, 3])
+
+    def test_post_selection_ids(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+
+        m = circuit.place_measurement_z((0, 0))
+        for _ in range(100):
+            circuit.place_detector([m], post_selection=True)
+            circuit.place_detector([m])
+        circuit.place_detectors([[m.id]] * 100, post_selection=True)
+
+        ids = circuit.post_selection_ids
+        self.assertEqual(ids.tolist(), list(range(0, 200, 2)) + list(range(200, 300)))
+        self.assertFalse(ids.flags.writeable)
+
+    def test_identifiers_are_hashable(self):
+        self.assertEqual(len({MeasurementIdentifier(1), MeasurementIdentifier(1), MeasurementIdentifier(2)}), 2)
+        self.assertEqual(len({DetectorIdentifier(1), DetectorIdentifier(1)}), 1)
+        self.assertEqual(len({ObservableIdentifier(1), ObservableIdentifier(1)}), 1)
+
+    def test_identifiers_are_immutable(self):
+        with self.assertRaises(AttributeError):
+            MeasurementIdentifier(1).id = 2  # type: ignore[misc]
+        with self.assertRaises(AttributeError):
+            DetectorIdentifier(1).id = 2  # type: ignore[misc]
+
+
+class DetectorMetadataTest(unittest.TestCase):
+    def test_detector_metadata(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+
+        m0 = circuit.place_measurement_z((0, 0))
+        circuit.place_detector([m0], post_selection=True, tag=POST_SELECTION_TAG)
+        circuit.place_tick()
+        circuit.place_layering_tick('A')
+
+        # Instructions appended to the stim circuit directly are taken into account.
+        circuit.circuit.append('H', [2])
+        m1 = circuit.place_measurement_x((0, 2))
+        circuit.place_detector([m1], tag='X')
+        circuit.place_tick()
+        circuit.place_layering_tick('B')
+
+        metadata = circuit.detector_metadata()
+        self.assertEqual(metadata.round_labels, ['A', 'B'])
+        self.assertEqual(metadata.round_detector_ends.tolist(), [1, 2])
+        self.assertEqual(metadata.round_qubit_usage.tolist(), [
+            [True, False, False, False, False, False, False, False],
+            [False, True, True, False, False, False, False, False],
+        ])
+        self.assertEqual(metadata.detector_rounds.tolist(), [0, 1])
+        self.assertEqual(metadata.detector_tag(0), POST_SELECTION_TAG)
+        self.assertEqual(metadata.detector_tag(1), 'X')
+        self.assertEqual(metadata.detector_post_selection.tolist(), [True, False])
+
+    def test_detector_metadata_with_repeat_blocks(self):
+        mapping = QubitMapping(4, 4)
+        circuit = Circuit(mapping, 0)
+        last: list[MeasurementIdentifier] = [circuit.place_measurement_z((0, 0))]
+        circuit.place_tick()
+
+        def body():
+            i = circuit.place_measurement_z((0, 0))
+            circuit.place_detector([last[0], i])
+            last[0] = i
+            circuit.place_tick()
+            circuit.place_layering_tick('Round')
+            circuit.place_reset_x((2, 2))
+
+        circuit.place_repeated(4, body)
+        circuit.place_detector([last[0]])
+
+        metadata = circuit.detector_metadata()
+        self.assertIn('REPEAT', str(circuit.circuit))
+        self.assertEqual(metadata.round_labels, ['Round'] * 4)
+        self.assertEqual(metadata.round_detector_ends.tolist(), [1, 2, 3, 4])
+        self.assertEqual(metadata.round_qubit_usage[:, :4].tolist(), [
+            [True, False, False, False],
+            [True, False, False, True],
+            [True, False, False, True],
+            [True, False, False, True],
+        ])
+        self.assertEqual(metadata.detector_rounds.tolist(), [0, 1, 2, 3, -1])
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections.abc import Callable
+from dataclasses import dataclass
+
+# A work queue stored in an SQLite file, for spreading many configurations over any number of workers on any
+# number of hosts sharing the file.
+#
+# A configuration is a command line of one of the simulation scripts in this directory, e.g.
+#   lattice_surgery_complementary_gap.py --num-shots 100000 --error-probability 0.001 --gap-threshold 4 --seed 1
+# and it is split into `num_chunks` chunks. The i-th chunk runs the command with `--shard i/num_chunks`, so
+# `--num-shots` is the number of shots per chunk. A worker leases a chunk, keeps the lease alive with heartbeats
+# while the chunk runs, and stores the resulting shard file. Leases of dead workers expire and their chunks are
+# leased again. A chunk is deterministic given its seed, so storing a result twice is harmless. A chunk which has
+# been leased `max_attempts` times without completing is marked failed and never leased again, so that a broken
+# configuration doesn't keep the workers from the others.
+#
+# Usage:
+#   python work_queue.py --queue queue.db add --num-chunks 100 -- lattice_surgery_complementary_gap.py ...
+#   python work_queue.py --queue queue.db work   # on as many hosts as you like
+#   python work_queue.py --queue queue.db status
+#   python work_queue.py --queue queue.db merge --config-id 1
+
+
+@dataclass(frozen=True)
+class Lease:
+    config_id: int
+    chunk_index: int
+    num_chunks: int
+    command: list[str]
+    worker: str
+
+
+@dataclass(frozen=True)
+class Progress:
+    config_id: int
+    command: list[str]
+    num_chunks: int
+    num_done: int
+    num_leased: int
+    num_failed: int
+
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+class WorkQueue:
+    def __init__(
+            self, path: str, clock: Callable[[], float] = time.time, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> None:
+        assert max_attempts > 0
+        # Transactions are managed explicitly, see `_transaction`.
+        self.con = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.clock = clock
+        self.max_attempts = max_attempts
+        with self._transaction():
+            self.con.execute('''
+                CREATE TABLE IF NOT EXISTS configurations (
+                    config_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    command TEXT UNIQUE,
+                    num_chunks INTEGER
+                )
+            ''')
+            self.con.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    config_id INTEGER,
+                    chunk_index INTEGER,
+                    state TEXT,
+                    worker TEXT,
+                    lease_expires_at REAL,
+                    num_attempts INTEGER,
+                    result BLOB,
+                    PRIMARY KEY (config_id, chunk_index)
+                )
+            ''')
+            self.con.execute('CREATE INDEX IF NOT EXISTS chunks_by_state ON chunks (state, lease_expires_at)')
+
+    def close(self) -> None:
+        self.con.close()
+
+    def _transaction(self) -> sqlite3.Connection:
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same chunk.
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def add_configuration(self, command: list[str], num_chunks: int) -> int:
+        '''\
+        Adds a configuration with `num_chunks` pending chunks and returns its id. Adding the same command again
+        returns the existing id.
+        '''
+        assert num_chunks > 0
+        encoded = json.dumps(command)
+        with self._transaction():
+            row = self.con.execute(
+                'SELECT config_id, num_chunks FROM configurations WHERE command = ?', (encoded,)).fetchone()
+            if row is not None:
+                (config_id, existing_num_chunks) = row
+                if existing_num_chunks != num_chunks:
+                    raise ValueError('The configuration {} already exists with {} chunks.'.format(
+                        config_id, existing_num_chunks))
+                return config_id
+            cur = self.con.execute(
+                'INSERT INTO configurations (command, num_chunks) VALUES (?, ?)', (encoded, num_chunks))
+            config_id = cur.lastrowid
+            assert config_id is not None
+            self.con.executemany(
+                'INSERT INTO chunks (config_id, chunk_index, state, num_attempts) VALUES (?, ?, \'pending\', 0)',
+                [(config_id, i) for i in range(num_chunks)])
+            return config_id
+
+    def lease(self, worker: str, duration: float) -> Lease | None:
+        '''\
+        Leases a pending chunk, or a chunk whose lease has expired, for `duration` seconds.
+        Returns None if there is no such chunk. Chunks whose leases have expired `max_attempts` times are marked
+        failed instead of being leased again.
+        '''
+        now = self.clock()
+        with self._transaction():
+            self.con.execute(
+                'UPDATE chunks SET state = \'failed\', worker = NULL, lease_expires_at = NULL '
+                'WHERE state = \'leased\' AND lease_expires_at < ? AND num_attempts >= ?', (now, self.max_attempts))
+            row = self.con.execute(
+                'SELECT chunks.config_id, chunk_index, num_chunks, command FROM chunks '
+                'JOIN configurations ON chunks.config_id = configurations.config_id '
+                'WHERE state = \'pending\' OR (state = \'leased\' AND lease_expires_at < ?) '
+                'ORDER BY chunks.config_id, chunk_index LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            (config_id, chunk_index, num_chunks, command) = row
+            self.con.execute(
+                'UPDATE chunks SET state = \'leased\', worker = ?, lease_expires_at = ?, '
+                'num_attempts = num_attempts + 1 WHERE config_id = ? AND chunk_index = ?',
+                (worker, now + duration, config_id, chunk_index))
+        return Lease(config_id, chunk_index, num_chunks, json.loads(command), worker)
+
+    def heartbeat(self, lease: Lease, duration: float) -> bool:
+        '''\
+        Extends `lease` by `duration` seconds from now. Returns False if the lease has been lost, i.e., it has
+        expired and the chunk has been leased by another worker or completed.
+        '''
+        with self._transaction():
+            cur = self.con.execute(
+                'UPDATE chunks SET lease_expires_at = ? '
+                'WHERE config_id = ? AND chunk_index = ? AND state = \'leased\' AND worker = ?',
+                (self.clock() + duration, lease.config_id, lease.chunk_index, lease.worker))
+            return cur.rowcount == 1
+
+    def complete(self, lease: Lease, result: bytes) -> None:
+        '''Stores the result of the chunk, replacing the existing one if any.'''
+        with self._transaction():
+            self.con.execute(
+                'INSERT INTO chunks (config_id, chunk_index, state, num_attempts, result) '
+                'VALUES (?, ?, \'done\', 1, ?) '
+                'ON CONFLICT (config_id, chunk_index) DO UPDATE SET '
+                'state = \'done\', worker = NULL, lease_expires_at = NULL, result = excluded.result',
+                (lease.config_id, lease.chunk_index, result))
+
+    def release(self, lease: Lease) -> None:
+        '''\
+        Gives up `lease` on failure so that another worker can retry the chunk, or marks the chunk failed if it
+        has been tried `max_attempts` times.
+        '''
+        with self._transaction():
+            self.con.execute(
+                'UPDATE chunks SET state = CASE WHEN num_attempts >= ? THEN \'failed\' ELSE \'pending\' END, '
+                'worker = NULL, lease_expires_at = NULL '
+                'WHERE config_id = ? AND chunk_index = ? AND state = \'leased\' AND worker = ?',
+                (self.max_attempts, lease.config_id, lease.chunk_index, lease.worker))
+
+    def progress(self) -> list[Progress]:
+        rows = self.con.execute(
+            'SELECT configurations.config_id, command, num_chunks, '
+            'SUM(state = \'done\'), SUM(state = \'leased\' AND lease_expires_at >= ?), SUM(state = \'failed\') '
+            'FROM configurations JOIN chunks ON configurations.config_id = chunks.config_id '
+            'GROUP BY configurations.config_id ORDER BY configurations.config_id', (self.clock(),)).fetchall()
+        return [Progress(config_id, json.loads(command), num_chunks, num_done, num_leased, num_failed)
+                for (config_id, command, num_chunks, num_done, num_leased, num_failed) in rows]
+
+    def results(self, config_id: int) -> list[tuple[int, bytes]]:
+        '''Returns the results of the completed chunks of the configuration, with their chunk indices.'''
+        rows = self.con.execute(
+            'SELECT chunk_index, result FROM chunks WHERE config_id = ? AND state = \'done\' ORDER BY chunk_index',
+            (config_id,)).fetchall()
+        return [(chunk_index, result) for (chunk_index, result) in rows]
+
+
+def _script_path(command: list[str]) -> str:
+    # Scripts are looked up next to this file, so that hosts with different checkouts can share a queue.
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.basename(command[0]))
+
+
+def run_chunk(queue: WorkQueue, lease: Lease, lease_duration: float, heartbeat_interval: float) -> bool:
+    '''Runs the leased chunk and stores its result. Returns False if the chunk has failed.'''
+    with tempfile.TemporaryDirectory() as dir:
+        output = os.path.join(dir, 'shard')
+        args = [sys.executable, _script_path(lease.command)] + lease.command[1:] + [
+            '--shard', '{}/{}'.format(lease.chunk_index, lease.num_chunks), '--shard-output', output]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                (stdout, _) = process.communicate(timeout=heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                if not queue.heartbeat(lease, lease_duration):
+                    print('Lost the lease of chunk {} of configuration {}.'.format(
+                        lease.chunk_index, lease.config_id), file=sys.stderr)
+                    process.kill()
+                    process.communicate()
+                    return False
+
+        if process.returncode != 0 or not os.path.exists(output):
+            print('Chunk {} of configuration {} failed:'.format(lease.chunk_index, lease.config_id), file=sys.stderr)
+            print(stdout.decode(errors='replace'), file=sys.stderr)
+            queue.release(lease)
+            return False
+        with open(output, 'rb') as f:
+            queue.complete(lease, f.read())
+    return True
+
+
+def run_worker(queue: WorkQueue, worker: str, lease_duration: float, heartbeat_interval: float) -> None:
+    while True:
+        lease = queue.lease(worker, lease_duration)
+        if lease is None:
+            return
+        print('Running chunk {}/{} of configuration {}...'.format(
+            lease.chunk_index, lease.num_chunks, lease.config_id))
+        run_chunk(queue, lease, lease_duration, heartbeat_interval)
+
+
+def merge(queue: WorkQueue, config_id: int) -> int:
+    '''Merges the results of the completed chunks of the configuration, and returns the exit status.'''
+    [command] = [p.command for p in queue.progress() if p.config_id == config_id]
+    results = queue.results(config_id)
+    if len(results) == 0:
+        print('Error: No chunk of configuration {} is done.'.format(config_id), file=sys.stderr)
+        return 1
+    with tempfile.TemporaryDirectory() as dir:
+        paths: list[str] = []
+        for (chunk_index, result) in results:
+            path = os.path.join(dir, '{}.shard'.format(chunk_index))
+            with open(path, 'wb') as f:
+                f.write(result)
+            paths.append(path)
+        completed = subprocess.run([sys.executable, _script_path(command)] + command[1:] + ['--merge-shards'] + paths)
+    if completed.returncode != 0:
+        print('Error: Merging the chunks of configuration {} failed.'.format(config_id), file=sys.stderr)
+    return completed.returncode
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='description')
+    parser.add_argument('--queue', type=str, default='work_queue.db')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='the number of times a chunk is tried before it is marked failed')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    add_parser = subparsers.add_parser('add')
+    add_parser.add_argument('--num-chunks', type=int, required=True)
+    add_parser.add_argument('command', nargs=argparse.REMAINDER)
+
+    work_parser = subparsers.add_parser('work')
+    work_parser.add_argument('--worker', type=str, default='{}-{}'.format(socket.gethostname(), os.getpid()))
+    work_parser.add_argument('--lease-duration', type=float, default=600)
+    work_parser.add_argument('--heartbeat-interval', type=float, default=60)
+
+    subparsers.add_parser('status')
+
+    merge_parser = subparsers.add_parser('merge')
+    merge_parser.add_argument('--config-id', type=int, required=True)
+
+    args = parser.parse_args()
+    if args.max_attempts <= 0:
+        print('Error: --max-attempts must be positive.', file=sys.stderr)
+        return
+
+    queue = WorkQueue(args.queue, max_attempts=args.max_attempts)
+    exit_status = 0
+    try:
+        match args.subcommand:
+            case 'add':
+                command: list[str] = args.command
+                if len(command) > 0 and command[0] == '--':
+                    command = command[1:]
+                if len(command) == 0:
+                    print('Error: No command is given.', file=sys.stderr)
+                    return
+                if '--seed' not in command:
+                    print('Error: The command must have --seed.', file=sys.stderr)
+                    return
+                if args.num_chunks <= 0:
+                    print('Error: --num-chunks must be positive.', file=sys.stderr)
+                    return
+                config_id = queue.add_configuration(command, args.num_chunks)
+                print('config_id = {}'.format(config_id))
+            case 'work':
+                if args.heartbeat_interval >= args.lease_duration:
+                    print('Error: --heartbeat-interval must be shorter than --lease-duration.', file=sys.stderr)
+                    return
+                run_worker(queue, args.worker, args.lease_duration, args.heartbeat_interval)
+            case 'status':
+                for p in queue.progress():
+                    print('{}: done = {}/{}, running = {}, failed = {}: {}'.format(
+                        p.config_id, p.num_done, p.num_chunks, p.num_leased, p.num_failed, ' '.join(p.command)))
+            case 'merge':
+                exit_status = merge(queue, args.config_id)
+            case _:
+                assert False
+    finally:
+        queue.close()
+    if exit_status != 0:
+        sys.exit(exit_status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import os
+import tempfile
+import unittest
+
+from work_queue import *
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.path = os.path.join(self.dir.name, 'queue.db')
+        self.queue = WorkQueue(self.path, self.clock)
+
+    def tearDown(self) -> None:
+        self.queue.close()
+        self.dir.cleanup()
+
+    def test_add_configuration(self) -> None:
+        config1 = self.queue.add_configuration(['a.py', '--seed', '1'], 2)
+        config2 = self.queue.add_configuration(['a.py', '--seed', '2'], 3)
+        self.assertNotEqual(config1, config2)
+        self.assertEqual(self.queue.add_configuration(['a.py', '--seed', '1'], 2), config1)
+        with self.assertRaises(ValueError):
+            self.queue.add_configuration(['a.py', '--seed', '1'], 3)
+
+        progress = self.queue.progress()
+        self.assertEqual([(p.config_id, p.command, p.num_chunks, p.num_done) for p in progress], [
+            (config1, ['a.py', '--seed', '1'], 2, 0),
+            (config2, ['a.py', '--seed', '2'], 3, 0),
+        ])
+
+    def test_lease(self) -> None:
+        config_id = self.queue.add_configuration(['a.py'], 2)
+        lease1 = self.queue.lease('w1', 10)
+        lease2 = self.queue.lease('w2', 10)
+        assert lease1 is not None
+        assert lease2 is not None
+        self.assertEqual((lease1.config_id, lease1.chunk_index, lease1.num_chunks), (config_id, 0, 2))
+        self.assertEqual((lease2.config_id, lease2.chunk_index, lease2.num_chunks), (config_id, 1, 2))
+        self.assertEqual(lease1.command, ['a.py'])
+        self.assertIsNone(self.queue.lease('w3', 10))
+        self.assertEqual(self.queue.progress()[0].num_leased, 2)
+
+    def test_leases_are_shared_among_connections(self) -> None:
+        self.queue.add_configuration(['a.py'], 1)
+        other = WorkQueue(self.path, self.clock)
+        try:
+            self.assertIsNotNone(other.lease('w1', 10))
+            self.assertIsNone(self.queue.lease('w2', 10))
+        finally:
+            other.close()
+
+    def test_heartbeat_and_expiration(self) -> None:
+        self.queue.add_configuration(['a.py'], 1)
+        lease1 = self.queue.lease('w1', 10)
+        assert lease1 is not None
+
+        self.clock.now += 8
+        self.assertTrue(self.queue.heartbeat(lease1, 10))
+        self.clock.now += 8
+        # The heartbeat has extended the lease.
+        self.assertIsNone(self.queue.lease('w2', 10))
+
+        self.clock.now += 8
+        lease2 = self.queue.lease('w2', 10)
+        assert lease2 is not None
+        self.assertEqual(lease2.chunk_index, lease1.chunk_index)
+        self.assertFalse(self.queue.heartbeat(lease1, 10))
+        self.assertTrue(self.queue.heartbeat(lease2, 10))
+
+    def test_complete(self) -> None:
+        config_id = self.queue.add_configuration(['a.py'], 2)
+        lease1 = self.queue.lease('w1', 10)
+        lease2 = self.queue.lease('w2', 10)
+        assert lease1 is not None
+        assert lease2 is not None
+
+        self.queue.complete(lease2, b'b')
+        self.assertEqual(self.queue.results(config_id), [(1, b'b')])
+        self.assertEqual(self.queue.progress()[0].num_done, 1)
+        self.assertFalse(self.queue.heartbeat(lease2, 10))
+
+        # Completed chunks are never leased again.
+        self.clock.now += 100
+        lease3 = self.queue.lease('w3', 10)
+        assert lease3 is not None
+        self.assertEqual(lease3.chunk_index, 0)
+
+        # Both the expired and the new lease may complete.
+        self.queue.complete(lease1, b'a')
+        self.queue.complete(lease3, b'a')
+        self.assertEqual(self.queue.results(config_id), [(0, b'a'), (1, b'b')])
+        self.assertIsNone(self.queue.lease('w4', 10))
+
+    def test_release(self) -> None:
+        self.queue.add_configuration(['a.py'], 1)
+        lease1 = self.queue.lease('w1', 10)
+        assert lease1 is not None
+        self.queue.release(lease1)
+        lease2 = self.queue.lease('w2', 10)
+        assert lease2 is not None
+        self.assertEqual(lease2.chunk_index, 0)
+        # Releasing a lost lease has no effect.
+        self.queue.release(lease1)
+        self.assertIsNone(self.queue.lease('w3', 10))
+
+    def test_max_attempts(self) -> None:
+        queue = WorkQueue(self.path, self.clock, max_attempts=2)
+        try:
+            config1 = queue.add_configuration(['a.py'], 1)
+            config2 = queue.add_configuration(['b.py'], 1)
+            for _ in range(2):
+                lease = queue.lease('w1', 10)
+                assert lease is not None
+                self.assertEqual(lease.config_id, config1)
+                queue.release(lease)
+            # The failing chunk doesn't keep the workers from the other configuration.
+            lease = queue.lease('w1', 10)
+            assert lease is not None
+            self.assertEqual(lease.config_id, config2)
+            self.assertEqual([p.num_failed for p in queue.progress()], [1, 0])
+
+            # Expired leases count as attempts, too.
+            self.clock.now += 100
+            lease = queue.lease('w2', 10)
+            assert lease is not None
+            self.assertEqual(lease.config_id, config2)
+            self.clock.now += 100
+            self.assertIsNone(queue.lease('w3', 10))
+            self.assertEqual([p.num_failed for p in queue.progress()], [1, 1])
+        finally:
+            queue.close()
+
+    def test_merge_failure(self) -> None:
+        config_id = self.queue.add_configuration(['no_such_script.py'], 1)
+        lease = self.queue.lease('w1', 10)
+        assert lease is not None
+        self.queue.complete(lease, b'a')
+        self.assertNotEqual(merge(self.queue, config_id), 0)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import pymatching
+import stim
+import threading
+
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class WorkerPool:
+    '''\
+    A process pool that lives across simulation phases and configurations.
+
+    Creating a ProcessPoolExecutor per phase makes every worker re-import stim and pymatching and rebuild
+    its decoders. A WorkerPool is created once per invocation and shared by the phases, and its worker
+    processes keep compiled state (see `cached_matcher()`) between tasks.
+
+    With `use_threads`, the workers are threads of this process instead, and they share one matcher per
+    circuit, so the memory for the decoders doesn't grow with `parallelism`. Note that stim and PyMatching hold
+    the GIL while sampling and decoding (as of stim 1.16 and PyMatching 2.4), so threads trade throughput for
+    memory; see benchmark_execution_modes.py.
+
+    Example:
+        with WorkerPool(parallelism) as pool:
+            table = parallel_construct_lookup_table(..., pool=pool)
+            results = perform_parallel_simulation(..., pool=pool)
+    '''
+    def __init__(self, parallelism: int, use_threads: bool = False) -> None:
+        self.parallelism = parallelism
+        self.use_threads = use_threads
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        '''Returns the underlying executor, starting the workers if needed.'''
+        if self._executor is None:
+            if self.use_threads:
+                self._executor = ThreadPoolExecutor(max_workers=self.parallelism)
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.parallelism)
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self) -> WorkerPool:
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace) -> None:
+        self.shutdown()
+
+
+@contextlib.contextmanager
+def borrow_executor(pool: WorkerPool | None, parallelism: int) -> Iterator[Executor]:
+    '''\
+    Yields the executor of `pool`, or of a temporary pool with `parallelism` workers when `pool` is None.
+    The temporary pool is shut down on exit, while `pool` is left running.
+    '''
+    if pool is not None:
+        yield pool.executor
+        return
+    with WorkerPool(parallelism) as temporary_pool:
+        yield temporary_pool.executor
+
+
+# Matchers built in this process, keyed by the digest of the circuit. Each worker process has its own cache,
+# which survives across tasks as long as the pool lives. Worker threads share the cache of their process.
+_MAX_CACHED_MATCHERS = 8
+_matchers: OrderedDict[str, pymatching.Matching] = OrderedDict()
+_matchers_lock = threading.Lock()
+
+
+def cached_matcher(circuit: stim.Circuit) -> pymatching.Matching:
+    '''\
+    Returns a matcher for the decomposed DEM of `circuit`, reusing the one built by an earlier task in
+    this process if any.
+    '''
+    key = hashlib.sha256(str(circuit).encode()).hexdigest()
+    # Holding the lock while building lets concurrent threads wait for one matcher instead of building their own.
+    with _matchers_lock:
+        matcher = _matchers.get(key)
+        if matcher is None:
+            dem = circuit.detector_error_model(decompose_errors=True)
+            matcher = pymatching.Matching.from_detector_error_model(dem)
+            _matchers[key] = matcher
+            if len(_matchers) > _MAX_CACHED_MATCHERS:
+                _matchers.popitem(last=False)
+        else:
+            _matchers.move_to_end(key)
+        return matcher
@@ -0,0 +1,48 @@
+import os
+import stim
+import unittest
+
+from worker_pool import *
+
+
+def _square(x: int) -> int:
+    return x * x
+
+
+def _matcher_id_and_pid(circuit: stim.Circuit) -> tuple[int, int]:
+    return (id(cached_matcher(circuit)), os.getpid())
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_borrow_executor(self) -> None:
+        with WorkerPool(2) as pool:
+            with borrow_executor(pool, 2) as executor1:
+                self.assertEqual(executor1.submit(_square, 3).result(), 9)
+            # The pool survives the first phase.
+            with borrow_executor(pool, 2) as executor2:
+                self.assertIs(executor1, executor2)
+                self.assertEqual(executor2.submit(_square, 4).result(), 16)
+
+    def test_threads(self) -> None:
+        circuit = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=2,
+                                         before_round_data_depolarization=0.01)
+        with WorkerPool(4, use_threads=True) as pool:
+            with borrow_executor(pool, 4) as executor:
+                results = [executor.submit(_matcher_id_and_pid, circuit) for _ in range(8)]
+                # All the workers share the matcher of this process.
+                self.assertEqual({r.result() for r in results}, {(id(cached_matcher(circuit)), os.getpid())})
+
+    def test_borrow_temporary_executor(self) -> None:
+        with borrow_executor(None, 1) as executor:
+            self.assertEqual(executor.submit(_square, 5).result(), 25)
+
+    def test_cached_matcher(self) -> None:
+        circuit1 = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=2,
+                                          before_round_data_depolarization=0.01)
+        circuit2 = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=2,
+                                          before_round_data_depolarization=0.01)
+        circuit3 = stim.Circuit.generated('repetition_code:memory', distance=5, rounds=2,
+                                          before_round_data_depolarization=0.01)
+
+        self.assertIs(cached_matcher(circuit1), cached_matcher(circuit2))
+        self.assertIsNot(cached_matcher(circuit1), cached_matcher(circuit3))